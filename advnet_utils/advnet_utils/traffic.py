@@ -1,10 +1,16 @@
 import csv
+import json
 import time
 import math
 import socket
 import struct
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
 
-from advnet_utils.utils import _parse_rate, _parse_size
+from advnet_utils.utils import _parse_rate, _parse_size, FLOW_LOG_MAGIC, FLOW_LOG_RECORD
 
 # Network constants (bytes)
 MTU = 1500
@@ -19,12 +25,32 @@ UDP_MAX_PAYLOAD = MTU - IPV4_HEADER - UDP_HEADER
 
 # Custom constants (packets)
 UDP_MAX_BURST_SIZE = 1
+# Packets sent or received with one sendmmsg/recvmmsg call
+UDP_BATCH_SIZE = 64
+# Receive buffer of each packet (bytes)
+UDP_RECV_SIZE = 4096
 
 # https://www.man7.org/linux/man-pages/man7/socket.7.html
 # Default value is 212992
 TCP_BUFFER_SIZE = int(212992*1.5)
 UDP_BUFFER_SIZE = int(212992*1.5)
 
+# Bytes passed to each TCP send call
+TCP_SEND_SIZE = 64 * 1024
+# Sample TCP_INFO at most every TCP_INFO_INTERVAL_MS, or every TCP_INFO_EVERY sends if the interval is 0.
+# Below about one MSS per ms this is the RTT row per send of the MSS-sized sends, above it caps the getsockopt calls
+TCP_INFO_INTERVAL_MS = 1
+TCP_INFO_EVERY = 16
+
+# Records buffered by a flow log before they are written (64 KiB)
+FLOW_LOG_BUFFER = 4096
+
+# Pacing: the sender sleeps until this long before a deadline and spins the rest (ns),
+# which covers the wake-up latency of the scheduler (timer slack is 50 us by default)
+PACING_SPIN_NS = 100000
+# /usr/include/uapi/asm-generic/socket.h
+SO_MAX_PACING_RATE = getattr(socket, 'SO_MAX_PACING_RATE', 47)
+
 # /usr/include/linux/tcp.h
 TCP_INFO = [
     'tcpi_state', 
@@ -91,7 +117,372 @@ def get_tcp_info(s):
     for i in range(len(tuple_info)):
         dict_info[TCP_INFO[i]] = tuple_info[i]
     return dict_info
-  
+
+
+def tcp_info_struct(fields):
+    """Precompile a struct that unpacks only `fields` of TCP_INFO, in the order of TCP_INFO.
+
+    The struct ends with the last field, so only the bytes up to it need to be read.
+    """
+    fmt = TCP_INFO_BYTES[0]
+    skip = 0
+    for name, code in zip(TCP_INFO, TCP_INFO_BYTES[1:]):
+        if name in fields:
+            fmt += '{}x{}'.format(skip, code) if skip else code
+            skip = 0
+        else:
+            skip += struct.calcsize(TCP_INFO_BYTES[0] + code)
+    return struct.Struct(fmt)
+
+
+TCP_INFO_RTT = tcp_info_struct(['tcpi_rtt', 'tcpi_segs_out'])
+
+
+class TcpInfoSampler:
+    """Samples the RTT of a TCP socket at most every `interval_ms`, or every `every` sends.
+
+    The first send is always sampled. Only tcpi_rtt and tcpi_segs_out are read, see TCP_INFO_RTT.
+
+    Args:
+        s (socket.socket): Connected TCP socket.
+        every (int, optional): Sends between two samples if ``interval_ms`` is 0. Defaults to TCP_INFO_EVERY.
+        interval_ms (float, optional): Minimum time between two samples, 0 to count sends. Defaults to TCP_INFO_INTERVAL_MS.
+    """
+
+    def __init__(self, s, every=TCP_INFO_EVERY, interval_ms=TCP_INFO_INTERVAL_MS):
+        assert isinstance(every, int) and every > 0 # Sample at least every send
+        self.s = s
+        self.every = every
+        self.interval = interval_ms / 1e3
+        self.sends = 0
+        self.next_sample = time.time()
+        self.tcpi_segs_out = 0
+
+    def sample(self):
+        """Count a send, return the RTT in us if it is sampled and segments went out since the last sample."""
+        self.sends += 1
+        if self.interval > 0:
+            now = time.time()
+            if now < self.next_sample:
+                return None
+            self.next_sample = now + self.interval
+        elif (self.sends - 1) % self.every:
+            return None
+
+        return self.read()
+
+    def read(self):
+        """Return the RTT in us if segments went out since the last sample, e.g. after the last send."""
+        rtt, segs_out = TCP_INFO_RTT.unpack(self.s.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_RTT.size))
+        if segs_out <= self.tcpi_segs_out:
+            return None
+        self.tcpi_segs_out = segs_out
+        return rtt
+
+
+class FlowLog:
+    """Binary log of (sequence number, timestamp) records, see read_flow_log in utils.
+
+    The records are packed into a preallocated buffer and written in large chunks,
+    so logging a packet costs no formatting and no system call.
+
+    Args:
+        out_file (str): Name of the log file.
+        fields (list): Names of the two fields.
+    """
+
+    def __init__(self, out_file, fields):
+        self.record = struct.Struct(FLOW_LOG_RECORD)
+        self.buffer = bytearray(self.record.size * FLOW_LOG_BUFFER)
+        self.offset = 0
+        self.output = open(out_file, 'wb')
+        self.output.write(FLOW_LOG_MAGIC + ','.join(fields).encode() + b'\n')
+
+    def write(self, seq_num, timestamp):
+        """Add a record."""
+        self.record.pack_into(self.buffer, self.offset, seq_num, timestamp)
+        self.offset += self.record.size
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records."""
+        self.output.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+        self.output.flush()
+
+    def close(self):
+        self.flush()
+        self.output.close()
+
+
+# sendmmsg(2) and recvmmsg(2) are not exposed by the socket module
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sendmmsg = _libc.sendmmsg
+    _recvmmsg = _libc.recvmmsg
+except (OSError, AttributeError, TypeError):
+    _sendmmsg = _recvmmsg = None
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+# Payload header: sequence number, ip proto, sport and dport
+UDP_PAYLOAD_HEADER = struct.Struct('>QBHH')
+UDP_SEQ_NUM = struct.Struct('>Q')
+# struct sockaddr_in
+SOCKADDR_IN = struct.Struct('=H2s4s8x')
+
+
+def _mmsg_vector(buffer, slot_size, names, name_size):
+    """Build the mmsghdr array of sendmmsg/recvmmsg, one message per slot of `buffer`.
+
+    Args:
+        buffer (ctypes array): Packet buffer, slot i starts at i * slot_size.
+        slot_size (int): Size of each slot in bytes.
+        names (ctypes array): Addresses of the messages, slot i starts at i * name_size.
+        name_size (int): Size of each address, 0 to share the first one.
+
+    Returns:
+        tuple: mmsghdr array and its iovec array, which must be kept alive with it.
+    """
+    size = len(buffer) // slot_size
+    iovs = (_iovec * size)()
+    msgs = (_mmsghdr * size)()
+    for i in range(size):
+        iovs[i].iov_base = ctypes.addressof(buffer) + i * slot_size
+        iovs[i].iov_len = slot_size
+        msgs[i].msg_hdr.msg_name = ctypes.addressof(names) + i * name_size
+        msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN.size
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    return msgs, iovs
+
+
+class UdpBurstSender:
+    """Sends bursts of packets of a UDP flow with one sendmmsg call.
+
+    The payloads are built once in a buffer of UDP_BATCH_SIZE packets and only the sequence
+    numbers are patched before each burst. Falls back to one sendto per packet without sendmmsg.
+
+    Args:
+        s (socket.socket): Bound UDP socket.
+        dst (str): Destination IP.
+        dport (int): Destination port.
+        sport (int): Source port, written in the payload.
+        protocol (int): IP protocol number, written in the payload.
+        payload_size (int): UDP payload in bytes.
+    """
+
+    def __init__(self, s, dst, dport, sport, protocol, payload_size):
+        self.s = s
+        self.address = (dst, dport)
+        self.payload_size = payload_size
+        self.buffer = ctypes.create_string_buffer(payload_size * UDP_BATCH_SIZE)
+        self.view = memoryview(self.buffer).cast('B')
+        for i in range(UDP_BATCH_SIZE):
+            UDP_PAYLOAD_HEADER.pack_into(self.buffer, i * payload_size, 0, protocol, sport, dport)
+
+        if _sendmmsg is not None:
+            self.name = ctypes.create_string_buffer(SOCKADDR_IN.pack(socket.AF_INET,
+                                                                     dport.to_bytes(2, byteorder='big'),
+                                                                     socket.inet_aton(socket.gethostbyname(dst))),
+                                                    SOCKADDR_IN.size)
+            self.msgs, self.iovs = _mmsg_vector(self.buffer, payload_size, self.name, 0)
+
+    def send(self, seq_num, count):
+        """Send `count` packets numbered from `seq_num`, at most UDP_BATCH_SIZE.
+
+        Returns:
+            int: packets sent, fewer than `count` only if a non-blocking socket is full.
+        """
+        for i in range(count):
+            UDP_SEQ_NUM.pack_into(self.buffer, i * self.payload_size, seq_num + i)
+
+        if _sendmmsg is None:
+            for i in range(count):
+                try:
+                    self.s.sendto(self.view[i * self.payload_size:(i + 1) * self.payload_size], self.address)
+                except BlockingIOError:
+                    return i
+            return count
+
+        sent = 0
+        while sent < count:
+            n = _sendmmsg(self.s.fileno(), ctypes.byref(self.msgs, sent * ctypes.sizeof(_mmsghdr)), count - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise OSError(err, os.strerror(err))
+            sent += n
+        return sent
+
+
+class UdpBurstReceiver:
+    """Receives the packets waiting on a UDP socket with one recvmmsg call.
+
+    Falls back to one recvfrom per call without recvmmsg.
+
+    Args:
+        s (socket.socket): Bound UDP socket.
+    """
+
+    def __init__(self, s):
+        self.s = s
+        if _recvmmsg is not None:
+            self.buffer = ctypes.create_string_buffer(UDP_RECV_SIZE * UDP_BATCH_SIZE)
+            self.names = ctypes.create_string_buffer(SOCKADDR_IN.size * UDP_BATCH_SIZE)
+            self.msgs, self.iovs = _mmsg_vector(self.buffer, UDP_RECV_SIZE, self.names, SOCKADDR_IN.size)
+
+    def recv(self, timeout=None):
+        """Wait for packets.
+
+        Args:
+            timeout (float, optional): Seconds to wait, forever if None.
+
+        Raises:
+            socket.timeout: if no packet arrived in time.
+
+        Returns:
+            list: source port and sequence number of the received packets.
+        """
+        if _recvmmsg is None:
+            self.s.settimeout(timeout)
+            try:
+                data, (_, pkt_sport) = self.s.recvfrom(UDP_RECV_SIZE)
+            except BlockingIOError:
+                return []
+            return [(pkt_sport, int.from_bytes(data[:8], byteorder='big'))]
+
+        readable, _, _ = select.select([self.s], [], [], timeout)
+        if not readable:
+            raise socket.timeout('timed out')
+
+        for i in range(UDP_BATCH_SIZE):
+            self.msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN.size
+        n = _recvmmsg(self.s.fileno(), self.msgs, UDP_BATCH_SIZE, socket.MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EINTR, errno.EAGAIN):
+                return []
+            raise OSError(err, os.strerror(err))
+
+        packets = []
+        for i in range(n):
+            if self.msgs[i].msg_len < UDP_SEQ_NUM.size:
+                continue
+            _, pkt_sport, _ = SOCKADDR_IN.unpack_from(self.names, i * SOCKADDR_IN.size)
+            seq_num, = UDP_SEQ_NUM.unpack_from(self.buffer, i * UDP_RECV_SIZE)
+            packets.append((int.from_bytes(pkt_sport, byteorder='big'), seq_num))
+        return packets
+
+
+def _check_udp_sender(dst, sport, dport, tos, rate, duration, payload_size, max_burst_size):
+    """Sanity checks of the arguments of a UDP sender, `rate` in B/s."""
+    assert isinstance(dst, str) # Desination IP must be a string
+    assert rate > 0 # The flow must have a positive rate
+    assert isinstance(sport, int) and sport > 0 and sport < 2**16 # Check valid port number
+    assert isinstance(dport, int) and dport > 0 and dport < 2**16 # Check valid port number
+    assert isinstance(tos, int) and tos >= 0 and tos < 2**8 # Check valid ToS value
+    assert (isinstance(duration, float) or isinstance(duration, int)) and duration >= 0 # Duration must be positive
+    assert isinstance(payload_size, int) and payload_size > 13 and payload_size <= UDP_MAX_PAYLOAD # Check valid payload size
+    assert isinstance(max_burst_size, int) and max_burst_size > 0 # The maximum burst size must be at least 1 packet
+
+
+def _check_tcp_sender(dst, sport, dport, tos, send_size, rate, duration, payload_size):
+    """Sanity checks of the arguments of a TCP sender, `rate` in B/s and `send_size` in bytes."""
+    assert isinstance(dst, str) # Desination IP must be a string
+    assert rate >= 0 # The flow must not be negative
+    assert send_size >= 0 # The flow size must not be negative
+    assert (rate > 0 and duration > 0) or send_size > 0 # Guarantee that some data are actually sent
+    assert isinstance(sport, int) and sport > 0 and sport < 2**16 # Check valid port number
+    assert isinstance(dport, int) and dport > 0 and dport < 2**16 # Check valid port number
+    assert isinstance(tos, int) and tos >= 0 and tos < 2**8 # Check valid ToS value
+    assert (isinstance(duration, float) or isinstance(duration, int)) and duration >= 0 # Duration must not be negative
+    assert isinstance(payload_size, int) and payload_size > 0 and payload_size <= TCP_MAX_PAYLOAD # Check valid payload size
+
+
+def _check_receiver(sport, dport, duration):
+    """Sanity checks of the arguments of a UDP or TCP receiver."""
+    assert isinstance(sport, int) and sport > 0 and sport < 2**16 # Check valid port number
+    assert isinstance(dport, int) and dport > 0 and dport < 2**16 # Check valid port number
+    assert (isinstance(duration, float) or isinstance(duration, int)) and duration >= 0 # Duration must be positive
+
+
+def _wait_until(deadline_ns, spin_ns=PACING_SPIN_NS):
+    """Wait until time.perf_counter_ns() reaches `deadline_ns`.
+
+    Sleeps until `spin_ns` before the deadline and busy waits the rest.
+    """
+    remaining = deadline_ns - time.perf_counter_ns()
+    if remaining > spin_ns:
+        time.sleep((remaining - spin_ns) / 1e9)
+    while time.perf_counter_ns() < deadline_ns:
+        pass
+
+
+class PacingStats:
+    """Lateness of the wake-ups of a paced sender, see send_udp_flow."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.start_ns = time.perf_counter_ns()
+        self.wakeups = 0
+        self.late_sum = self.late_sq = self.late_max = 0
+
+    def wakeup(self, late):
+        """Add a wake-up `late` ns after its deadline."""
+        self.wakeups += 1
+        self.late_sum += late
+        self.late_sq += late * late
+        self.late_max = max(self.late_max, late)
+
+    def save(self, out_csv, rate, sent_bytes, packets):
+        """Save the pacing summary of the flow next to its log and return it."""
+        elapsed = (time.perf_counter_ns() - self.start_ns) / 1e9
+        late_mean = self.late_sum / self.wakeups if self.wakeups else 0
+        summary = {
+            'start': self.start_time,
+            'rate': rate,
+            'achieved_rate': sent_bytes / elapsed if elapsed > 0 else 0,
+            'packets': packets,
+            'wakeups': self.wakeups,
+            'lateness_mean_us': late_mean / 1e3,
+            'jitter_us': math.sqrt(max(self.late_sq / self.wakeups - late_mean ** 2, 0)) / 1e3 if self.wakeups else 0,
+            'lateness_max_us': self.late_max / 1e3,
+        }
+        with open(os.path.splitext(out_csv)[0] + '-pacing.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        return summary
+
 
 ## UDP
 def send_udp_flow(dst='127.0.0.1',
@@ -103,8 +494,16 @@ def send_udp_flow(dst='127.0.0.1',
                   payload_size=UDP_MAX_PAYLOAD,
                   max_burst_size=UDP_MAX_BURST_SIZE,
                   out_csv='send.csv',
+                  spin_ns=PACING_SPIN_NS,
+                  kernel_pacing=False,
                   **kwargs):
     """UDP sending function that keeps a constant rate and logs sent packets to a file.
+
+    The token bucket holds ``rate * elapsed - sent`` bytes, so each packet has an absolute
+    deadline (when the bucket reaches ``payload_size``) and the sender waits for it with
+    _wait_until instead of accumulating sleep errors. The pacing summary (achieved rate and
+    lateness of the sends) is returned and saved next to ``out_csv`` as ``*-pacing.json``.
+
     Args:
         dst (str, optional): Destination IP. Defaults to '127.0.0.1'.
         sport (int, optional): Source port. Defaults to 5000.
@@ -114,108 +513,106 @@ def send_udp_flow(dst='127.0.0.1',
         duration (float, optional): Flow duration in seconds. Defaults to 10.
         payload_size (int, optional): UDP payload in bytes. Defaults to UDP_MAX_PAYLOAD.
         max_burst_size (int, optional): UDP burst size in number of packets. Defaults to UDP_MAX_BURST_SIZE.
-        out_csv (str, optional): Log of sent packets with timestamps. Defaults to 'send.csv'.
-    
+        out_csv (str, optional): Binary log of sent packets with timestamps, see FlowLog. Defaults to 'send.csv'.
+        spin_ns (int, optional): Busy wait before each deadline in ns, 0 to only sleep. Defaults to PACING_SPIN_NS.
+        kernel_pacing (bool, optional): Also cap the rate with SO_MAX_PACING_RATE, needs the fq qdisc. Defaults to False.
+
+    Returns:
+        dict: pacing summary of the flow.
+
     Note:
-        ``max_burst_size`` cannot be smaller than ``1``.
+        ``max_burst_size`` cannot be smaller than ``1``. The packets of a burst are sent with one
+        sendmmsg call per UDP_BATCH_SIZE packets and logged with the same timestamp.
     """
     # Convert rates to B/s
     rate = _parse_rate(rate)
     #print("rate", rate, "\n")
 
     # Sanity checks
-    assert isinstance(dst, str) # Desination IP must be a string
-    assert rate > 0 # The flow must have a positive rate
-    assert isinstance(sport, int) and sport > 0 and sport < 2**16 # Check valid port number
-    assert isinstance(dport, int) and dport > 0 and dport < 2**16 # Check valid port number
-    assert isinstance(tos, int) and tos >= 0 and tos < 2**8 # Check valid ToS value
-    assert (isinstance(duration, float) or isinstance(duration, int)) and duration >= 0 # Duration must be positive
-    assert isinstance(payload_size, int) and payload_size > 13 and payload_size <= UDP_MAX_PAYLOAD # Check valid payload size
-    assert isinstance(max_burst_size, int) and max_burst_size > 0 # The maximum burst size must be at least 1 packet
+    _check_udp_sender(dst, sport, dport, tos, rate, duration, payload_size, max_burst_size)
 
-    # Open .csv file
-    output = open(out_csv, 'w', newline='')
-    # Fields of the .csv
-    fields = ['seq_num', 't_timestamp']
-    # CSV writer
-    csv_writer = csv.DictWriter(output, fieldnames=fields)
-    # Write header
-    csv_writer.writeheader()
+    # Open log file
+    log = FlowLog(out_csv, ['seq_num', 't_timestamp'])
 
     # Open socket
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setsockopt(socket.SOL_IP, socket.IP_TOS, tos)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE) 
+    if kernel_pacing:
+        s.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, min(int(rate), 2**32 - 1))
 
     s.setblocking(True)
     s.bind(('', sport))
 
     # udp protocol number
     protocol = 17
+    # Prebuilt payloads
+    sender = UdpBurstSender(s, dst, dport, sport, protocol, payload_size)
+    # Bytes on the wire per packet
+    packet_size = payload_size + ETHERNET_HEADER + IPV4_HEADER + UDP_HEADER
 
-    # Initialize token bucket
-    token_bucket = 0
-    # Initialize burst counter
-    brst_count = 0
+    # Initialize sent bytes, the token bucket holds rate * elapsed - sent_bytes
+    sent_bytes = 0
     # Initialize sequence number
     seq_num = 1
-
     # Save start time
-    startTime = lastTime = time.time()
+    stats = PacingStats()
+    start_ns = stats.start_ns
 
     # Compute end time
     if duration > 0:
-        endTime = startTime + duration
+        end_ns = start_ns + int(duration * 1e9)
     else:
-        endTime = None
+        end_ns = None
 
     while True:
-        while token_bucket >= payload_size and brst_count < max_burst_size:
-            # Get timestamp
-            timestamp = time.time()
-            # Send packet
-            # concatenates ip proto +  sport, dport and sequence number in the packet payload
-            payload =  seq_num.to_bytes(8, byteorder='big') + protocol.to_bytes(1, byteorder="big") + sport.to_bytes(2, byteorder="big") + dport.to_bytes(2, byteorder="big") + bytes(payload_size - 13)
-
-            s.sendto(payload, (dst, dport))
-
-            # Save log to the .csv file
-            csv_writer.writerow({'seq_num': seq_num, 't_timestamp': timestamp})
-            # Increase the sequence number
-            seq_num += 1
-            # Increse the burst counter
-            brst_count += 1
-            # Remove tokens from the bucket
-            token_bucket -= payload_size + ETHERNET_HEADER + IPV4_HEADER + UDP_HEADER 
-            # If the sequence number needs more bytes, raise exception
-            if math.ceil(seq_num.bit_length() / 8) > payload_size-4:
-                raise Exception('cannot store sequence number in packet payload!')
-        
-        # Get current time
-        currentTime = time.time()
+        # Deadline of the next packet, when the bucket holds payload_size tokens
+        deadline_ns = start_ns + int((sent_bytes + payload_size) * 1e9 / rate)
 
         # Break if duration expired
-        if endTime is not None:
-            if currentTime >= endTime:
-                break
+        if end_ns is not None and deadline_ns >= end_ns:
+            break
 
-        # Compute elapsed time
-        diffTime = currentTime - lastTime
-        lastTime = currentTime
+        _wait_until(deadline_ns, spin_ns)
+        current_ns = time.perf_counter_ns()
+        stats.wakeup(current_ns - deadline_ns)
 
-        # Add tokens to bucket
-        token_bucket += rate * diffTime
+        # Fill the bucket
+        token_bucket = rate * (current_ns - start_ns) / 1e9 - sent_bytes
         # Reset the burst counter
         brst_count = 0
 
-        # Sleep for at least one packet in the token_bucket
-        time.sleep(max(payload_size - token_bucket, 0) / rate)
+        while token_bucket >= payload_size and brst_count < max_burst_size:
+            # Packets the bucket allows, a packet is sent while at least payload_size tokens are left
+            count = min(int((token_bucket - payload_size) // packet_size) + 1, max_burst_size - brst_count, UDP_BATCH_SIZE)
+            # If the last sequence number needs more bytes than the payload has for it, raise exception
+            if math.ceil((seq_num + count - 1).bit_length() / 8) > min(payload_size - 4, UDP_SEQ_NUM.size):
+                raise Exception('cannot store sequence number in packet payload!')
+            # Get timestamp
+            timestamp = time.time()
+            # Send packets
+            # the payload carries the sequence number, ip proto, sport and dport
+            sender.send(seq_num, count)
+
+            # Save log
+            for i in range(count):
+                log.write(seq_num + i, timestamp)
+            # Increase the sequence number
+            seq_num += count
+            # Increse the burst counter
+            brst_count += count
+            # Remove tokens from the bucket
+            token_bucket -= count * packet_size
+            sent_bytes += count * packet_size
 
     # Close socket
     s.close()
-    # Close .csv file
-    output.close()
+    # Close log file
+    log.close()
+
+    # Pacing summary
+    return stats.save(out_csv, rate, sent_bytes, seq_num - 1)
 
 
 def recv_udp_flow(sport=5000,
@@ -229,27 +626,20 @@ def recv_udp_flow(sport=5000,
         sport (int, optional): Source port of the flow. Defaults to 5000.
         dport (int, optional): Port to listen on. Defaults to 5001.
         duration (float, optional): Listening time in seconds. Defaults to 10.
-        out_csv (str, optional): Log of received packets with timestamps. Defaults to 'recv.csv'.
+        out_csv (str, optional): Binary log of received packets with timestamps, see FlowLog. Defaults to 'recv.csv'.
     """
     # Sanity checks
-    assert isinstance(sport, int) and sport > 0 and sport < 2**16 # Check valid port number
-    assert isinstance(dport, int) and dport > 0 and dport < 2**16 # Check valid port number
-    assert (isinstance(duration, float) or isinstance(duration, int)) and duration >= 0 # Duration must be positive
+    _check_receiver(sport, dport, duration)
 
-    # Open .csv file
-    output = open(out_csv, 'w', newline='')
-    # Fields of the .csv
-    fields = ['seq_num', 'r_timestamp']
-    # CSV writer
-    csv_writer = csv.DictWriter(output, fieldnames=fields)
-    # Write header
-    csv_writer.writeheader()
+    # Open log file
+    log = FlowLog(out_csv, ['seq_num', 'r_timestamp'])
 
     # Open socket
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE) 
     s.bind(('', dport))
+    receiver = UdpBurstReceiver(s)
 
     # Save start time
     startTime = time.time()
@@ -262,9 +652,6 @@ def recv_udp_flow(sport=5000,
 
     # Receive packets
     while True:
-        # Get current time
-        currentTime = time.time()
-
         # Break if duration expired
         if endTime is not None:
             # Get current time
@@ -272,33 +659,29 @@ def recv_udp_flow(sport=5000,
             if currentTime >= endTime:
                 break
             # Update timeout
-            s.settimeout(max(endTime - time.time(), 0))
+            timeout = endTime - currentTime
         else:
-            s.setblocking(True)
+            timeout = None
 
         try:
-            # Get data from socket
-            data, address = s.recvfrom(4096)
+            # Get the waiting packets from socket
+            packets = receiver.recv(timeout)
             # Get timestamp
             timestamp = time.time()
-            # Get source address
-            _, pkt_sport = address
 
-            # Only accept packets from the expected source
-            if pkt_sport == sport:
-                # Parse sequence number
-                seq_num = int.from_bytes(data[:8], byteorder='big')
-                # Save log to the .csv file
-                csv_writer.writerow({'seq_num': seq_num, 'r_timestamp': timestamp})
+            for pkt_sport, seq_num in packets:
+                # Only accept packets from the expected source
+                if pkt_sport == sport:
+                    # Save log
+                    log.write(seq_num, timestamp)
         # If timeout expired
         except socket.timeout:
             break
 
     # Close socket
     s.close()
-    # Close .csv file
-    output.flush()
-    output.close()
+    # Close log file
+    log.close()
 
 def send_tcp_flow(dst='127.0.0.1',
                   sport=5000,
@@ -309,6 +692,8 @@ def send_tcp_flow(dst='127.0.0.1',
                   duration=10,
                   payload_size=TCP_MAX_PAYLOAD,
                   out_csv='send.csv',
+                  info_every=TCP_INFO_EVERY,
+                  info_interval_ms=TCP_INFO_INTERVAL_MS,
                   **kwargs):
     """TCP sending function that keeps a constant rate and logs sent packets to a file.
 
@@ -322,10 +707,13 @@ def send_tcp_flow(dst='127.0.0.1',
         duration (float, optional): Flow duration in seconds. Defaults to 10.
         payload_size (int, optional): TCP payload in bytes. Defaults to TCP_MAX_PAYLOAD.
         out_csv (str, optional): Log of sent packets with timestamps. Defaults to 'send.csv'.
+        info_every (int, optional): Sends between two RTT samples if ``info_interval_ms`` is 0. Defaults to TCP_INFO_EVERY.
+        info_interval_ms (float, optional): Minimum time between two RTT samples, 0 to count sends. Defaults to TCP_INFO_INTERVAL_MS.
 
     Note:
         - If ``send_size`` is set to ``0`` then the sender will continuously send data. Otherwise,
           it will send the selected amount of data.
+        - The data are sent in chunks of TCP_SEND_SIZE bytes, ``payload_size`` sets the MSS.
         - If ``duration`` is set to ``0``, then the sender will wait indefinitely for flow completion.
     """
     # Convert rates to B/s
@@ -334,15 +722,7 @@ def send_tcp_flow(dst='127.0.0.1',
     send_size = _parse_size(send_size)
 
     # Sanity checks
-    assert isinstance(dst, str) # Desination IP must be a string
-    assert rate >= 0 # The flow must not be negative
-    assert send_size >= 0 # The flow size must not be negative
-    assert (rate > 0 and duration > 0) or send_size > 0 # Guarantee that some data are actually sent
-    assert isinstance(sport, int) and sport > 0 and sport < 2**16 # Check valid port number
-    assert isinstance(dport, int) and dport > 0 and dport < 2**16 # Check valid port number
-    assert isinstance(tos, int) and tos >= 0 and tos < 2**8 # Check valid ToS value
-    assert (isinstance(duration, float) or isinstance(duration, int)) and duration >= 0 # Duration must not be negative
-    assert isinstance(payload_size, int) and payload_size > 0 and payload_size <= TCP_MAX_PAYLOAD # Check valid payload size
+    _check_tcp_sender(dst, sport, dport, tos, send_size, rate, duration, payload_size)
 
     # Compute tot_bytes
     if send_size > 0:
@@ -371,10 +751,8 @@ def send_tcp_flow(dst='127.0.0.1',
     s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TCP_BUFFER_SIZE)
     s.bind(('', sport))
 
-    # Create two fixed payloads
-    payload = bytes(payload_size)
-    # Init tcpi_segs_out counter
-    tcpi_segs_out = 0
+    # Create a fixed payload
+    payload = memoryview(bytes(TCP_SEND_SIZE))
 
     # Save start time
     startTime = time.time()
@@ -403,10 +781,13 @@ def send_tcp_flow(dst='127.0.0.1',
         # Terminate function
         return
 
+    # RTT samples
+    sampler = TcpInfoSampler(s, info_every, info_interval_ms)
+
     # bulk based sender
     while True:
         # Bytes to send
-        bytes_to_send = min(tot_bytes, payload_size)
+        bytes_to_send = min(tot_bytes, TCP_SEND_SIZE)
         # If there are actual data to send
         if bytes_to_send > 0:
             # Update timeouts
@@ -416,7 +797,7 @@ def send_tcp_flow(dst='127.0.0.1',
                 s.setblocking(True)
 
             try:
-                # Send packet
+                # Send chunk, the socket takes what fits in its buffer
                 sent_bytes = s.send(payload[:bytes_to_send])
                 # Break if remote endpoint closed connection
                 if not sent_bytes:
@@ -426,12 +807,9 @@ def send_tcp_flow(dst='127.0.0.1',
                 # Exit loop
                 break
 
-            tcp_info = get_tcp_info(s)
-            if tcp_info['tcpi_segs_out'] > tcpi_segs_out:
-                # Update count
-                tcpi_segs_out = tcp_info['tcpi_segs_out']
-                # Get RTT
-                rtt = tcp_info['tcpi_rtt']
+            # Get RTT
+            rtt = sampler.sample()
+            if rtt is not None:
                 # Save log to the .csv file
                 csv_writer.writerow({'rtt': rtt})
 
@@ -449,6 +827,11 @@ def send_tcp_flow(dst='127.0.0.1',
             if currentTime >= endTime:
                 break
 
+    # Get the RTT after the last send
+    rtt = sampler.read()
+    if rtt is not None:
+        csv_writer.writerow({'rtt': rtt})
+
     # Write elapsed time
     csv_writer.writerow({'rtt': time.time() - startTime})
     # Write unsent bytes
@@ -471,9 +854,7 @@ def recv_tcp_flow(sport=5000,
         duration (float, optional): Listening time in seconds. Defaults to 10.
     """
     # Sanity checks
-    assert isinstance(sport, int) and sport > 0 and sport < 2**16 # Check valid port number
-    assert isinstance(dport, int) and dport > 0 and dport < 2**16 # Check valid port number
-    assert (isinstance(duration, float) or isinstance(duration, int)) and duration >= 0 # Duration must be positive
+    _check_receiver(sport, dport, duration)
 
     # Open socket
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -0,0 +1,349 @@
+"""Traffic agent: runs all the flows of a host on one asyncio event loop.
+
+TrafficManager adds one agent task per host instead of one task per sender and receiver.
+The flows take the arguments of the functions in traffic.py and write the same output files.
+"""
+
+import asyncio
+import csv
+import math
+import socket
+import time
+
+from advnet_utils.utils import _parse_rate, _parse_size, log_error
+from advnet_utils.traffic import (ETHERNET_HEADER, IPV4_HEADER, UDP_HEADER, UDP_MAX_PAYLOAD, UDP_MAX_BURST_SIZE,
+                                  UDP_BATCH_SIZE, UDP_BUFFER_SIZE, UDP_SEQ_NUM, TCP_MAX_PAYLOAD, TCP_BUFFER_SIZE,
+                                  TCP_SEND_SIZE, TCP_INFO_EVERY, TCP_INFO_INTERVAL_MS, SO_MAX_PACING_RATE,
+                                  PACING_SPIN_NS, FlowLog, PacingStats, UdpBurstSender, UdpBurstReceiver,
+                                  TcpInfoSampler, _check_udp_sender, _check_tcp_sender, _check_receiver)
+
+# Bytes read from a TCP connection at once
+TCP_RECV_SIZE = 65536
+
+
+def _timeout(endTime):
+    """Seconds left until endTime, None if there is no end."""
+    if endTime is None:
+        return None
+    return max(endTime - time.time(), 0)
+
+
+async def _wait_writable(s):
+    """Wait until the socket can send again."""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_writer(s.fileno(), lambda: ready.done() or ready.set_result(None))
+    try:
+        await ready
+    finally:
+        loop.remove_writer(s.fileno())
+
+
+## UDP
+async def udp_sender(dst='127.0.0.1',
+                     sport=5000,
+                     dport=5001,
+                     tos=0,
+                     rate='10 Mbps',
+                     duration=10,
+                     payload_size=UDP_MAX_PAYLOAD,
+                     max_burst_size=UDP_MAX_BURST_SIZE,
+                     out_csv='send.csv',
+                     spin_ns=PACING_SPIN_NS,
+                     kernel_pacing=False,
+                     **kwargs):
+    """send_udp_flow on the event loop.
+
+    Like _wait_until, the sender sleeps on a timer of the loop until ``spin_ns`` before the
+    deadline and spins the rest. The pacing is coarser than the one of send_udp_flow: the
+    timers of the loop round up to 1 ms, so a send can still be up to ``1 ms - spin_ns`` late
+    (plus the time the loop is busy with the other flows), and the spin blocks the other flows
+    of the host. The rate is kept either way, a late send makes the next deadlines due.
+    """
+    # Convert rates to B/s
+    rate = _parse_rate(rate)
+
+    # Sanity checks
+    _check_udp_sender(dst, sport, dport, tos, rate, duration, payload_size, max_burst_size)
+
+    # Open log file
+    log = FlowLog(out_csv, ['seq_num', 't_timestamp'])
+
+    # Open socket
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_IP, socket.IP_TOS, tos)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE)
+    if kernel_pacing:
+        s.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, min(int(rate), 2**32 - 1))
+
+    s.setblocking(False)
+    s.bind(('', sport))
+
+    # Prebuilt payloads, 17 is the udp protocol number
+    sender = UdpBurstSender(s, dst, dport, sport, 17, payload_size)
+    packet_size = payload_size + ETHERNET_HEADER + IPV4_HEADER + UDP_HEADER
+
+    sent_bytes = 0
+    seq_num = 1
+    stats = PacingStats()
+    start_ns = stats.start_ns
+    end_ns = start_ns + int(duration * 1e9) if duration > 0 else None
+
+    try:
+        while True:
+            # Deadline of the next packet, when the bucket holds payload_size tokens
+            deadline_ns = start_ns + int((sent_bytes + payload_size) * 1e9 / rate)
+            if end_ns is not None and deadline_ns >= end_ns:
+                break
+
+            remaining = deadline_ns - time.perf_counter_ns()
+            if remaining > spin_ns:
+                await asyncio.sleep((remaining - spin_ns) / 1e9)
+            while time.perf_counter_ns() < deadline_ns:
+                pass
+            current_ns = time.perf_counter_ns()
+            stats.wakeup(current_ns - deadline_ns)
+
+            token_bucket = rate * (current_ns - start_ns) / 1e9 - sent_bytes
+            brst_count = 0
+
+            while token_bucket >= payload_size and brst_count < max_burst_size:
+                count = min(int((token_bucket - payload_size) // packet_size) + 1, max_burst_size - brst_count, UDP_BATCH_SIZE)
+                # If the last sequence number needs more bytes than the payload has for it, raise exception
+                if math.ceil((seq_num + count - 1).bit_length() / 8) > min(payload_size - 4, UDP_SEQ_NUM.size):
+                    raise Exception('cannot store sequence number in packet payload!')
+                timestamp = time.time()
+                sent = sender.send(seq_num, count)
+
+                for i in range(sent):
+                    log.write(seq_num + i, timestamp)
+                seq_num += sent
+                brst_count += sent
+                token_bucket -= sent * packet_size
+                sent_bytes += sent * packet_size
+
+                # The socket buffer is full
+                if sent < count:
+                    await _wait_writable(s)
+    finally:
+        s.close()
+        log.close()
+
+    return stats.save(out_csv, rate, sent_bytes, seq_num - 1)
+
+
+async def udp_receiver(sport=5000,
+                       dport=5001,
+                       duration=10,
+                       out_csv='recv.csv',
+                       **kwargs):
+    """recv_udp_flow on the event loop."""
+    loop = asyncio.get_running_loop()
+
+    # Sanity checks
+    _check_receiver(sport, dport, duration)
+
+    # Open log file
+    log = FlowLog(out_csv, ['seq_num', 'r_timestamp'])
+
+    # Open socket
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
+    s.setblocking(False)
+    s.bind(('', dport))
+    receiver = UdpBurstReceiver(s)
+
+    def on_readable():
+        try:
+            packets = receiver.recv(0)
+        except socket.timeout:
+            return
+        timestamp = time.time()
+
+        for pkt_sport, seq_num in packets:
+            # Only accept packets from the expected source
+            if pkt_sport == sport:
+                log.write(seq_num, timestamp)
+
+    loop.add_reader(s.fileno(), on_readable)
+    try:
+        if duration > 0:
+            await asyncio.sleep(duration)
+        else:
+            await loop.create_future()
+    finally:
+        loop.remove_reader(s.fileno())
+        s.close()
+        log.close()
+
+
+## TCP
+async def tcp_sender(dst='127.0.0.1',
+                     sport=5000,
+                     dport=5001,
+                     tos=0,
+                     send_size=0,
+                     rate=0,
+                     duration=10,
+                     payload_size=TCP_MAX_PAYLOAD,
+                     out_csv='send.csv',
+                     info_every=TCP_INFO_EVERY,
+                     info_interval_ms=TCP_INFO_INTERVAL_MS,
+                     **kwargs):
+    """send_tcp_flow on the event loop."""
+    loop = asyncio.get_running_loop()
+
+    # Convert rates to B/s
+    rate = _parse_rate(rate)
+    # Convert send_size to Bytes
+    send_size = _parse_size(send_size)
+
+    # Sanity checks
+    _check_tcp_sender(dst, sport, dport, tos, send_size, rate, duration, payload_size)
+
+    # Compute tot_bytes
+    if send_size > 0:
+        tot_bytes = send_size
+    else:
+        tot_bytes = math.ceil(rate*duration)
+
+    # Open .csv file
+    output = open(out_csv, 'w', newline='')
+    csv_writer = csv.DictWriter(output, fieldnames=['rtt'])
+    csv_writer.writeheader()
+    # Save tot_bytes as first line
+    csv_writer.writerow({'rtt': tot_bytes})
+
+    # Open socket
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_IP, socket.IP_TOS, tos)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_TCP, socket.TCP_MAXSEG, payload_size)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_BUFFER_SIZE)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TCP_BUFFER_SIZE)
+        s.setblocking(False)
+        s.bind(('', sport))
+
+        # Save start time
+        startTime = time.time()
+        endTime = startTime + duration if duration > 0 else None
+
+        try:
+            # Establish connection
+            await asyncio.wait_for(loop.sock_connect(s, (dst, dport)), _timeout(endTime))
+        except asyncio.TimeoutError:
+            return
+
+        payload = memoryview(bytes(TCP_SEND_SIZE))
+        sampler = TcpInfoSampler(s, info_every, info_interval_ms)
+
+        async def send_all():
+            nonlocal tot_bytes
+            while tot_bytes > 0:
+                try:
+                    sent = s.send(payload[:min(tot_bytes, TCP_SEND_SIZE)])
+                except BlockingIOError:
+                    # The socket buffer is full
+                    await _wait_writable(s)
+                    continue
+
+                # Count the bytes actually written, so the unsent bytes are exact on timeout
+                tot_bytes -= sent
+
+                rtt = sampler.sample()
+                if rtt is not None:
+                    csv_writer.writerow({'rtt': rtt})
+
+            # The RTT after the last send
+            rtt = sampler.read()
+            if rtt is not None:
+                csv_writer.writerow({'rtt': rtt})
+
+        try:
+            await asyncio.wait_for(send_all(), _timeout(endTime))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # Write elapsed time
+            csv_writer.writerow({'rtt': time.time() - startTime})
+            # Write unsent bytes
+            csv_writer.writerow({'rtt': tot_bytes})
+    finally:
+        s.close()
+        output.close()
+
+
+async def tcp_receiver(sport=5000,
+                       dport=5001,
+                       duration=10,
+                       **kwargs):
+    """recv_tcp_flow on the event loop."""
+    loop = asyncio.get_running_loop()
+
+    # Sanity checks
+    _check_receiver(sport, dport, duration)
+
+    # Open socket
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_BUFFER_SIZE)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TCP_BUFFER_SIZE)
+    s.setblocking(False)
+    s.bind(('', dport))
+    s.listen()
+
+    endTime = time.time() + duration if duration > 0 else None
+
+    async def receive():
+        # Wait for the right connection
+        while True:
+            conn, (_, conn_sport) = await loop.sock_accept(s)
+            if conn_sport == sport:
+                break
+            conn.close()
+
+        try:
+            while await loop.sock_recv(conn, TCP_RECV_SIZE):
+                pass
+        finally:
+            conn.close()
+
+    try:
+        await asyncio.wait_for(receive(), _timeout(endTime))
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        s.close()
+
+
+SENDERS = {'udp': udp_sender, 'tcp': tcp_sender}
+RECEIVERS = {'udp': udp_receiver, 'tcp': tcp_receiver}
+
+
+async def _run_flow(function, flow):
+    """Start the flow at its unix start time."""
+    await asyncio.sleep(max(flow['start'] - time.time(), 0))
+    try:
+        await function(**flow['kwargs'])
+    except Exception as e:
+        log_error("Traffic agent: {} {} failed: {!r}".format(function.__name__, flow['kwargs'], e))
+
+
+async def _run_flows(senders, receivers):
+    await asyncio.gather(*[_run_flow(SENDERS[flow['protocol']], flow) for flow in senders],
+                         *[_run_flow(RECEIVERS[flow['protocol']], flow) for flow in receivers])
+
+
+def run_traffic_agent(senders=None, receivers=None):
+    """Run the flows of a host, see TrafficManager.
+
+    Args:
+        senders (list): Flows sent by the host, dicts with the ``protocol``, the unix ``start``
+            time and the ``kwargs`` of send_udp_flow or send_tcp_flow.
+        receivers (list): Flows received by the host, with the ``kwargs`` of recv_udp_flow or recv_tcp_flow.
+    """
+    asyncio.run(_run_flows(senders or [], receivers or []))
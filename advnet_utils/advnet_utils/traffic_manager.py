@@ -10,6 +10,7 @@ from advnet_utils.network_API import AdvNetNetworkAPI
 from advnet_utils.input_parsers import parse_traffic, parse_waypoint_slas
 from advnet_utils.utils import setRateToInt, setSizeToInt, _parse_rate, _parse_size
 from advnet_utils.traffic import send_tcp_flow, send_udp_flow, recv_tcp_flow, recv_udp_flow
+from advnet_utils.traffic_agent import run_traffic_agent
 import networkx as nx
 import csv
 
@@ -144,11 +145,16 @@ class TrafficManager(object):
     """Failure manager."""
     SENDERS_DURATION_OFFSET = 5
 
-    def __init__(self, net: AdvNetNetworkAPI, additional_traffic_file, base_traffic_file, slas_file, additional_constrains, base_constrains, check_constrains, outputdir, experiment_duration):
+    def __init__(self, net: AdvNetNetworkAPI, additional_traffic_file, base_traffic_file, slas_file, additional_constrains, base_constrains, check_constrains, outputdir, experiment_duration, traffic_agent=False):
 
         # get networkx node topology
         self.net = net
 
+        # run the flows of each host in one traffic agent, or each sender and receiver in its own task
+        self.traffic_agent = traffic_agent
+        # host -> flows of its traffic agent
+        self._agent_flows = {}
+
         # checks
         self.check_constrains = check_constrains
 
@@ -447,12 +453,27 @@ class TrafficManager(object):
                 _send_function = send_tcp_flow
                 _recv_function = recv_tcp_flow
 
+            if self.traffic_agent:
+                # add flows to the agents of the hosts
+                self._agent_flows.setdefault(flow["src"], {"senders": [], "receivers": []})["senders"].append(
+                    {"protocol": flow["protocol"], "start": sender_start_time, "kwargs": sender_kwargs})
+                self._agent_flows.setdefault(flow["dst"], {"senders": [], "receivers": []})["receivers"].append(
+                    {"protocol": flow["protocol"], "start": receiver_start_time, "kwargs": receiver_kwargs})
+                continue
+
             # add tasks
             self.net.addTask(flow["src"], _send_function,
                              start=sender_start_time, kwargs=sender_kwargs)
             self.net.addTask(flow["dst"], _recv_function,
                              start=receiver_start_time, kwargs=receiver_kwargs)
 
+    def _schedule_agents(self):
+        """Adds one traffic agent per host, started with its first flow"""
+        for host, flows in self._agent_flows.items():
+            agent_start_time = min(flow["start"] for flow in flows["senders"] + flows["receivers"])
+            self.net.addTask(host, run_traffic_agent,
+                             start=agent_start_time, kwargs=flows)
+
     def start(self, reference_time):
         """Starts and schedules the link events"""
         # Sets t=0 in the simulation
@@ -462,6 +483,7 @@ class TrafficManager(object):
         # Adds flow events to the scheduler
         self._schedule_flows(self._additional_traffic)
         self._schedule_flows(self._base_traffic)
+        self._schedule_agents()
 
 
 # HELPERS
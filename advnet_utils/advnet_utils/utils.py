@@ -1,5 +1,6 @@
 import subprocess
 import math
+import numpy as np
 import pandas as pd
 import sys
 import os
@@ -148,6 +149,33 @@ def setRateToInt(size):
         traceback.print_exc()
         return 0
 
+# Flow logs
+###########
+
+# The binary flow logs written by traffic.py start with the magic line and a line with the
+# names of the two fields, then fixed-width records of a sequence number and a timestamp.
+FLOW_LOG_MAGIC = b'ADVNET-FLOW-LOG-1\n'
+FLOW_LOG_RECORD = '<Qd'
+
+def read_flow_log(log_file):
+    """Load a flow log into a DataFrame.
+
+    Args:
+        log_file (str): Name of the log file, either a binary log or a .csv file
+
+    Returns:
+        pandas.DataFrame: seq_num and timestamp columns
+    """
+    with open(log_file, 'rb') as f:
+        if f.read(len(FLOW_LOG_MAGIC)) != FLOW_LOG_MAGIC:
+            return pd.read_csv(log_file)
+        fields = f.readline().decode().strip().split(',')
+        data = f.read()
+
+    dtype = np.dtype([(fields[0], '<u8'), (fields[1], '<f8')])
+    # Ignore a record cut short by a killed writer.
+    return pd.DataFrame(np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize))
+
 # Flow performance utils
 ########################
 
@@ -161,9 +189,9 @@ def udp_perf(sender_csv, receiver_csv):
     Returns:
         tuple: PRR (Packet Reception Ratio) and average delay
     """
-    # Open sender and receive .csv files
-    sender_df = pd.read_csv(sender_csv)
-    receiver_df = pd.read_csv(receiver_csv)
+    # Open sender and receive logs
+    sender_df = read_flow_log(sender_csv)
+    receiver_df = read_flow_log(receiver_csv)
 
     # Remove duplicated sequence numbers
     receiver_df.drop_duplicates(subset='seq_num', keep='first', inplace=True)
@@ -405,7 +433,7 @@ def waypoint_perf(outputdir):
                                                             flow["dport"], 
                                                             flow["protocol"])
         try:
-            receiver_df = pd.read_csv(receiver_file)
+            receiver_df = read_flow_log(receiver_file)
         except FileNotFoundError:
             return flow_wp_performances  # Nothing to return
         receiver_df.drop_duplicates(
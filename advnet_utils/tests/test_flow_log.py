@@ -0,0 +1,55 @@
+"""
+    Regression tests of the binary flow logs of traffic.py.
+
+    Usage:
+        python -m pytest advnet_utils/tests
+"""
+import pytest
+
+# advnet_utils.utils imports the p4utils, scapy and ipdb of the VM.
+for module in ["numpy", "pandas", "ipdb", "p4utils", "scapy"]:
+    pytest.importorskip(module)
+
+from advnet_utils.traffic import FlowLog, FLOW_LOG_BUFFER
+from advnet_utils.utils import read_flow_log
+
+
+def test_flow_log_round_trip(tmp_path):
+    out_file = str(tmp_path / "send.csv")
+    # More records than the buffer, so some are written by write and the rest by close.
+    records = [ (seq_num, 1600000000 + seq_num * 1e-6) for seq_num in range(1, 2 * FLOW_LOG_BUFFER + 10) ]
+
+    log = FlowLog(out_file, ["seq_num", "t_timestamp"])
+    for seq_num, timestamp in records:
+        log.write(seq_num, timestamp)
+    log.close()
+
+    df = read_flow_log(out_file)
+    assert list(df.columns) == ["seq_num", "t_timestamp"]
+    assert list(df["seq_num"]) == [ seq_num for seq_num, _ in records ]
+    assert list(df["t_timestamp"]) == [ timestamp for _, timestamp in records ]
+
+
+def test_flow_log_ignores_cut_record(tmp_path):
+    out_file = str(tmp_path / "recv.csv")
+    log = FlowLog(out_file, ["seq_num", "r_timestamp"])
+    log.write(1, 1.5)
+    log.write(2, 2.5)
+    log.close()
+
+    # A writer killed in the middle of a record.
+    with open(out_file, "ab") as f:
+        f.write(b"\x03\x00\x00")
+
+    df = read_flow_log(out_file)
+    assert list(df["seq_num"]) == [1, 2]
+    assert list(df["r_timestamp"]) == [1.5, 2.5]
+
+
+def test_read_flow_log_csv(tmp_path):
+    out_file = tmp_path / "recv.csv"
+    out_file.write_text("seq_num,r_timestamp\n1,1.5\n2,2.5\n")
+
+    df = read_flow_log(str(out_file))
+    assert list(df["seq_num"]) == [1, 2]
+    assert list(df["r_timestamp"]) == [1.5, 2.5]
@@ -0,0 +1,71 @@
+"""
+    Regression tests of the pacing of the UDP senders of traffic.py.
+
+    Usage:
+        python -m pytest advnet_utils/tests
+"""
+import json
+import time
+
+import pytest
+
+# advnet_utils.utils imports the p4utils, scapy and ipdb of the VM.
+for module in ["numpy", "pandas", "ipdb", "p4utils", "scapy"]:
+    pytest.importorskip(module)
+
+from advnet_utils.traffic import _wait_until, send_udp_flow, PacingStats, PACING_SPIN_NS, ETHERNET_HEADER, IPV4_HEADER, UDP_HEADER
+from advnet_utils.utils import read_flow_log
+
+
+@pytest.mark.parametrize("spin_ns", [0, PACING_SPIN_NS])
+def test_wait_until_never_returns_early(spin_ns):
+    for delay_ns in [0, 50000, 500000, 5000000]:
+        deadline_ns = time.perf_counter_ns() + delay_ns
+        _wait_until(deadline_ns, spin_ns)
+        assert time.perf_counter_ns() >= deadline_ns
+
+
+def test_wait_until_spins_to_the_deadline():
+    # The sleep wakes up before the deadline and the spin takes the rest, so the lateness is the one of a
+    # busy loop, far below the timer slack of a sleep. The median is robust to a preempted wait.
+    lateness = []
+    for _ in range(50):
+        deadline_ns = time.perf_counter_ns() + 1000000
+        _wait_until(deadline_ns, 2 * PACING_SPIN_NS)
+        lateness.append(time.perf_counter_ns() - deadline_ns)
+
+    assert sorted(lateness)[len(lateness) // 2] < 50000
+
+
+def test_pacing_stats_summary(tmp_path):
+    out_csv = str(tmp_path / "send.csv")
+    stats = PacingStats()
+    for late in [1000, 3000, 2000, 2000]:
+        stats.wakeup(late)
+    summary = stats.save(out_csv, rate=1e6, sent_bytes=0, packets=4)
+
+    with open(str(tmp_path / "send-pacing.json")) as f:
+        assert json.load(f) == summary
+
+    assert summary["wakeups"] == 4
+    assert summary["lateness_mean_us"] == pytest.approx(2)
+    assert summary["jitter_us"] == pytest.approx(0.5 ** 0.5)
+    assert summary["lateness_max_us"] == pytest.approx(3)
+
+
+def test_send_udp_flow_pacing_summary(tmp_path):
+    out_csv = str(tmp_path / "send.csv")
+    # 1000 B on the wire per packet at 1 MB/s, so the flow sends a packet every 1ms.
+    payload_size = 1000 - ETHERNET_HEADER - IPV4_HEADER - UDP_HEADER
+    summary = send_udp_flow(dst="127.0.0.1", sport=5700, dport=5701, rate="8 Mbps", duration=0.5,
+                            payload_size=payload_size, max_burst_size=1, out_csv=out_csv)
+
+    with open(str(tmp_path / "send-pacing.json")) as f:
+        assert json.load(f) == summary
+
+    # Every packet is logged and the rate holds within a few packets.
+    assert summary["packets"] == len(read_flow_log(out_csv))
+    assert summary["packets"] == pytest.approx(500, abs=5)
+    assert summary["achieved_rate"] == pytest.approx(1e6, rel=0.05)
+    assert summary["wakeups"] == summary["packets"]
+    assert 0 <= summary["lateness_mean_us"] <= summary["lateness_max_us"]
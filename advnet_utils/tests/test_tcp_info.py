@@ -0,0 +1,88 @@
+"""
+    Regression tests of the sampled TCP_INFO of send_tcp_flow.
+
+    Usage:
+        python -m pytest advnet_utils/tests
+"""
+import socket
+import threading
+
+import pytest
+
+# advnet_utils.utils imports the p4utils, scapy and ipdb of the VM.
+for module in ["numpy", "pandas", "ipdb", "p4utils", "scapy"]:
+    pytest.importorskip(module)
+
+from advnet_utils.traffic import TcpInfoSampler, get_tcp_info, send_tcp_flow
+from advnet_utils.utils import tcp_perf
+
+
+@pytest.fixture
+def tcp_pair():
+    """A connected client socket and its accepted server socket."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    yield client, server
+    client.close()
+    server.close()
+
+
+def test_sampler_reads_the_fields_of_get_tcp_info(tcp_pair):
+    client, server = tcp_pair
+    client.sendall(b"x" * 1000)
+    server.recv(1000)
+
+    sampler = TcpInfoSampler(client)
+    assert sampler.sample() == get_tcp_info(client)["tcpi_rtt"]
+    # No segments went out since the sample
+    assert sampler.read() is None
+
+
+def test_sampler_counts_sends(tcp_pair):
+    client, server = tcp_pair
+    sampler = TcpInfoSampler(client, every=3, interval_ms=0)
+
+    sampled = []
+    for _ in range(7):
+        client.sendall(b"x")
+        server.recv(1)
+        sampled.append(sampler.sample() is not None)
+
+    # The first send and then every 3 sends
+    assert sampled == [True, False, False, True, False, False, True]
+
+
+def test_send_tcp_flow_log_is_read_by_tcp_perf(tmp_path):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 5731))
+    listener.listen()
+
+    def receive():
+        conn, _ = listener.accept()
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    out_csv = str(tmp_path / "send.csv")
+    try:
+        send_tcp_flow(sport=5730, dport=5731, send_size="20MB", duration=5, out_csv=out_csv)
+    finally:
+        receiver.join()
+        listener.close()
+
+    fcr, avg_rtt, fct = tcp_perf(out_csv)
+    assert fcr == 1
+    assert avg_rtt is not None and avg_rtt > 0
+    assert 0 < fct < 5
+
+    # At most a sample per ms, plus the first and the last send, besides the size, elapsed and unsent rows.
+    with open(out_csv) as f:
+        rows = f.read().splitlines()[1:]
+    assert 3 < len(rows) <= fct * 1e3 + 5
@@ -0,0 +1,86 @@
+"""
+    Regression tests of the flows of traffic_agent.py.
+
+    Usage:
+        python -m pytest advnet_utils/tests
+"""
+import asyncio
+import csv
+import json
+import socket
+import time
+
+import pytest
+
+# advnet_utils.utils imports the p4utils, scapy and ipdb of the VM.
+for module in ["numpy", "pandas", "ipdb", "p4utils", "scapy"]:
+    pytest.importorskip(module)
+
+from advnet_utils.traffic import ETHERNET_HEADER, IPV4_HEADER, UDP_HEADER
+from advnet_utils.traffic_agent import run_traffic_agent, tcp_sender
+from advnet_utils.utils import read_flow_log
+
+
+def test_agent_udp_flow_is_paced_and_received(tmp_path):
+    # 1000 B on the wire per packet at 1 MB/s, so the flow sends a packet every 1ms.
+    payload_size = 1000 - ETHERNET_HEADER - IPV4_HEADER - UDP_HEADER
+    start = time.time() + 0.1
+    sender = {"sport": 5710, "dport": 5711, "rate": "8 Mbps", "duration": 0.5,
+              "payload_size": payload_size, "out_csv": str(tmp_path / "send.csv")}
+    receiver = {"sport": 5710, "dport": 5711, "duration": 1, "out_csv": str(tmp_path / "recv.csv")}
+    run_traffic_agent(senders=[{"protocol": "udp", "start": start, "kwargs": sender}],
+                      receivers=[{"protocol": "udp", "start": start - 0.05, "kwargs": receiver}])
+
+    sent = read_flow_log(sender["out_csv"])
+    received = read_flow_log(receiver["out_csv"])
+    assert len(sent) == pytest.approx(500, abs=5)
+    assert list(received["seq_num"]) == list(sent["seq_num"])
+
+    # The sends wait for their deadlines, late by the timers of the loop at most.
+    with open(str(tmp_path / "send-pacing.json")) as f:
+        summary = json.load(f)
+    assert summary["packets"] == len(sent)
+    assert 0 <= summary["lateness_mean_us"] <= 2000
+
+
+def test_agent_rejects_invalid_flows(tmp_path):
+    with pytest.raises(AssertionError):
+        asyncio.run(tcp_sender(dport=2**16, send_size=1000, out_csv=str(tmp_path / "send.csv")))
+
+
+def test_tcp_sender_logs_unsent_bytes_on_reset(tmp_path):
+    # A receiver that closes the connection with unread data, so the sender gets a reset.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 5721))
+    listener.listen()
+
+    async def reset_receiver():
+        loop = asyncio.get_running_loop()
+        listener.setblocking(False)
+        conn, _ = await loop.sock_accept(listener)
+        await loop.sock_recv(conn, 1)
+        conn.close()
+
+    out_csv = str(tmp_path / "send.csv")
+
+    async def run():
+        receiver = asyncio.ensure_future(reset_receiver())
+        try:
+            await tcp_sender(sport=5720, dport=5721, send_size=10**9, duration=5, out_csv=out_csv)
+        finally:
+            await receiver
+
+    try:
+        with pytest.raises(OSError):
+            asyncio.run(run())
+    finally:
+        listener.close()
+
+    # The log is closed with the elapsed time and the unsent bytes, like on a timeout. The elapsed
+    # time is the only float of the log, the total bytes and RTTs are integers.
+    with open(out_csv) as f:
+        rows = [ row["rtt"] for row in csv.DictReader(f) ]
+    assert int(rows[0]) == 10**9
+    assert "." in rows[-2] and 0 < float(rows[-2]) < 5
+    assert 0 < int(rows[-1]) < 10**9
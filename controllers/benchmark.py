@@ -0,0 +1,137 @@
+"""
+    The reconvergence benchmark of the controller.
+
+    For each scenario in inputs/, the controller programs fake switches (see fake_switch.py) and then the link
+    events of the .failure file are replayed in order. For the startup and each event we report the wall time,
+    the RPCs sent to the switches, the paths evaluated and the best paths changed in the published routing state.
+
+    Usage:
+        python controllers/benchmark.py [--scenarios 00_baseline 01_turing] [--latency 0.001] [--out bench.json]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+from advnet_utils.input_parsers import parse_additional_links, parse_link_failures
+
+from controller import Controller, city_maps
+from fake_switch import FakeTopology, build_topology, fake_switch_api
+
+cur_dir = os.path.dirname(os.path.abspath(__file__)) + "/"
+
+
+def get_link_events(failures_file: str, added_links: list):
+    """
+        Get the up/down events of the failures sorted by time, see LinksManager in advnet_utils.
+
+        The ADDED_<n> links are replaced by the n-th additional link, the invalid ones are skipped.
+    """
+    events = []
+    for link, fail_time, duration in parse_link_failures(failures_file):
+        if link[0].startswith("ADDED"):
+            index = int(link[0].split("_")[-1]) - 1
+            if index < 0 or index >= len(added_links):
+                logging.warning(f"Skip the failure of the invalid added link {link[0]}")
+                continue
+            link = added_links[index]
+
+        events.append(("down", link, fail_time))
+        events.append(("up", link, fail_time + duration))
+
+    return sorted(events, key=lambda x: x[2])
+
+
+def count_rpcs(controller: Controller):
+    return sum(sum(sw.controller.connect().rpcs.values()) for sw in controller.switches)
+
+
+def count_changed_paths(old, new):
+    """
+        Count the pairs of cities whose best path differs between two routing snapshots, see Controller.publish.
+    """
+    return sum(p1 != p2 for bp1, bp2 in zip(old.best_paths, new.best_paths) for p1, p2 in zip(bp1, bp2))
+
+
+def run_scenario(inputs_dir: str, scenario: str, latency: float):
+    """
+        Run the scenario and return the measurements.
+    """
+    prefix = f"{inputs_dir}/{scenario}"
+    added_links = [ link for link, _ in parse_additional_links(prefix + ".links") ]
+    topo = FakeTopology(graph=build_topology(links_file=prefix + ".links"))
+
+    start = time.time()
+    controller = Controller(prefix + ".traffic-base", prefix + ".slas", topo, fake_switch_api(latency))
+    report = {
+        "scenario" : scenario,
+        "init" : { "wall" : time.time() - start, "rpcs" : count_rpcs(controller), "paths_evaluated" : controller.paths_evaluated },
+        "events" : []
+    }
+
+    for action, (src, dst), event_time in get_link_events(prefix + ".failure", added_links):
+        sw1 = controller.switches[city_maps[src]]
+        sw2 = controller.switches[city_maps[dst]]
+        port = sw2.sw_links[sw1.city]['port']
+
+        rpcs = count_rpcs(controller)
+        paths_evaluated = controller.paths_evaluated
+        snapshot = controller.snapshot
+        start = time.time()
+        if action == "down":
+            controller.has_failure(sw2, [port])
+        else:
+            controller.no_failure(sw2, [port])
+        # The routing worker isn't started, handle the event right here.
+        controller.router.handle_pending()
+
+        report["events"].append({
+            "time" : event_time,
+            "event" : action,
+            "link" : [src, dst],
+            "wall" : time.time() - start,
+            "rpcs" : count_rpcs(controller) - rpcs,
+            "paths_evaluated" : controller.paths_evaluated - paths_evaluated,
+            "paths_changed" : count_changed_paths(snapshot, controller.snapshot),
+            "version" : controller.snapshot.version
+        })
+
+    controller.executor.shutdown()
+    return report
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputs', help='Path to the inputs',
+                        type=str, required=False, default=cur_dir + '../inputs')
+    parser.add_argument('--scenarios', help='The scenarios to run, all by default',
+                        type=str, nargs='*', default=None)
+    parser.add_argument('--latency', help='The latency of each RPC to the fake switches in seconds',
+                        type=float, required=False, default=0.001)
+    parser.add_argument('--out', help='Path to the json report, stdout by default',
+                        type=str, required=False, default='')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    # The controller logs every table operation.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scenarios = args.scenarios
+    if not scenarios:
+        scenarios = sorted(os.path.basename(f)[:-len(".failure")] for f in glob.glob(f"{args.inputs}/*.failure"))
+
+    reports = [ run_scenario(args.inputs, scenario, args.latency) for scenario in scenarios ]
+    for r in reports:
+        walls = [ e["wall"] for e in r["events"] ]
+        print(f"{r['scenario']}: init {r['init']['wall']:.3f}s, {len(walls)} events, max {max(walls, default=0):.3f}s", file=sys.stderr)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(reports, f, indent=2)
+    else:
+        print(json.dumps(reports, indent=2))
@@ -13,14 +13,20 @@ import binascii
 import struct
 import time
 import socket
+import select
+import ctypes
 import nnpy
-from scapy.all import *
-from scapy.layers.l2 import Ether
-from scapy.layers.inet import IP, TCP, UDP
 from datetime import datetime
 from thrift.Thrift import TApplicationException
 from thrift.transport.TTransport import TTransportException
 import copy
+import json
+import bisect
+import heapq
+import ipaddress
+import queue
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import psutil
 
 # TODO: remove logging to speedup
@@ -33,6 +39,57 @@ logging.basicConfig(format="[%(levelname)s] %(message)s", level=logging.DEBUG)
 #   sw1 -> switch1
 #   sw2 -> switch2
 
+# The maximum depth of the MPLS stack, must match CONST_MAX_HOPS in headers.p4
+CONST_MAX_HOPS = 9
+# How many shortest paths we keep for each pair of cities.
+K_SHORTEST_PATHS = 10
+# The number of ports checked by the switches, must match N_PORTS in switch.p4
+N_PORTS = 16
+# The traffic engineering of the base traffic keeps the shortest paths below this link utilization and
+# it may spend this many seconds to lower the maximum utilization, see solve_te.
+TE_MAX_UTIL = 0.8
+TE_TIME_BUDGET = 0.5
+# How many seconds before a base flow starts we reserve its path, see DemandScheduler.
+DEMAND_LEAD_TIME = 1.0
+# The pairs of cities with at least ECMP_MIN_FLOWS base flows split them over up to ECMP_MAX_PATHS paths
+# by the hash of the 5-tuple, each group has ECMP_BUCKETS buckets. See ecmp_group in switch.p4.
+ECMP_MIN_FLOWS = 2
+ECMP_MAX_PATHS = 3
+ECMP_BUCKETS = 16
+# A multipath group is only split again if the worst path gets this many bps more, see rebalance_by_capacity.
+ECMP_REBALANCE_MARGIN = 1e6
+# A pinned flow only moves to a path whose bottleneck has this many bps more capacity, see pin_elephants.
+ELEPHANT_MARGIN = 1e6
+# The flows a switch can pin, each has its own cell of pin_meter. See flow_tbl in switch.p4.
+FLOW_PINS = 1024
+# The IP protocol numbers of the flows.
+IP_PROTOCOLS = { "tcp" : 6, "udp" : 17 }
+# The timeout of a Thrift call in seconds and how many times a failed call is retried, see SwitchConnection.
+THRIFT_TIMEOUT = 2.0
+THRIFT_RETRIES = 2
+# The upper bounds of the buckets of the RPC latency histograms in seconds, see Switch.rpc.
+RPC_LATENCY_BUCKETS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, float("inf")]
+
+
+# The C structures to send many frames with a single sendmmsg, see sendmmsg(2) and linux/if_packet.h
+class SockaddrLL(ctypes.Structure):
+    _fields_ = [("sll_family", ctypes.c_ushort), ("sll_protocol", ctypes.c_ushort), ("sll_ifindex", ctypes.c_int),
+                ("sll_hatype", ctypes.c_ushort), ("sll_pkttype", ctypes.c_ubyte), ("sll_halen", ctypes.c_ubyte),
+                ("sll_addr", ctypes.c_ubyte * 8)]
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint), ("msg_iov", ctypes.POINTER(IOVec)),
+                ("msg_iovlen", ctypes.c_size_t), ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
 
 # This class assign a numberic index to each city. Since it is derived fron IntEnum, each enum can be used like
 # a python int. Also, a python int can be used to construct a City class.
@@ -66,9 +123,8 @@ class City(IntEnum):
     REN = 15
 
     def __str__(self):
-        s = super().__str__()
-
-        return s.split(".")[1]
+        # IntEnum.__str__ is the value since Python 3.11.
+        return self.name
 
 # This map a city string to a City enum.
 city_maps = {
@@ -90,6 +146,112 @@ city_maps = {
     "REN" : City.REN,
 }
 
+def set_thrift_timeout(api, timeout: float):
+    """
+        Set the timeout of the socket under the Thrift API, p4utils doesn't expose it.
+
+        All clients of the API share the socket, see thrift_connect in p4utils.
+    """
+    trans = getattr(getattr(getattr(api, "client", None), "_iprot", None), "trans", None)
+    if trans is None:
+        # Not a Thrift API, like the fake switches.
+        logging.debug(f"{type(api).__name__} has no Thrift transport, no timeout to set")
+        return
+
+    # The TBufferedTransport wraps the TSocket.
+    sock = getattr(trans, "_TBufferedTransport__trans", trans)
+    if hasattr(sock, "setTimeout"):
+        sock.setTimeout(timeout * 1000)
+    else:
+        logging.warning(f"Can't find the socket under {type(trans).__name__}, the Thrift calls have no timeout")
+
+
+# A Thrift connection to a switch, the controller opens one for programming and one for monitoring.
+# The calls are serialized on the connection and a failed call is retried on a new connection. After `max_failures`
+# failures in a row the connection is unhealthy and the calls fail at once until `cooldown` passed, so a dead
+# switch doesn't block the caller.
+class SwitchConnection:
+
+    # The calls we don't retry, a retry after a lost reply would add a duplicate entry.
+    NO_RETRY = ("table_add",)
+
+    def __init__(self, switch_api: callable, thrift_port: int, role: str, timeout=THRIFT_TIMEOUT, retries=THRIFT_RETRIES, max_failures=3, cooldown=1.0):
+        self.switch_api = switch_api
+        self.thrift_port = thrift_port
+        self.role = role
+        self.timeout = timeout
+        self.retries = retries
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.api = None
+        # A Thrift client is not thread safe.
+        self.lock = threading.RLock()
+        # The failures in a row, all failures and the retries.
+        self.failures = 0
+        self.errors = 0
+        self.retried = 0
+        self.down_until = 0
+
+    def connect(self):
+        """
+            Return the Thrift API, connect if we are not connected.
+        """
+        with self.lock:
+            if self.api is None:
+                self.api = self.switch_api(self.thrift_port)
+                set_thrift_timeout(self.api, self.timeout)
+            return self.api
+
+    @property
+    def healthy(self):
+        return self.failures < self.max_failures
+
+    def call(self, name: str, args: tuple):
+        """
+            Call the method `name` of the Thrift API, like "table_add" or "client.bm_learning_ack_buffer".
+        """
+        with self.lock:
+            if not self.healthy and time.monotonic() < self.down_until:
+                raise TTransportException(TTransportException.NOT_OPEN, f"The {self.role} connection to {self.thrift_port} is unhealthy")
+
+            attempt = 0
+            while True:
+                try:
+                    fn = self.connect()
+                    for attr in name.split("."):
+                        fn = getattr(fn, attr)
+                    r = fn(*args)
+                    self.failures = 0
+                    return r
+                except (TTransportException, socket.timeout) as e:
+                    self.errors += 1
+                    self.failures += 1
+                    # The connection may be broken, use a new one.
+                    self.api = None
+                    if attempt >= self.retries or not self.healthy or name in self.NO_RETRY:
+                        self.down_until = time.monotonic() + self.cooldown
+                        raise
+
+                    logging.warning(f"[{self.thrift_port}] {self.role} call {name} failed: {e}, retry")
+                    time.sleep(0.05 * (2 ** attempt))
+                    attempt += 1
+                    self.retried += 1
+
+    def health(self):
+        return { "healthy" : self.healthy, "errors" : self.errors, "retried" : self.retried }
+
+    def __getattr__(self, name: str):
+        # Called for the methods of the Thrift API only, they all go through call. We don't connect here, so the
+        # retries and the health checks apply to the first call too. Read the other attributes from connect().
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def rpc(*args):
+            return self.call(name, args)
+        rpc.__name__ = name
+        return rpc
+
+
 # Represent a P4Swtich
 class Switch:
 
@@ -105,13 +267,23 @@ class Switch:
         self.sw_ports = {} # type: dict[int, Switch]
         # The host connected to this switch
         self.host = Host(self)
-        # The controller API
-        self.controller = None # type: SimpleSwitchThriftAPI
+        # The connection for programming the switch
+        self.controller = None # type: SwitchConnection
+        # The connection for the monitors, so they never wait for the programming calls.
+        self.monitor = None # type: SwitchConnection
         # The path to other hosts.
         self.hosts_path = [ ( (), 0xFFFF ) for _ in range(16) ]
-        # The links that are failed on this switch.
-        self.failed_link = []
-        self.in_reroute_table = {}
+        # The table operations queued by each thread, see begin_batch.
+        self._batch = threading.local()
+        # The shadow model of the installed entries, see set_entry.
+        #   table name -> { (match keys, prio) : [action name, action params, handle] }
+        # Note the handle is None until the entry is installed.
+        self.tables = {} # type: dict[str, dict[tuple, list]]
+        # The RPCs we issued and the RPCs we skipped thanks to the shadow tables.
+        self.rpc_calls = 0
+        # The RPCs in each bucket of RPC_LATENCY_BUCKETS.
+        self.rpc_latency = [0 for _ in RPC_LATENCY_BUCKETS]
+        self.rpc_saved = 0
 
     def get_link_to(self, city: City):
         """
@@ -122,11 +294,86 @@ class Switch:
         next_sw = self.sw_links[city]['sw']
         return self.sw_links[city]['port'], self.sw_links[city]['mac'], next_sw.sw_links[self.city]['port'], next_sw.sw_links[self.city]['mac']
 
-    def table_add(self, table_name: str, action_name: str, match_keys: list, action_params: list, prio=0):
+    def begin_batch(self):
+        """
+            Queue the following table operations of the current thread instead of running them.
+
+            The queued operations are taken with take_batch and run with run_batch.
+        """
+        self._batch.ops = []
+
+    def take_batch(self):
+        """
+            Take the table operations queued by the current thread and stop batching.
+        """
+        ops = getattr(self._batch, "ops", None)
+        self._batch.ops = None
+        return ops if ops is not None else []
+
+    def run_batch(self, ops: list):
+        """
+            Run the queued table operations in order. The callback of an operation gets its return value.
+        """
+        for fn, args, callback in ops:
+            try:
+                r = self.rpc(fn, args)
+                if callback is not None:
+                    callback(r)
+            except Exception:
+                logging.exception(f"[{str(self)}] Fail to run {getattr(fn, '__name__', fn)} {args}")
+
+    def call(self, fn: callable, args: tuple, callback: callable = None):
+        """
+            Run a Thrift call, or queue it if the current thread is batching.
+
+            Return the result of the call, or None if it is queued.
+        """
+        ops = getattr(self._batch, "ops", None)
+        if ops is not None:
+            ops.append((fn, args, callback))
+            return None
+
+        r = self.rpc(fn, args)
+        if callback is not None:
+            callback(r)
+        return r
+
+    def rpc(self, fn: callable, args: tuple):
+        """
+            Run a Thrift call and count its latency in `rpc_latency`.
+        """
+        self.rpc_calls += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.rpc_latency[bisect.bisect_left(RPC_LATENCY_BUCKETS, time.perf_counter() - start)] += 1
+
+    def rpc_histogram(self):
+        """
+            The RPC latency histogram by the upper bound of each bucket in ms.
+        """
+        return { ("inf" if b == float("inf") else f"{b * 1000:g}ms") : n for b, n in zip(RPC_LATENCY_BUCKETS, self.rpc_latency) }
+
+    def table_add(self, table_name: str, action_name: str, match_keys: list, action_params: list, prio=0, callback: callable = None):
         """
             The wrapper for table_add command.
         """
-        r = self.controller.table_add(table_name, action_name, match_keys, action_params, prio)
+        key = (tuple(match_keys), prio)
+        entry = [action_name, tuple(action_params), None]
+        self.tables.setdefault(table_name, {})[key] = entry
+
+        def _installed(hdl):
+            if hdl is None:
+                # Failed, forget about it.
+                if self.tables[table_name].get(key) is entry:
+                    del self.tables[table_name][key]
+            else:
+                entry[2] = hdl
+            if callback is not None:
+                callback(hdl)
+
+        r = self.call(self.controller.table_add, (table_name, action_name, match_keys, action_params, prio), _installed)
         #logging.debug(f"[{str(self)}] table_add {table_name} {action_name} {match_keys} {action_params} {prio} ret={r}")
         
         if r is None:
@@ -134,34 +381,106 @@ class Switch:
             #logging.warning(f"[{str(self)}] table_add ret is None!")
         return r
 
-    def table_modify(self, table_name: str, hdl: int, action_name: str, action_params: list):
+    def table_modify(self, table_name: str, hdl: int, action_name: str, action_params: list, callback: callable = None):
         """
             The wrapper for table_modify command.
         """
-        r = self.controller.table_modify(table_name, action_name, hdl, action_params)
+        for entry in self.tables.get(table_name, {}).values():
+            if entry[2] == hdl:
+                entry[0], entry[1] = action_name, tuple(action_params)
+
+        r = self.call(self.controller.table_modify, (table_name, action_name, hdl, action_params), callback)
         #logging.debug(f"[{str(self)}] table_modify {table_name} {action_name} {action_params} hdl={hdl} ret={r}")
         return r
 
-    def dst_table_add(self, dst: City, table_name: str, action_name: str, match_keys: list, action_params: list, best_path: list):
+    def _modify_entry(self, table_name: str, entry: list):
+        # The handle of a queued entry is only known when we run.
+        return self.controller.table_modify(table_name, entry[0], entry[2], list(entry[1]))
+
+    def _delete_entry(self, table_name: str, entry: list):
+        return self.controller.table_delete(table_name, entry[2])
+
+    def set_entry(self, table_name: str, match_keys: list, action_name: str, action_params: list, prio=0, callback: callable = None):
+        """
+            Make the entry matching `match_keys` run the action, with as few RPCs as the shadow tables allow.
+
+            Nothing is sent if the installed entry is the same, the entry is modified if only the action differs,
+            else it is added. `callback` gets the handle once a new entry is installed.
+
+            Return True if an RPC is needed.
+        """
+        entry = self.tables.get(table_name, {}).get((tuple(match_keys), prio))
+
+        if entry is None:
+            self.table_add(table_name, action_name, match_keys, action_params, prio, callback)
+        elif entry[0] != action_name or entry[1] != tuple(action_params):
+            entry[0], entry[1] = action_name, tuple(action_params)
+            self.call(self._modify_entry, (table_name, entry))
+        else:
+            self.rpc_saved += 1
+            return False
+
+        return True
+
+    def delete_entry(self, table_name: str, match_keys: list, prio=0):
+        """
+            Delete the entry matching `match_keys` if it is installed.
+
+            Return True if an RPC is needed.
+        """
+        entry = self.tables.get(table_name, {}).pop((tuple(match_keys), prio), None)
+        if entry is None:
+            return False
+
+        self.call(self._delete_entry, (table_name, entry))
+        return True
+
+    def sync_table(self, table_name: str, desired: dict):
+        """
+            Make the table hold exactly the `desired` entries.
+
+            `desired` maps (match keys, prio) to (action name, action params) and only the minimal set of
+            add/modify/delete operations is sent. Return the number of RPCs needed.
+        """
+        n = 0
+        for (match_keys, prio), (action_name, action_params) in desired.items():
+            n += self.set_entry(table_name, list(match_keys), action_name, list(action_params), prio)
+
+        for (match_keys, prio) in list(self.tables.get(table_name, {}).keys()):
+            if (match_keys, prio) not in desired:
+                n += self.delete_entry(table_name, list(match_keys), prio)
+
+        return n
+
+    def table_set_default(self, table_name: str, action_name: str, action_params: list = None):
+        """
+            The wrapper for table_set_default command.
+        """
+        return self.call(self.controller.table_set_default, (table_name, action_name, [] if action_params is None else action_params))
+
+    def dst_table_add(self, dst: City, table_name: str, action_name: str, match_keys: list, action_params: list, best_path: list, callback: callable = None):
         """
             Add a new table entry for routing to the destination City.
 
             This function is mostly used for reroute. If the `best_path` is already the path to the destination City, 
             nothing happens. Else, we do a table_modify.
+
+            Note the handle is stored in `hosts_path` once the entry is installed, `callback` gets it too.
         """
         last_path, last_hdl = self.hosts_path[dst]
-        if last_hdl == 0xFFFF:
-            hdl = self.table_add(table_name, action_name, match_keys, action_params)
+
+        def _installed(hdl):
             if hdl is not None:
                 self.hosts_path[dst] = (best_path, hdl)
-            return hdl
-        else:
-            if best_path != last_path:
-                hdl = self.table_modify(table_name, last_hdl, action_name, action_params)
-                self.hosts_path[dst] = (best_path, hdl)
-                logging.debug(f"[{str(self)}] -> [{str(dst)}] Path Change (hdl={hdl} last_hdl={last_hdl}):\n{last_path}\n{best_path}")
-                return hdl
-            return last_hdl
+            if callback is not None:
+                callback(hdl)
+
+        if self.set_entry(table_name, match_keys, action_name, action_params, callback=_installed) and last_hdl != 0xFFFF:
+            # A modified entry keeps its handle.
+            self.hosts_path[dst] = (best_path, last_hdl)
+            logging.debug(f"[{str(self)}] -> [{str(dst)}] Path Change (hdl={last_hdl}):\n{last_path}\n{best_path}")
+
+        return self.hosts_path[dst][1]
 
     def get_meter_rates_from_bw(self, bw_committed, burst_size_committed, bw_peak, burst_size_peak):
         """
@@ -233,233 +552,543 @@ class Host:
     def __str__(self) -> str:
         return f"{str(self.city_sw)}_h0"
 
-# The threads to send heartbeat with a fixed interval.
-# The direction is sw1->sw2
-class Ping(threading.Thread):
-
-    def __init__(self, sw1: Switch, sw2: Switch, interval: float):
+def build_heartbeat(sw1: Switch, sw2: Switch):
+    """
+        Build the heartbeat frame of the link sw1 -> sw2.
+
+        From headers.p4:
+            header heart_t {
+                bit<9>    port;
+                bit<1>    from_cp;
+                bit<6>    padding;
+            }
+    """
+    s1_port, s1_mac, _, s2_mac = sw1.get_link_to(sw2.city)
+    bs = b""
+    bs += b"".join(map(binascii.unhexlify, s2_mac.split(":")))
+    bs += b"".join(map(binascii.unhexlify, s1_mac.split(":")))
+    bs += struct.pack(">H", 0x1926)
+    bs += struct.pack(">H", (s1_port << 7) | (1 << 6))
+
+    return bs
+
+
+# The heartbeat sender which sends the heartbeats of all links from a single thread.
+# The frames are built once, the heartbeats due in a tick are sent together by a timer wheel.
+class HeartbeatSender(threading.Thread):
+
+    # The errnos after which the interface doesn't exist any more.
+    GONE_ERRNOS = (19, 6)
+    # The errnos after which we try again later, 100: Link down, 105: Bandwith full
+    RETRY_ERRNOS = (100, 105)
+
+    def __init__(self, switches: list, interval: float, intervals=None, tick=0.05, wheel_size=64, use_sendmmsg=True):
+        """
+            Send a heartbeat on each link every `interval`, or `intervals[(c1, c2)]` for the link c1 -> c2.
+        """
         super().__init__()
-        self.sw1 = sw1
-        self.sw2 = sw2
-        self.interval = interval
+        self.tick = tick
+        if intervals is None:
+            intervals = {}
+        # The heartbeats as (sw1, sw2, interval), one per direction of each link.
+        self.links = []
+        for sw1 in switches:
+            for c2 in sw1.sw_links:
+                self.links.append((sw1, sw1.sw_links[c2]['sw'], intervals.get((sw1.city, c2), interval)))
+        self.frames = [ build_heartbeat(sw1, sw2) for sw1, sw2, _ in self.links ]
+        self.ifaces = [ sw1.sw_links[sw2.city]['interfaces'][0] for sw1, sw2, _ in self.links ]
+
+        # The timer wheel, each slot is the heartbeats to send in the tick, as (heartbeat, rounds left).
+        self.wheel = [ [] for _ in range(wheel_size) ]
+        self.cur = 0
+        for i in range(len(self.links)):
+            self.schedule(i, 0)
+
+        # The bound sockets by interface, and the socket for sendmmsg, see build_msgs.
+        self.socks = {}
+        self.sock = None
+        self.libc = None
+        if use_sendmmsg:
+            try:
+                self.libc = ctypes.CDLL(None, use_errno=True)
+                self.libc.sendmmsg
+            except (OSError, AttributeError):
+                logging.warning("sendmmsg is not available, send heartbeats one by one")
+                self.libc = None
 
-    def build_hearbeat(self):
+    def schedule(self, i: int, delay: float):
         """
-            Build a heartbeat frame.
-
-            From headers.p4:
-                header heart_t {
-                    bit<9>    port;
-                    bit<1>    from_cp;
-                    bit<6>    padding;
-                }
+            Schedule the heartbeat i after `delay` seconds, at least one tick later.
         """
-        s1_port, s1_mac, _, s2_mac = self.sw1.get_link_to(self.sw2.city)
-        bs = b""
-        bs += b"".join(map(binascii.unhexlify, s2_mac.split(":")))
-        bs += b"".join(map(binascii.unhexlify, s1_mac.split(":")))
-        bs += struct.pack(">H", 0x1926)
-        bs += struct.pack(">H", (s1_port << 7) | (1 << 6))
+        steps = max(1, round(delay / self.tick))
+        self.wheel[(self.cur + steps) % len(self.wheel)].append((i, (steps - 1) // len(self.wheel)))
 
-        return bs
+    def build_msgs(self):
+        """
+            Build the messages of all heartbeats for sendmmsg, each is sent to the interface in its address.
+        """
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        self.bufs = [ ctypes.create_string_buffer(bs, len(bs)) for bs in self.frames ]
+        self.iovs = [ IOVec(ctypes.addressof(buf), len(bs)) for buf, bs in zip(self.bufs, self.frames) ]
+        self.addrs = []
+        self.msgs = []
+        for iface, iov in zip(self.ifaces, self.iovs):
+            try:
+                ifindex = socket.if_nametoindex(iface)
+            except OSError:
+                ifindex = 0
+            addr = SockaddrLL(socket.AF_PACKET, 0, ifindex)
+            self.addrs.append(addr)
+            self.msgs.append(MMsgHdr(MsgHdr(ctypes.addressof(addr), ctypes.sizeof(addr), ctypes.pointer(iov), 1, None, 0, 0), 0))
+
+    def send_one(self, i: int):
+        """
+            Send the heartbeat i with the socket bound to its interface. Return False if the interface is gone.
+        """
+        iface = self.ifaces[i]
+        try:
+            if iface not in self.socks:
+                skt = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+                skt.bind((iface, 0))
+                self.socks[iface] = skt
+            self.socks[iface].send(self.frames[i])
+        except OSError as e:
+            # Open the socket again next time.
+            skt = self.socks.pop(iface, None)
+            if skt is not None:
+                skt.close()
+            if e.errno in self.GONE_ERRNOS:
+                return False
+            if e.errno not in self.RETRY_ERRNOS:
+                logging.exception(f"[{str(self.links[i][0])}] -> [{str(self.links[i][1])}] inf={iface}")
+        return True
 
+    def send_many(self, due: list):
+        """
+            Send the heartbeats with as few sendmmsg as possible. Return the heartbeats whose interface is gone.
+        """
+        gone = []
+        start = 0
+        while start < len(due):
+            msgs = (MMsgHdr * (len(due) - start))(*[ self.msgs[i] for i in due[start:] ])
+            n = self.libc.sendmmsg(self.sock.fileno(), msgs, len(msgs), 0)
+            if n < 0:
+                # The first message fails, skip it and send the rest.
+                err = ctypes.get_errno()
+                i = due[start]
+                if err in self.GONE_ERRNOS or self.addrs[i].sll_ifindex == 0:
+                    gone.append(i)
+                elif err not in self.RETRY_ERRNOS:
+                    logging.error(f"[{str(self.links[i][0])}] -> [{str(self.links[i][1])}] inf={self.ifaces[i]}: errno {err}")
+                n = 1
+            start += n
+        return gone
 
     def run(self):
-        inf1, inf2 = self.sw1.sw_links[self.sw2.city]['interfaces']
+        try:
+            if self.libc is not None:
+                self.build_msgs()
+            logging.debug(f"Send {len(self.links)} heartbeats every {self.tick}s tick")
 
-        while True:
-            skt = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
-            try:
-                skt.bind((inf1, 0))
-                bs = self.build_hearbeat()
-                logging.debug(f"[{str(self.sw1)}] -> [{str(self.sw2)}]: Sniffing {inf1}")
-                while True:
-                    try:
-                        skt.send(bs)
-                        time.sleep(self.interval)
-                    except OSError as e:
-                        if e.errno == 105:
-                            # Bandwith full, nothing more to do
-                            time.sleep(self.interval)
-                        else:
-                            # Re-raise the error
-                            raise e
-            except KeyboardInterrupt:
-                return
-            except OSError as e:
-                
-                # We are done, the device doesn't exist any more
-                if e.errno == 19 or e.errno == 6:
-                    return
+            next_tick = time.monotonic()
+            while True:
+                next_tick += self.tick
+                time.sleep(max(0, next_tick - time.monotonic()))
+
+                self.cur = (self.cur + 1) % len(self.wheel)
+                slot = self.wheel[self.cur]
+                self.wheel[self.cur] = []
+                due = []
+                for i, rounds in slot:
+                    if rounds > 0:
+                        self.wheel[self.cur].append((i, rounds - 1))
+                    else:
+                        due.append(i)
+
+                if self.libc is not None:
+                    gone = set(self.send_many(due))
                 else:
-                    # 100: Link down
-                    if e.errno != 100:
-                        logging.exception(f"[{str(self.sw1)}] -> [{str(self.sw2)}] inf1={inf1} inf2={inf2}")
-                    # Sleep and try again.
-                    time.sleep(self.interval)
-            except Exception:
-                logging.exception(f"[{str(self.sw1)}] -> [{str(self.sw2)}] inf1={inf1} inf2={inf2}")
-            finally:
+                    gone = set(i for i in due if not self.send_one(i))
+
+                # We are done with the links whose device doesn't exist any more.
+                for i in due:
+                    if i not in gone:
+                        self.schedule(i, self.links[i][2])
+        except KeyboardInterrupt:
+            return
+        except Exception:
+            logging.exception("Fail to send heartbeats")
+        finally:
+            for skt in self.socks.values():
                 skt.close()
-            
+            if self.sock is not None:
+                self.sock.close()
+
+
+# The link listener which reports link failures from the digests of all switches.
+# The switches check the heartbeats themselves, see CHECK_PORT in switch.p4, so we only wait for the changes.
+class LinkListener(threading.Thread):
 
-# The Pong monitor which report a link failure
-class Pong(threading.Thread):
+    # struct link_digest_t in headers.p4
+    LINK_DIGEST = struct.Struct("!H")
+    # The header of a learning notification of bmv2: topic, device id, context id, list id, buffer id, samples.
+    DIGEST_HDR = struct.Struct("<4sQiiQi")
 
-    def __init__(self, sw: Switch, threshold: float, failure_cb: callable, good_cb: callable):
+    def __init__(self, switches: list, threshold: float, failure_cb: callable, good_cb: callable):
         super().__init__()
-        self.sw = sw
+        self.switches = switches
+        self.threshold = threshold
         self.failure_cb = failure_cb
         self.good_cb = good_cb
-        self.threshold = threshold
-        self.latest_timestamp = 0
-        self.last_seen = [None for _ in range(16)]
 
-    def process_stamps(self, raw_stamps: list):
-        for port, stamp in enumerate(raw_stamps):
-            if port not in self.sw.sw_ports or stamp == 0:
-                continue
-            if stamp > self.latest_timestamp:
-                self.latest_timestamp = stamp
+    def subscribe(self, sw: Switch):
+        """
+            Start the link checks of the switch and subscribe to its notifications.
+        """
+        ports = 0
+        for p in sw.sw_ports:
+            if p >= N_PORTS:
+                raise ValueError(f"[{str(sw)}]: Port {p} is out of the {N_PORTS} ports checked by the switch")
+            ports |= 1 << p
+        sw.monitor.register_write("heartPorts", 0, ports)
+        sw.monitor.register_write("heartThreshold", 0, int(self.threshold * 1e6))
+
+        try:
+            # Send each digest at once instead of waiting for more.
+            sw.monitor.call("client.bm_learning_set_buffer_size", (0, 1, 1))
+        except Exception:
+            logging.warning(f"[{str(sw)}]: Fail to set the digest buffer size")
+
+        sub = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
+        sub.connect(sw.monitor.call("client.bm_mgmt_get_info", ()).notifications_socket)
+        sub.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, "")
+        return sub
+
+    def process_digest(self, sw: Switch, msg: bytes):
+        topic, _, ctx_id, list_id, buffer_id, num = self.DIGEST_HDR.unpack_from(msg)
+        if topic != b"LEA|":
+            return
 
-            self.last_seen[port] = stamp
+        # Only the last sample matters, it is the current failed ports.
+        failed, = self.LINK_DIGEST.unpack_from(msg, self.DIGEST_HDR.size + (num - 1) * self.LINK_DIGEST.size)
+        sw.monitor.call("client.bm_learning_ack_buffer", (ctx_id, list_id, buffer_id))
+
+        fports = [ p for p in sw.sw_ports if failed & (1 << p) ]
+        gports = [ p for p in sw.sw_ports if not failed & (1 << p) ]
+        logging.debug(f"[{str(sw)}]: Failed ports {fports}")
+
+        # Report the up and down ports.
+        if len(fports) != 0:
+            self.failure_cb(sw, fports)
+
+        if len(gports) != 0:
+            self.good_cb(sw, gports)
 
     def run(self):
+        subs = {}
         try:
-            while True:
-                try:
-                    time.sleep(self.threshold)
-                    # Read the register directly.
-                    register_stamps = self.sw.controller.register_read("linkStamp")
-                    self.process_stamps(register_stamps)
-                except OSError as e:
-
-                    # We are done, the switch is offline.
-                    if e.errno == 32:
-                        return
-                except TApplicationException:
-                    # Sometimes we get this exception.
-                    # I suspect it is caused by multithreading.
-                    pass
-                finally:
-                    fports = []
-                    gports = []
-                    if self.latest_timestamp != 0:
-                        for p in self.sw.sw_ports:
-                            if self.last_seen[p] is not None:
-                                if (self.latest_timestamp - self.last_seen[p]) / 1e6 > self.threshold:
-                                    fports.append(p)
-                                else:
-                                    gports.append(p)
-                    
-                    # Report the up and down ports.
-                    if len(fports) != 0:
-                        self.failure_cb(self, fports)
+            for sw in self.switches:
+                sub = self.subscribe(sw)
+                subs[sub.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)] = (sw, sub)
 
-                    if len(gports) != 0:
-                        self.good_cb(self, gports)
+            while True:
+                readable, _, _ = select.select(list(subs), [], [])
+                for fd in readable:
+                    sw, sub = subs[fd]
+                    try:
+                        self.process_digest(sw, sub.recv())
+                    except TApplicationException:
+                        # Sometimes we get this exception, probably caused by multithreading.
+                        pass
+                    except Exception:
+                        logging.exception(f"[{str(sw)}]: Fail to process the digest")
         except KeyboardInterrupt:
             return
+        except OSError as e:
+            # We are done, the switch is offline.
+            if e.errno != 32:
+                logging.exception("")
         except Exception:
             logging.exception("")
+        finally:
+            for _, sub in subs.values():
+                sub.close()
 
 
-# The flow monitor use scapy to monitor all flows to trigger a possible reroute.
-class FlowMonitor(threading.Thread):
+# The flow poller reads the flow counters of all switches to trigger a possible reroute.
+# Unlike sniffing the host interfaces, no packet is copied to the controller.
+class FlowPoller(threading.Thread):
 
     def __init__(self, switches: list, spd_cb: callable, interval=0.5):
         super().__init__()
         self.switches = switches
         self.spd_cb = spd_cb
         self.interval = interval
-        self.last_time = None
-        self.flows = { City(i) : {} for i in range(16) }
-        self.interfaces = {sw.host.sw_interface : sw for sw in self.switches}
-        self.hosts = {sw.host.ip : sw for sw in self.switches}
+        # The hosts by the ip address as an int.
+        self.hosts = {struct.unpack("!I", socket.inet_aton(sw.host.ip))[0] : sw for sw in self.switches}
+        # The flow and the bytes counted in each slot of each switch when we last read it.
+        self.last_slots = { sw.city : {} for sw in self.switches }
 
-    def parse(self, pkt: Packet):
-        
-        iface = pkt.sniffed_on
-        if iface is None:
+    def read_flows(self, sw: Switch):
+        """
+            Read the flow counters of the switch and return the bytes of each flow since the last read.
+
+            The whole register arrays are read with one RPC each, see flowBytes in switch.p4.
+        """
+        flow_bytes = sw.monitor.register_read("flowBytes")
+        flow_src = sw.monitor.register_read("flowSrc")
+        flow_dst = sw.monitor.register_read("flowDst")
+        flow_ports = sw.monitor.register_read("flowPorts")
+        flow_proto = sw.monitor.register_read("flowProto")
+
+        last_slots = self.last_slots[sw.city]
+        flows = {}
+        for idx, cnt in enumerate(flow_bytes):
+            if cnt == 0:
+                continue
+
+            src_sw = self.hosts.get(flow_src[idx])
+            dst_sw = self.hosts.get(flow_dst[idx])
+            if src_sw is None or dst_sw is None or (flow_proto[idx] != 6 and flow_proto[idx] != 17):
+                continue
+
+            fl = (src_sw.city, flow_ports[idx] >> 16, dst_sw.city, flow_ports[idx] & 0xFFFF, "tcp" if flow_proto[idx] == 6 else "udp")
+            last_fl, last_cnt = last_slots.get(idx, (None, 0))
+            # If another flow took the slot, we can't tell the bytes apart, count them all for the new one.
+            delta = cnt - last_cnt if last_fl == fl else cnt
+            last_slots[idx] = (fl, cnt)
+
+            if delta > 0:
+                flows[fl] = flows.get(fl, 0) + delta
+
+        return flows
+
+    def run(self):
+        last_time = datetime.now().timestamp()
+        logging.debug(f"Poll flow counters every {self.interval}s")
+        try:
+            while True:
+                time.sleep(self.interval)
+                flows = { City(i) : {} for i in range(16) }
+                for sw in self.switches:
+                    try:
+                        flows[sw.city] = self.read_flows(sw)
+                    except TApplicationException:
+                        # Sometimes we get this exception, probably caused by multithreading.
+                        pass
+
+                now = datetime.now().timestamp()
+                try:
+                    # Report all flows.
+                    self.spd_cb(self, flows, now - last_time)
+                except Exception:
+                    logging.exception(f"Fail to call spd_cb")
+                last_time = now
+        except KeyboardInterrupt:
             return
+        except OSError as e:
+            # We are done, the switch is offline.
+            if e.errno != 32:
+                logging.exception("Fail to poll flow")
+        except Exception:
+            logging.exception("Fail to poll flow")
+
+# The demand scheduler tells the routing worker when the demands of the base traffic change.
+# The times are seconds of the simulation, which starts at `reference_time`, see Controller.build_timeline.
+class DemandScheduler(threading.Thread):
+
+    def __init__(self, times: list, reference_time: float, demands_cb: callable):
+        super().__init__()
+        self.times = times
+        self.reference_time = reference_time
+        self.demands_cb = demands_cb
+
+    def run(self):
+        try:
+            for t in self.times:
+                delay = self.reference_time + t - time.time()
+                if delay > 0:
+                    time.sleep(delay)
 
-        if iface not in self.interfaces:
-            logging.warning(f"Packet on {iface} not in {self.interfaces}")
+                logging.debug(f"The base traffic changes at {t}s")
+                self.demands_cb(t)
+        except KeyboardInterrupt:
             return
+        except Exception:
+            logging.exception("")
 
-        city = self.interfaces[iface].city
-        ip = pkt.getlayer(IP)
 
-        if ip is not None:
-            tcp = pkt.getlayer(TCP)
-            udp = pkt.getlayer(UDP)
+# The routing state published by the routing worker, see Controller.publish.
+# A new snapshot replaces the old one as a whole, so the readers never see a half updated state.
+RoutingSnapshot = namedtuple("RoutingSnapshot", ["version", "weights", "best_paths", "hosts_path"])
 
-            if tcp is None and udp is None:
-                return
-            
-            if tcp is not None:
-                sport = tcp.sport
-                dport = tcp.dport
-                proto = "tcp"
+# The routing worker is the only thread which changes the routes after init.
+# The monitors post their events to it and the events arriving within `window` are handled with a single recompute.
+class RoutingWorker(threading.Thread):
+
+    def __init__(self, controller, window=0.05):
+        super().__init__()
+        self.controller = controller
+        self.window = window
+        self.events = queue.Queue()
+
+    def link_down(self, sw2: Switch, ports: list):
+        self.events.put(("down", sw2, ports))
+
+    def link_up(self, sw2: Switch, ports: list):
+        self.events.put(("up", sw2, ports))
+
+    def flows(self, monitor, flows: dict, interval: float):
+        self.events.put(("flows", monitor, flows, interval))
+
+    def demands(self, t: float):
+        self.events.put(("demands", t))
+
+    def collect(self):
+        """
+            Wait for an event, then take all events arriving within the window.
+        """
+        events = [self.events.get()]
+        deadline = time.monotonic() + self.window
+        while True:
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    events.append(self.events.get(timeout=timeout))
+                else:
+                    # Still take what is already queued.
+                    events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def coalesce(self, events: list):
+        """
+            Merge the events into the last state of each reported port, the last flows and the last demands.
+
+            The flows are the speeds of the last interval, so the newer report replaces the older one.
+        """
+        states = {}
+        flows = None
+        demands = None
+        for e in events:
+            if e[0] == "flows":
+                flows = e[1:]
+            elif e[0] == "demands":
+                demands = e[1]
             else:
-                sport = udp.sport
-                dport = udp.dport
-                proto = "udp"
-
-            # src_ip = get_field_bytes(ip, "src")
-            # dst_ip = get_field_bytes(ip, "dst")
-            src_ip = ip.src
-            if src_ip not in self.hosts:
-                logging.warning(f"src_ip={src_ip} not in {self.hosts}")
-                return
-            src_city = self.hosts[src_ip].city
-            dst_ip = ip.dst
-            if dst_ip not in self.hosts:
-                logging.warning(f"dst_ip={dst_ip} not in {self.hosts}")
-                return
-            dst_city = self.hosts[dst_ip].city
-
-            fl = (src_city, sport, dst_city, dport, proto)
-
-            if fl not in self.flows[city]:
-                self.flows[city][fl] = 0
-
-            whole_size = len(pkt)
-            self.flows[city][fl] += whole_size
-        
-        now = pkt.time
+                for port in e[2]:
+                    states[(e[1], port)] = e[0] == "down"
+
+        return states, flows, demands
 
-        if now - self.last_time > self.interval:
+    def handle(self, events: list):
+        """
+            Update the routes once for all the events and publish the new routing state.
+        """
+        states, flows, demands = self.coalesce(events)
+        try:
+            # Reroute the flows on the routes without the failed links.
+            if len(states) != 0:
+                self.controller.set_link_states(states)
+            if demands is not None:
+                self.controller.apply_demands(demands)
+            if flows is not None:
+                self.controller.rt_flows(*flows)
+        except TApplicationException:
+            # Sometimes we get this exception, probably caused by multithreading.
+            pass
+        except Exception:
+            logging.exception("Fail to update the routes")
+        finally:
+            self.controller.publish()
+
+    def handle_pending(self):
+        """
+            Handle the queued events in the calling thread, for the callers which don't start the worker, see benchmark.py.
+        """
+        events = []
+        while True:
             try:
-                # Report all flows.
-                self.spd_cb(self, self.flows, now - self.last_time)
-            except Exception:
-                logging.exception(f"Fail to call spd_cb")
-            self.last_time = now
-            self.flows = { City(i) : {} for i in range(16) }
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+
+        if len(events) != 0:
+            self.handle(events)
 
     def run(self):
-        self.last_time = datetime.now().timestamp()
-        logging.debug(f"Monitor flow on: {list(self.interfaces.keys())}")
         try:
-            sniff(iface=list(self.interfaces.keys()), prn=self.parse)
-        except Exception:
-            logging.exception("Fail to monitor flow")
+            while True:
+                self.handle(self.collect())
+        except KeyboardInterrupt:
+            return
+
 
 # The core controller object
 class Controller(object):
 
-    def __init__(self, base_traffic: str, slas: str):
+    def __init__(self, base_traffic: str, slas: str, topo=None, switch_api=SimpleSwitchThriftAPI, profile='', reference_time=0, elephant_flows=0):
+        """
+            `topo` and `switch_api` replace the topology.json of p4run and the Thrift API, see fake_switch.py.
+
+            If `profile` is set, the timing of init is written to it, see write_profile.
+
+            If `reference_time` is set, it is the unix time the simulation starts and only the base flows active
+            at a time reserve capacity, see DemandScheduler. Else all base flows reserve capacity all the time.
+
+            If `elephant_flows` is set, the largest flows are pinned to paths one by one instead of rerouting
+            whole pairs of cities, see pin_elephants.
+        """
         self.base_traffic_file = base_traffic
         self.slas_file = slas
-        self.topo = load_topo('topology.json')
+        self.profile = profile
+        self.reference_time = reference_time
+        self.elephant_flows = elephant_flows
+        # The path of each pinned flow, see pin_elephants.
+        self.pinned = {}
+        # The pin_meter cell of each pinned flow, and the cells of each switch whose rates are set, see pin_meter.
+        self.pin_meters = {}
+        self.pin_meters_ready = { City(i) : set() for i in range(16) }
+        # The times the demands of the base traffic change, see build_timeline.
+        self.timeline = []
+        # The time of the demands we used last, see apply_demands.
+        self.demands_time = None
+        # The pairs of cities splitting their flows over several paths, see parse_inputs.
+        self.multipath_pairs = set()
+        # The paths and the weights of the multipath group of each pair of cities, see build_multipath_from_to.
+        self.multipaths = [ [None for __ in range(16)] for _ in range(16) ]
+        # The demands placed by cal_best_paths and the capacity of the links they leave.
+        self.demands = {}
+        self.spare_capacity = [ [0 for __ in range(16)] for _ in range(16) ]
+        # The timing of each phase of init, see run_phase.
+        self.phases = []
+        self.topo = load_topo('topology.json') if topo is None else topo
+        self.switch_api = switch_api
+        # The programming and the monitoring connections of each switch, see SwitchConnection.
         self.controllers = {}
+        self.monitors = {}
         self.links_capacity = [ [0 for __ in range(16)] for _ in range(16) ]
         self.weights = { City(i) : {} for i in range(16) }
         self.switches = [Switch(City(i)) for i in range(16)]
         self.all_available_path = []
         self.thrift_controller = None
         self.wps = [ [None for __ in range(16)] for _ in range(16) ]
+        # The capacity reserved by cal_best_paths for each pair of cities.
+        self.reservations = [ [0 for __ in range(16)] for _ in range(16) ]
+        # The pairs of cities whose cached paths traverse a link, see index_paths.
+        self.link_pairs = {}
+        # The path-link incidence matrices of the cached paths of each pair of cities, see incidence_matrix.
+        self.path_links = [ [None for __ in range(16)] for _ in range(16) ]
+        # The backup (path, weight) of each (city, neighbour, destination), see cal_lfa_paths.
+        self.lfa_paths = {}
+        # The paths we calculated so far, see benchmark.py
+        self.paths_evaluated = 0
+        # The last published routing state, see publish.
+        self.snapshot = None
+        # All route changes after init go through the routing worker, see start_monitor.
+        self.router = RoutingWorker(self)
+        # Used to program all switches concurrently, see flush_switches.
+        self.executor = ThreadPoolExecutor(max_workers=16)
         self.init()
 
     def parse_inputs(self):
@@ -470,6 +1099,14 @@ class Controller(object):
             rdr = csv.DictReader(cleanfile(f))
             self.slas = [make_sla(spec) for spec in rdr]
         self.flows = parse_traffic(self.base_traffic_file)
+        self.timeline = self.build_timeline()
+
+        # The flows of a pair can only be split if it has more than one.
+        pair_flows = {}
+        for fl in self.flows:
+            pair = (self.parse_city_str(fl['src'])[0], self.parse_city_str(fl['dst'])[0])
+            pair_flows[pair] = pair_flows.get(pair, 0) + 1
+        self.multipath_pairs = { pair for pair, n in pair_flows.items() if n >= ECMP_MIN_FLOWS and pair[0] != pair[1] }
 
     def parse_city_str(self, s: str):
         """
@@ -499,11 +1136,98 @@ class Controller(object):
         
         return (l, r)
 
+    def merge_port_ranges(self, rects: list):
+        """
+            Merge the (sport range, dport range) rectangles as long as the union of two is still a rectangle.
+
+            A rectangle inside another one is dropped.
+        """
+        def merge(a, b):
+            (asl, asr), (adl, adr) = a
+            (bsl, bsr), (bdl, bdr) = b
+            if bsl <= asl and asr <= bsr and bdl <= adl and adr <= bdr:
+                return b
+            if asl <= bsl and bsr <= asr and adl <= bdl and bdr <= adr:
+                return a
+            # The same sports with overlapping or adjacent dports, or the other way around.
+            if (asl, asr) == (bsl, bsr) and adl <= bdr + 1 and bdl <= adr + 1:
+                return ((asl, asr), (min(adl, bdl), max(adr, bdr)))
+            if (adl, adr) == (bdl, bdr) and asl <= bsr + 1 and bsl <= asr + 1:
+                return ((min(asl, bsl), max(asr, bsr)), (adl, adr))
+            return None
+
+        rects = list(set(rects))
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(rects)):
+                for j in range(i + 1, len(rects)):
+                    m = merge(rects[i], rects[j])
+                    if m is not None:
+                        rects = [ r for k, r in enumerate(rects) if k != i and k != j ] + [m]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        return rects
+
+    def compile_sla_rules(self, rules: set, all_nets: set):
+        """
+            Compile the allowed (port, dst network, sport range, dport range) rules into fewer entries.
+
+            All sla entries are NoAction in front of a drop default, so a table is the union of its rules and we
+            can merge them freely:
+                1. The port ranges of each (port, dst network) are merged, see merge_port_ranges.
+                2. The dst networks of each (port, port ranges) are aggregated, all of `all_nets` is 0.0.0.0/0.
+                3. The rules inside another one are dropped.
+
+            Return the entries like Switch.sync_table wants, the more specific entries have the higher priority.
+        """
+        wildcard = ipaddress.ip_network("0.0.0.0/0")
+        rules = set(rules)
+
+        while True:
+            n = len(rules)
+
+            by_net = {}
+            for port, net, srange, drange in rules:
+                by_net.setdefault((port, net), []).append((srange, drange))
+            rules = set( (port, net, srange, drange) for (port, net), rects in by_net.items() for srange, drange in self.merge_port_ranges(rects) )
+
+            by_ranges = {}
+            for port, net, srange, drange in rules:
+                by_ranges.setdefault((port, srange, drange), set()).add(net)
+            rules = set()
+            for (port, srange, drange), nets in by_ranges.items():
+                nets = [wildcard] if nets >= all_nets else ipaddress.collapse_addresses(nets)
+                rules |= set( (port, net, srange, drange) for net in nets )
+
+            def covered(r1, r2):
+                return r1 != r2 and r1[0] == r2[0] and r1[1].subnet_of(r2[1]) and \
+                    r2[2][0] <= r1[2][0] and r1[2][1] <= r2[2][1] and r2[3][0] <= r1[3][0] and r1[3][1] <= r2[3][1]
+            rules = set( r1 for r1 in rules if not any(covered(r1, r2) for r2 in rules) )
+
+            if len(rules) == n:
+                break
+
+        # Longer prefixes and smaller ranges first, a lower value is a higher priority.
+        ordered = sorted(rules, key=lambda r: (-r[1].prefixlen, (r[2][1] - r[2][0]) * (r[3][1] - r[3][0]), r[0], str(r[1]), r[2], r[3]))
+        return { ((str(port), str(net), f"{srange[0]}->{srange[1]}", f"{drange[0]}->{drange[1]}"), prio) : ("NoAction", ())
+                 for prio, (port, net, srange, drange) in enumerate(ordered, 1) }
+
     def build_sla_rules(self):
         """
             This function build rules for specific SLAs.
+
+            The rules are compiled into fewer entries, see compile_sla_rules.
         """
         try:
+            # The allowed (port, dst network, sport range, dport range) of each table.
+            rules = { sw.city : { "tcp_sla" : set(), "udp_sla" : set() } for sw in self.switches }
+            # The entries we would install without compile_sla_rules.
+            n_entries = 0
+
             for sla_idx, sla in enumerate(self.slas):
                 src_cities = self.parse_city_str(sla.src)
                 dst_cities = self.parse_city_str(sla.dst)
@@ -542,24 +1266,34 @@ class Controller(object):
                             sw2 = self.switches[dst_city] # type: Switch
 
                             # Add rules for range sport=[src_l, src_r] dport=[dst_l, dst_r]
-                            sw1.table_add(tname, "NoAction", [str(sw1.host.sw_port), sw2.host.lpm, f"{src_l}->{src_r}", f"{dst_l}->{dst_r}"], [], 1 + int(dst_city) + sla_idx * len(self.slas))
-                            sw2.table_add(tname, "NoAction", [str(sw2.host.sw_port), sw1.host.lpm, f"{dst_l}->{dst_r}", f"{src_l}->{src_r}"], [], 1 + int(dst_city) + sla_idx * len(self.slas))
+                            rules[src_city][tname].add((sw1.host.sw_port, ipaddress.ip_network(sw2.host.lpm, strict=False), (src_l, src_r), (dst_l, dst_r)))
+                            rules[dst_city][tname].add((sw2.host.sw_port, ipaddress.ip_network(sw1.host.lpm, strict=False), (dst_l, dst_r), (src_l, src_r)))
+                            n_entries += 2
 
-            
+            n_compiled = 0
             for sw in self.switches:
+                # The networks of all other hosts.
+                all_nets = set( ipaddress.ip_network(other.host.lpm, strict=False) for other in self.switches if other is not sw )
 
-                for p in sw.sw_ports.keys():
-                    # Add rules for forwarding.
-                    # Equavelent to
-                    #   iptables -A FORWARD -j ACCEPT
-                    sw.table_add("tcp_sla", "NoAction", [str(p), "0.0.0.0/0", "0->65535", "0->65535"], [], 0)
-                    sw.table_add("udp_sla", "NoAction", [str(p), "0.0.0.0/0", "0->65535", "0->65535"], [], 0)
+                for tname in ["tcp_sla", "udp_sla"]:
+                    entries = self.compile_sla_rules(rules[sw.city][tname], all_nets)
+                    n_compiled += len(entries)
+
+                    for p in sw.sw_ports.keys():
+                        # Add rules for forwarding.
+                        # Equavelent to
+                        #   iptables -A FORWARD -j ACCEPT
+                        entries[((str(p), "0.0.0.0/0", "0->65535", "0->65535"), 0)] = ("NoAction", ())
+
+                    sw.sync_table(tname, entries)
 
                 # By defacult block all traffic.
                 # Equavelent to
                 #   iptables -P INPUT DROP
-                sw.controller.table_set_default("tcp_sla", "drop")
-                sw.controller.table_set_default("udp_sla", "drop")
+                sw.table_set_default("tcp_sla", "drop")
+                sw.table_set_default("udp_sla", "drop")
+
+            logging.info(f"SLA entries: {n_entries} compiled to {n_compiled}")
 
         except Exception:
             logging.exception("Adding sla")
@@ -570,19 +1304,122 @@ class Controller(object):
             2. Parse and build sla rules.
             3. Build the best paths based on SLA.
         """
-        self.connect_to_switches()
-        self.reset_states()
-        self.build_topo()
-        self.sanity_check()
-        self.parse_inputs()
-        self.build_sla_rules()
-
-        self.paths = self.cal_paths()
-        self.best_paths = self.cal_best_paths(self.paths)
-        
-        self.build_mpls_forward_table()
-        self.build_mpls_fec(self.best_paths)
+        self.run_phase("connect_to_switches", self.connect_to_switches)
+        self.run_phase("reset_states", self.reset_states)
+        self.run_phase("build_topo", self.build_topo)
+        self.run_phase("sanity_check", self.sanity_check)
+        self.run_phase("parse_inputs", self.parse_inputs)
+
+        self.paths = self.run_phase("cal_paths", self.cal_paths)
+        self.run_phase("index_paths", self.build_path_index)
+        if self.reference_time:
+            # During the warmup, reserve for the flows starting first.
+            self.demands_time = max(time.time() - self.reference_time, 0)
+        self.best_paths = self.run_phase("cal_best_paths", self.cal_best_paths, self.paths, self.base_demands(self.demands_time))
+
+        # Queue all table operations and then program all switches at once.
+        self.begin_batch()
+        self.run_phase("build_sla_rules", self.build_sla_rules)
+        self.run_phase("build_mpls_forward_table", self.build_mpls_forward_table)
+        self.run_phase("build_mpls_fec", self.build_mpls_fec, self.best_paths)
+        self.run_phase("build_lfa_tables", self.build_lfa_tables)
         #self.build_meter_table()
+        self.run_phase("flush_switches", self.flush_switches)
+        self.publish()
+
+        if self.profile:
+            self.write_profile(self.profile)
+
+    def build_path_index(self):
+        """
+            Build the indexes of the paths, see index_paths and incidence_matrix.
+        """
+        self.link_pairs = self.index_paths(self.paths)
+        for i in range(16):
+            for j in range(16):
+                self.path_links[i][j] = self.incidence_matrix([p for p, _ in self.paths[i][j]])
+
+    def run_phase(self, name: str, fn: callable, *args):
+        """
+            Run a phase of init and record its wall time, CPU time and RPCs. Return what the phase returns.
+
+            The CPU time is of the whole process, since the RPCs run in the executor.
+        """
+        rpcs = sum(sw.rpc_calls for sw in self.switches)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        r = fn(*args)
+        self.phases.append({
+            "name" : name,
+            "wall" : time.perf_counter() - wall,
+            "cpu" : time.process_time() - cpu,
+            "rpcs" : sum(sw.rpc_calls for sw in self.switches) - rpcs
+        })
+        logging.debug(f"Phase {name}: {self.phases[-1]}")
+        return r
+
+    def write_profile(self, path: str):
+        """
+            Write the timing of init and the RPCs of each switch as json.
+        """
+        report = {
+            "phases" : self.phases,
+            "total" : {
+                "wall" : sum(p["wall"] for p in self.phases),
+                "cpu" : sum(p["cpu"] for p in self.phases),
+                "rpcs" : sum(p["rpcs"] for p in self.phases)
+            },
+            "switches" : {
+                str(sw) : {
+                    "rpcs" : sw.rpc_calls,
+                    "saved" : sw.rpc_saved,
+                    "latency" : sw.rpc_histogram(),
+                    "connections" : { conn.role : conn.health() for conn in (sw.controller, sw.monitor) }
+                } for sw in self.switches
+            }
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Profile written to {path}")
+
+    def publish(self):
+        """
+            Publish the current routing state as a new snapshot.
+
+            Only the thread changing the routes calls it, see RoutingWorker. The other threads read `self.snapshot`,
+            like benchmark.py.
+        """
+        self.snapshot = RoutingSnapshot(
+            0 if self.snapshot is None else self.snapshot.version + 1,
+            tuple( tuple(sorted(self.weights[City(i)].items())) for i in range(16) ),
+            tuple( tuple(bp) for bp in self.best_paths ),
+            tuple( tuple(sw.hosts_path) for sw in self.switches )
+        )
+
+    def begin_batch(self):
+        """
+            Queue the table operations of the current thread on all switches, see Switch.begin_batch.
+        """
+        for sw in self.switches:
+            sw.begin_batch()
+
+    def flush_switches(self):
+        """
+            Program all switches concurrently with the table operations queued by the current thread.
+
+            The operations of a switch are still run in order on its own connection.
+        """
+        futures = []
+        for sw in self.switches:
+            ops = sw.take_batch()
+            if len(ops) != 0:
+                futures.append(self.executor.submit(sw.run_batch, ops))
+
+        for f in futures:
+            f.result()
+
+        if len(futures) != 0:
+            logging.debug(f"RPCs issued: {sum(sw.rpc_calls for sw in self.switches)} saved: {sum(sw.rpc_saved for sw in self.switches)}")
 
 
     def pprint_topo(self):
@@ -613,6 +1450,8 @@ class Controller(object):
     def build_mpls_fec(self, best_paths):
         """
             Build all MPLS routes based on the best_path
+
+            The unchanged routes cost no RPC, see Switch.set_entry.
         """
         for sw1 in self.switches:
             c1 = sw1.city
@@ -633,34 +1472,139 @@ class Controller(object):
         """
         sw1 = self.switches[c1]
         sw2 = self.switches[c2]
-        mpls_path = list(map(str, self.build_mpls_path(path)[::-1]))
 
-        handle_1 = sw1.dst_table_add(c2, "FEC_tbl", f"mpls_ingress_{len(mpls_path)}_hop", [sw1.host.lpm, sw2.host.ip], mpls_path, path)
+        if len(path) < 2:
+            # We can't reach the destination any more.
+            sw1.delete_entry("FEC_tbl", [sw1.host.lpm, sw2.host.ip])
+            sw1.hosts_path[c2] = ( (), 0xFFFF )
+            self.multipaths[c1][c2] = None
+            return
 
-        # Add meters
-        sw1.set_direct_meter_bandwidth('rate_limiting_meter', handle_1, 0.00085, 0.00085, 1600, 1600)
+        if (c1, c2) in self.multipath_pairs:
+            self.build_multipath_from_to(c1, c2, self.multipath_members(c1, c2, path))
+            return
+
+        mpls_path = list(map(str, self.build_mpls_path(path)[::-1]))
+        sw1.dst_table_add(c2, "FEC_tbl", f"mpls_ingress_{len(mpls_path)}_hop", [sw1.host.lpm, sw2.host.ip], mpls_path, path, self.fec_meter(sw1))
+
+    def fec_meter(self, sw1: Switch):
+        """
+            The callback adding the meter of a new FEC_tbl entry, a modified entry keeps its meter.
+        """
+        def _installed(hdl):
+            if hdl is not None:
+                sw1.call(sw1.set_direct_meter_bandwidth, ('rate_limiting_meter', hdl, 0.00085, 0.00085, 1600, 1600))
+
+        return _installed
+
+    def multipath_members(self, c1: City, c2: City, best_path: tuple, k=ECMP_MAX_PATHS):
+        """
+            Select the paths of the multipath group from c1 to c2, the best path and up to k - 1 other cached paths.
+
+            The paths must respect the waypoint. Each path is weighted by the capacity the base traffic leaves on its
+            bottleneck link, see cal_best_paths.
+            Return a list of (path, weight).
+        """
+        target_city = self.wps[c1][c2]
+        paths = [best_path]
+        for p, _ in self.paths[c1][c2]:
+            if len(paths) >= k:
+                break
+            if p != best_path and (target_city is None or target_city in p):
+                paths.append(p)
+
+        members = []
+        for p in paths:
+            spare = min(self.spare_capacity[p[i]][p[i+1]] for i in range(len(p) - 1))
+            if p == best_path:
+                # The demand of the pair is on its best path.
+                spare += self.demands.get((c1, c2), 0)
+            members.append((p, max(spare, 0)))
+
+        if sum(w for _, w in members) == 0:
+            return [ (p, 1) for p, _ in members ]
+        return members
+
+    def ecmp_buckets(self, weights: list):
+        """
+            Split the ECMP_BUCKETS buckets by the weights with the largest remainder method.
+
+            Return the index of the weight for each bucket.
+        """
+        total = sum(weights)
+        shares = [ w * ECMP_BUCKETS / total for w in weights ]
+        counts = [ int(x) for x in shares ]
+        for i in sorted(range(len(weights)), key=lambda i: counts[i] - shares[i])[:ECMP_BUCKETS - sum(counts)]:
+            counts[i] += 1
+
+        return [ i for i, n in enumerate(counts) for _ in range(n) ]
+
+    def build_multipath_from_to(self, c1: City, c2: City, members: list):
+        """
+            Split the flows from c1 to c2 over the paths in `members`, a list of (path, weight).
+
+            The buckets are installed before the FEC_tbl entry, so a packet never hits a missing bucket. Only the
+            buckets which changed are sent, see Switch.set_entry.
+        """
+        sw1 = self.switches[c1]
+        sw2 = self.switches[c2]
+        group = str(int(c2))
+
+        for bucket, i in enumerate(self.ecmp_buckets([ w for _, w in members ])):
+            mpls_path = list(map(str, self.build_mpls_path(members[i][0])[::-1]))
+            sw1.set_entry("ecmp_tbl", [group, str(bucket)], f"mpls_push_{len(mpls_path)}_hop", mpls_path)
+
+        self.multipaths[c1][c2] = members
+        sw1.dst_table_add(c2, "FEC_tbl", "ecmp_group", [sw1.host.lpm, sw2.host.ip], [group, str(ECMP_BUCKETS)], members[0][0], self.fec_meter(sw1))
+
+    def rebalance_multipath(self, c1: City, c2: City, weights: list):
+        """
+            Set the weights of the paths of the multipath group from c1 to c2, in the order of `self.multipaths`.
+        """
+        members = self.multipaths[c1][c2]
+        if members is None or len(weights) != len(members) or sum(weights) <= 0:
+            logging.warning(f"Invalid weights {weights} for the multipath group {str(c1)} -> {str(c2)}")
+            return
+
+        self.build_multipath_from_to(c1, c2, [ (p, w) for (p, _), w in zip(members, weights) ])
+
+    def multipath_shares(self, members: list):
+        """
+            The share of the buckets of each path in `members`, a list of (path, weight), see ecmp_buckets.
+        """
+        return np.bincount(self.ecmp_buckets([ w for _, w in members ]), minlength=len(members)) / ECMP_BUCKETS
+
+    def pair_links(self, c1: City, c2: City):
+        """
+            The share of the traffic from c1 to c2 on each of the 256 links, see incidence_matrix.
+
+            It is the best path, or the paths of the multipath group weighted by their buckets.
+        """
+        members = self.multipaths[c1][c2]
+        if members is None:
+            return self.incidence_matrix([self.best_paths[c1][c2]])[0]
+        return self.multipath_shares(members) @ self.incidence_matrix([ p for p, _ in members ])
 
     def build_mpls_forward_table(self):
         """
             Build mpls_forward table.
 
-            Note this function should be called exactly once.
+            Only the entries which differ from the installed ones are sent, see Switch.sync_table.
         """
         for sw1 in self.switches:
             c1 = sw1.city
 
-            sw1.table_add("FEC_tbl", "ipv4_forward", ["0.0.0.0/0", sw1.host.ip], [sw1.host.mac, str(sw1.host.sw_port)])
-            
+            sw1.set_entry("FEC_tbl", ["0.0.0.0/0", sw1.host.ip], "ipv4_forward", [sw1.host.mac, str(sw1.host.sw_port)])
+
+            desired = {}
             for c2 in sw1.sw_links:
                 c1_port, c1_mac, c2_port, c2_mac = sw1.get_link_to(c2)
 
-                # maybe optimize??
-                sw1.table_add("mpls_tbl", "mpls_forward", [ str(c1_port), "0" ], [c2_mac, str(c1_port)])
-                sw1.table_add("lfa_mpls_tbl", "mpls_forward", [ str(c1_port), "0" ], [c2_mac, str(c1_port)])
-                sw1.table_add("meter_mpls_tbl", "mpls_forward", [ str(c1_port), "0" ], [c2_mac, str(c1_port)])
-                sw1.table_add("mpls_tbl", "penultimate", [ str(c1_port), "1" ], [c2_mac, str(c1_port)])
-                sw1.table_add("lfa_mpls_tbl", "penultimate", [ str(c1_port), "1" ], [c2_mac, str(c1_port)])
-                sw1.table_add("meter_mpls_tbl", "penultimate", [ str(c1_port), "1" ], [c2_mac, str(c1_port)])
+                desired[((str(c1_port), "0"), 0)] = ("mpls_forward", (c2_mac, str(c1_port)))
+                desired[((str(c1_port), "1"), 0)] = ("penultimate", (c2_mac, str(c1_port)))
+
+            for tname in ["mpls_tbl", "lfa_mpls_tbl", "meter_mpls_tbl"]:
+                sw1.sync_table(tname, desired)
 
     def fullfil_link_capcaity(self, path: tuple, req: int):
         """
@@ -723,46 +1667,245 @@ class Controller(object):
         return int(spd_num) * pl
 
         
-    def cal_best_paths(self, paths):
+    def flow_rate(self, fl: dict):
+        """
+            The capacity we reserve for a flow from the traffic file.
+        """
+        if fl['protocol'] == 'udp':
+            return self.parse_speed(fl['rate'])
+        else:
+            return self.parse_speed(fl['size'])
+
+    def select_best_path(self, c1: City, c2: City, paths, req: int):
+        """
+            Select the best path from c1 to c2.
+
+            The waypoint is respected first, then we try to reserve `req` capacity on the path. Return ()
+            if we can't find such a path.
+        """
+        target_city = self.wps[c1][c2]
+        if target_city is not None:
+            # TODO: Optimize by ports?
+            for p in paths[c1][c2]:
+                if target_city in p[0]:
+                    return p[0]
+
+        if req != 0:
+            for ps, _ in paths[c1][c2]:
+                if self.sub_path_if_fullfilled(ps, req):
+                    self.reservations[c1][c2] = req
+                    return ps
+
+        return ()
+
+    def solve_te(self, demands: dict, candidates: dict, budget=TE_TIME_BUDGET):
+        """
+            Assign a path to each pair of cities so that the maximum link utilization is low.
+
+            `demands` maps a pair to its rate and `candidates` to the indexes of the paths it may use. The pairs
+            are placed greedily, the largest demand first, on the shortest path staying below TE_MAX_UTIL, else
+            on the path with the lowest utilization. Then, while a link is above TE_MAX_UTIL, the pairs on the
+            most utilized link are moved to another path if it lowers the maximum, until `budget` seconds passed.
+
+            A link is shared by both directions, like links_capacity. Return the index of the path of each pair.
+        """
+        # The column of the reversed link, see incidence_matrix.
+        rev = (np.arange(256) % 16) * 16 + np.arange(256) // 16
+        cap = np.array([ self.initial_links_capacity[l // 16][l % 16] for l in range(256) ], dtype=float)
+        cap[cap <= 0] = np.inf
+
+        links = {}
+        for (c1, c2), ks in candidates.items():
+            m = self.path_links[c1][c2][ks]
+            links[(c1, c2)] = np.minimum(m + m[:, rev], 1)
+
+        def worst(pair, load):
+            # The maximum utilization along each candidate path with the pair on it.
+            m = links[pair]
+            return np.max(np.where(m > 0, (load + demands[pair] * m) / cap, 0), axis=1)
+
+        order = sorted(demands, key=lambda pair: -demands[pair])
+        load = np.zeros(256)
+        choice = {}
+        for pair in order:
+            w = worst(pair, load)
+            fit = np.flatnonzero(w <= TE_MAX_UTIL)
+            choice[pair] = int(fit[0]) if len(fit) != 0 else int(np.argmin(w))
+            load += demands[pair] * links[pair][choice[pair]]
+
+        deadline = time.perf_counter() + budget
+        moves = 0
+        while time.perf_counter() < deadline:
+            util = load / cap
+            top = util.max()
+            if top <= TE_MAX_UTIL:
+                break
+
+            hot = util >= top - 1e-9
+            for pair in order:
+                cur = links[pair][choice[pair]]
+                if not (cur > 0)[hot].any():
+                    continue
+
+                rest = load - demands[pair] * cur
+                w = worst(pair, rest)
+                k = int(np.argmin(w))
+                if w[k] < top - 1e-9:
+                    choice[pair] = k
+                    load = rest + demands[pair] * links[pair][k]
+                    moves += 1
+                    break
+            else:
+                # Nothing lowers the maximum any more.
+                break
+
+        logging.debug(f"TE: {len(demands)} pairs, {moves} moves, max utilization {(load / cap).max():.2f}")
+        return { pair : candidates[pair][k] for pair, k in choice.items() }
+
+    def flow_interval(self, fl: dict):
+        """
+            The seconds of the simulation the flow reserves capacity, from DEMAND_LEAD_TIME before it starts.
+
+            We don't know when a TCP flow is done, so it reserves until the end.
+        """
+        start = fl['start_time'] - DEMAND_LEAD_TIME
+        if fl['protocol'] == 'udp' and fl['duration']:
+            return start, fl['start_time'] + float(fl['duration'])
+        return start, float("inf")
+
+    def build_timeline(self):
+        """
+            Build the sorted times the demands of the base traffic change.
+        """
+        times = set()
+        for fl in self.flows:
+            for t in self.flow_interval(fl):
+                if t != float("inf"):
+                    times.add(t)
+
+        return sorted(times)
+
+    def base_demands(self, t=None):
+        """
+            The demand of each pair of cities in the base traffic at `t` seconds of the simulation.
+
+            If `t` is None, all flows are counted.
+        """
+        demands = {}
+        for fl in self.flows:
+            if t is not None:
+                start, end = self.flow_interval(fl)
+                if t < start or t >= end:
+                    continue
+
+            c1 = self.parse_city_str(fl['src'])[0]
+            c2 = self.parse_city_str(fl['dst'])[0]
+            if c1 != c2:
+                demands[(c1, c2)] = demands.get((c1, c2), 0) + self.flow_rate(fl)
+
+        return demands
+
+    def apply_demands(self, t: float):
+        """
+            Select the best paths again for the pairs whose base demand changed at `t` seconds of the simulation.
+
+            The other pairs keep their paths, including the reroutes of rt_flows. The multipath groups are split
+            again by the new spare capacity and the pins of the rerouted pairs are dropped, see pin_elephants.
+            Return the pairs whose best path changed.
+        """
+        self.demands_time = t
+        demands = { pair : req for pair, req in self.base_demands(t).items() if len(self.paths[pair[0]][pair[1]]) != 0 }
+
+        changed = []
+        for c1, c2 in sorted(set(demands) | set(self.demands)):
+            old_req = self.demands.get((c1, c2), 0)
+            req = demands.get((c1, c2), 0)
+            if req == old_req:
+                continue
+
+            best_path = self.best_paths[c1][c2]
+            # Release the capacity reserved on the old path before selecting a new one.
+            if self.reservations[c1][c2] != 0:
+                self.sub_path_link_capcity(best_path, -self.reservations[c1][c2])
+                self.reservations[c1][c2] = 0
+            self.sub_path_spare_capacity(best_path, -old_req)
+
+            # A pair without demand keeps its path.
+            new_path = best_path
+            if req != 0:
+                new_path = self.select_best_path(c1, c2, self.paths, req)
+                if new_path == ():
+                    new_path = best_path if self.path_alive(best_path) else self.paths[c1][c2][0][0]
+                self.sub_path_spare_capacity(new_path, req)
+
+            if new_path != best_path:
+                self.best_paths[c1][c2] = new_path
+                changed.append((c1, c2))
+        self.demands = demands
+
+        self.begin_batch()
+        for c1, c2 in changed:
+            self.build_mpls_from_to(c1, c2, self.best_paths[c1][c2])
+        for c1, c2 in self.multipath_pairs:
+            if (c1, c2) not in changed:
+                self.build_mpls_from_to(c1, c2, self.best_paths[c1][c2])
+        self.unpin([ fl for fl in self.pinned if (fl[0], fl[2]) in changed ])
+        self.flush_switches()
+
+        logging.debug(f"The demands changed at {t}s, {len(changed)} best paths changed")
+        return changed
+
+    def sub_path_spare_capacity(self, path: tuple, val):
+        """
+            Substract the capacity for the given path from the capacity the base traffic leaves, see multipath_members.
+        """
+        for i in range(len(path)-1):
+            self.spare_capacity[path[i]][path[i+1]] -= val
+            self.spare_capacity[path[i+1]][path[i]] -= val
+
+    def cal_best_paths(self, paths, demands: dict):
         """
             Select the best path from all available paths.
+
+            The pairs with a demand, see base_demands, are placed together by solve_te, the rest are filled greedily.
         """
 
         best_paths = [ [ () for j in range(16) ] for i in range(16) ]
+        self.links_capacity = copy.deepcopy(self.initial_links_capacity)
+        self.reservations = [ [0 for __ in range(16)] for _ in range(16) ]
 
         for sla in self.slas:
             if sla.type == "wp":
                 try:
-                    # Fullfill the waypoint sla.
                     target_city =  city_maps[sla.target]
                     src_city = self.parse_city_str(sla.src)[0]
                     dst_city = self.parse_city_str(sla.dst)[0]
                     self.wps[src_city][dst_city] = target_city
-                    # TODO: Optimize by ports?
-                    for p in paths[src_city][dst_city]:
-                        if target_city in p[0]:
-                            best_paths[src_city][dst_city] = p[0]
-                            logging.debug(f"Select the best path based on sla {str(src_city)} -> {str(target_city)} -> {str(dst_city)}: {p[0]}")
-                            break
                 except (KeyError, IndexError):
                     logging.exception("")
 
-        # Try to do reservation.
-        for fl in self.flows:
-            c1 = self.parse_city_str(fl['src'])[0]
-            c2 = self.parse_city_str(fl['dst'])[0]
-            if best_paths[c1][c2] == ():
-                if fl['protocol'] == 'udp':
-                    rt = self.parse_speed(fl['rate'])
-                else:
-                    rt = self.parse_speed(fl['size'])
-                all_paths_with_weights = paths[c1][c2]
+        demands = { pair : req for pair, req in demands.items() if len(paths[pair[0]][pair[1]]) != 0 }
+
+        # Fullfill the waypoint slas, a pair may use any path if none traverses its waypoint.
+        candidates = {}
+        for c1, c2 in demands:
+            target_city = self.wps[c1][c2]
+            ks = [ k for k, (p, _) in enumerate(paths[c1][c2]) if target_city is not None and target_city in p ]
+            candidates[(c1, c2)] = ks if len(ks) != 0 else list(range(len(paths[c1][c2])))
+
+        for (c1, c2), k in self.solve_te(demands, candidates).items():
+            best_paths[c1][c2] = paths[c1][c2][k][0]
+            self.sub_path_link_capcity(best_paths[c1][c2], demands[(c1, c2)])
+            self.reservations[c1][c2] = demands[(c1, c2)]
+        self.spare_capacity = copy.deepcopy(self.links_capacity)
+        self.demands = demands
+
+        for i in range(16):
+            for j in range(16):
+                if self.wps[i][j] is not None and best_paths[i][j] == ():
+                    best_paths[i][j] = self.select_best_path(City(i), City(j), paths, 0)
+                    logging.debug(f"Select the best path based on sla {str(City(i))} -> {str(self.wps[i][j])} -> {str(City(j))}: {best_paths[i][j]}")
 
-                for ps, _ in all_paths_with_weights:
-                    if self.sub_path_if_fullfilled(ps, rt):
-                        best_paths[c1][c2] = ps
-                        break
-        
         # Try to make full use of all links.
         for i in range(16):
             for j in range(16):
@@ -770,62 +1913,274 @@ class Controller(object):
                     c1 = City(i)
                     c2 = City(j)
                     if best_paths[c1][c2] == ():
-                        all_paths_with_weights = paths[c1][c2]
-
-                        for ps, _ in all_paths_with_weights:
-                            if self.sub_path_if_fullfilled(ps, 1e7):
-                                best_paths[c1][c2] = ps
-                                break
+                        best_paths[c1][c2] = self.select_best_path(c1, c2, paths, 1e7)
         
         # If we can't find a best path, use the path with the smallest weight.
         return [ [ paths[i][j][0][0] if best_paths[i][j] == () and len(paths[i][j]) != 0  else best_paths[i][j] for j in range(16) ] for i in range(16) ]
 
-    def cal_paths(self):
+    def index_paths(self, paths):
         """
-            Calculate all possible paths with BFS and Floyd alogrithm.
+            Build the reverse index from a link (c1, c2) to the pairs of cities whose paths traverse it.
+        """
+        link_pairs = {}
+        for i in range(16):
+            for j in range(16):
+                self._index_pair(link_pairs, paths, City(i), City(j))
 
-            This function is super slow, be cautious.
+        return link_pairs
+
+    def _index_pair(self, link_pairs: dict, paths, src: City, dst: City, remove=False):
+        for p, _ in paths[src][dst]:
+            for k in range(len(p) - 1):
+                if remove:
+                    link_pairs[(p[k], p[k+1])].discard((src, dst))
+                else:
+                    link_pairs.setdefault((p[k], p[k+1]), set()).add((src, dst))
+
+    def incidence_matrix(self, paths: list):
+        """
+            Build the paths x links incidence matrix of the paths.
+
+            The link c1 -> c2 is the column c1 * 16 + c2, so the matrix times a vector of the links gives the sum over each path.
         """
-        dis = [ [ 0xFFFF for __ in range(16) ] for _ in range(16)]
+        m = np.zeros((len(paths), 256))
+        for r, p in enumerate(paths):
+            for k in range(len(p) - 1):
+                m[r, p[k] * 16 + p[k+1]] = 1
+
+        return m
+
+    def cal_distances(self):
+        """
+            Calculate the distances between all cities with Floyd algorithm.
+        """
+        dis = [ [ 0 if i == j else float("inf") for j in range(16) ] for i in range(16) ]
 
         for city1, c1_w in self.weights.items():
             for city2, w in c1_w.items():
-                dis[city1][city2] = w
-        
-        def _paths_from_city(src_city: City):
-            ps = []
-            ps.append( ((src_city,), 0) )
-            idx = 0
-            while idx < len(ps):
-                top = ps[idx]
-                idx += 1
-                cur = top[0][-1]
+                if w != 0xFFFF:
+                    dis[city1][city2] = w
 
+        for k in range(16):
+            dis_k = dis[k]
+            for i in range(16):
+                dis_ik = dis[i][k]
+                if dis_ik == float("inf"):
+                    continue
+                dis_i = dis[i]
                 for j in range(16):
-                    if dis[cur][j] != 0xFFFF and j not in top[0]:
-                        ps.append( (top[0] + (City(j),), top[1] + dis[cur][j]) )
-            
-            return ps
+                    if dis_ik + dis_k[j] < dis_i[j]:
+                        dis_i[j] = dis_ik + dis_k[j]
 
-        paths = [ [ [] for __ in range(16) ] for _ in range(16)]
+        return dis
+
+    def affected_pairs(self, c1: City, c2: City):
+        """
+            Find the pairs of cities whose paths may change after the weight of link c1 <-> c2 changed.
+
+            If the link fails, these are the pairs with a cached path traversing it. If the link recovers,
+            these are the pairs for which a path over the link could be shorter than the k-th cached one.
+        """
+        if self.weights[c1][c2] == 0xFFFF:
+            return self.link_pairs.get((c1, c2), set()) | self.link_pairs.get((c2, c1), set())
+
+        dis = self.cal_distances()
+        w = self.weights[c1][c2]
+        pairs = set()
         for i in range(16):
-            ps = _paths_from_city(City(i))
+            for j in range(16):
+                if i == j:
+                    continue
+                # The lightest path over the link is a lower bound of all paths over it.
+                via = min(dis[i][c1] + w + dis[c2][j], dis[i][c2] + w + dis[c1][j])
+                ps = self.paths[i][j]
+                if via != float("inf") and (len(ps) < K_SHORTEST_PATHS or via < ps[-1][1]):
+                    pairs.add((City(i), City(j)))
+
+        return pairs
+
+    def update_paths(self, links: list):
+        """
+            Recompute the paths and the best paths after the weights of the links c1 <-> c2 changed.
+
+            Only the affected pairs are recomputed once, see affected_pairs. Return the pairs whose best path changed
+            or whose multipath group has a path over a failed link.
+        """
+        failed = [ (c1, c2) for c1, c2 in links if self.weights[c1][c2] == 0xFFFF ]
+        pairs = set()
+        recovered_pairs = set()
+        for c1, c2 in links:
+            if (c1, c2) in failed:
+                pairs |= self.affected_pairs(c1, c2)
+            else:
+                recovered_pairs |= self.affected_pairs(c1, c2)
+        pairs |= recovered_pairs
+
+        for src, dst in pairs:
+            self._index_pair(self.link_pairs, self.paths, src, dst, remove=True)
+            self.paths[src][dst] = self.cal_k_shortest_paths(src, dst)
+            self._index_pair(self.link_pairs, self.paths, src, dst)
+            self.path_links[src][dst] = self.incidence_matrix([p for p, _ in self.paths[src][dst]])
+
+        changed = []
+        for src, dst in sorted(pairs):
+            best_path = self.best_paths[src][dst]
+            # The best paths not traversing a failed link are still good, unless a recovered link may do better.
+            if (src, dst) not in recovered_pairs and not any(self.path_has_link(best_path, c1, c2) for c1, c2 in failed):
+                continue
+
+            # Release the capacity reserved on the old path before selecting a new one.
+            req = self.reservations[src][dst]
+            if req != 0:
+                self.sub_path_link_capcity(best_path, -req)
+                self.reservations[src][dst] = 0
+
+            new_path = self.select_best_path(src, dst, self.paths, req)
+            if new_path == () and len(self.paths[src][dst]) != 0:
+                new_path = self.paths[src][dst][0][0]
+            if new_path != best_path:
+                self.best_paths[src][dst] = new_path
+                changed.append((src, dst))
+
+        # The multipath groups may split the flows over a failed link even if the best path is fine.
+        for src, dst in sorted(self.multipath_pairs):
+            members = self.multipaths[src][dst]
+            if (src, dst) in changed or members is None:
+                continue
+            if any(self.path_has_link(p, c1, c2) for p, _ in members for c1, c2 in failed):
+                changed.append((src, dst))
 
-            for p in ps:
-                dst = p[0][-1]
-                w = p[1]
-                if w > 0:
-                    paths[i][dst].append(p)
+        logging.debug(f"Links {[(str(c1), str(c2)) for c1, c2 in links]} changed, recompute {len(pairs)} pairs, {len(changed)} best paths changed")
+        return changed
 
+    def path_has_link(self, path: tuple, c1: City, c2: City):
+        """
+            Check if the path traverses the link c1 <-> c2 in any direction.
+        """
+        for i in range(len(path) - 1):
+            if (path[i] == c1 and path[i+1] == c2) or (path[i] == c2 and path[i+1] == c1):
+                return True
+        return False
+
+    def path_alive(self, path: tuple):
+        """
+            Check if no link of the path failed.
+        """
+        return all(self.weights[path[i]][path[i+1]] != 0xFFFF for i in range(len(path) - 1))
+
+    def shortest_path(self, src: City, dst: City, banned_nodes=(), banned_edges=(), max_hops=CONST_MAX_HOPS):
+        """
+            Find the shortest path from src to dst with Dijkstra.
+
+            The nodes in `banned_nodes` and the edges (c1, c2) in `banned_edges` are skipped. If `max_hops`
+            is not None, the path has at most `max_hops` links.
+
+            Return (path, weight) or None if there is no such path.
+        """
+        # Each label is (weight, hops, city, previous label). Since we pop labels by weight, a label which
+        # reaches a city with no fewer hops than a settled one can never be better.
+        settled_hops = [ None for _ in range(16) ]
+        heap = [ (0, 0, src, None) ]
+
+        while len(heap) != 0:
+            label = heapq.heappop(heap)
+            w, hops, cur, _ = label
+
+            if settled_hops[cur] is not None and settled_hops[cur] <= hops:
+                continue
+            settled_hops[cur] = hops
+
+            if cur == dst:
+                path = []
+                while label is not None:
+                    path.append(label[2])
+                    label = label[3]
+                return (tuple(path[::-1]), w)
+
+            if max_hops is not None and hops >= max_hops:
+                continue
+
+            for neigh, neigh_w in self.weights[cur].items():
+                if neigh_w == 0xFFFF or (settled_hops[neigh] is not None and settled_hops[neigh] <= hops + 1) or neigh in banned_nodes or (cur, neigh) in banned_edges:
+                    continue
+                heapq.heappush(heap, (w + neigh_w, hops + 1, neigh, label))
+
+        return None
+
+    def cal_k_shortest_paths(self, src: City, dst: City, k=K_SHORTEST_PATHS, max_hops=CONST_MAX_HOPS):
+        """
+            Calculate the k shortest simple paths from src to dst with Yen's algorithm.
+
+            Return a list of (path, weight) sorted by weight.
+        """
+        first = self.shortest_path(src, dst, max_hops=max_hops)
+        if first is None:
+            return []
+
+        ps = [first]
+        # The index where each path deviates from its parent, see Lawler's improvement of Yen's algorithm.
+        deviations = [0]
+        candidates = []
+        seen = {first[0]}
+
+        while len(ps) < k:
+            last_path, _ = ps[-1]
+            root_w = 0
+
+            for i in range(len(last_path) - 1):
+                if i > 0:
+                    root_w += self.weights[last_path[i-1]][last_path[i]]
+
+                # The spurs before the deviation were already tried by the parent path.
+                if i < deviations[-1]:
+                    continue
+
+                root_path = last_path[:i+1]
+
+                # Remove the links already used by the paths sharing the same root.
+                banned_edges = set()
+                for p, _ in ps:
+                    if len(p) > i + 1 and p[:i+1] == root_path:
+                        banned_edges.add((p[i], p[i+1]))
+
+                hop_budget = None if max_hops is None else max_hops - i
+                spur = self.shortest_path(last_path[i], dst, root_path[:-1], banned_edges, hop_budget)
+                if spur is None:
+                    continue
+
+                total_path = root_path[:-1] + spur[0]
+                if total_path not in seen:
+                    seen.add(total_path)
+                    heapq.heappush(candidates, (root_w + spur[1], len(total_path), total_path, i))
+
+            if len(candidates) == 0:
+                break
+
+            w, _, p, dev = heapq.heappop(candidates)
+            ps.append((p, w))
+            deviations.append(dev)
+
+        self.paths_evaluated += len(ps)
+        return ps
+
+    def cal_paths(self, k=K_SHORTEST_PATHS, max_hops=CONST_MAX_HOPS):
+        """
+            Calculate the k shortest paths between all cities.
+
+            paths[i][j] is a list of (path, weight) sorted by weight, and each path has at most
+            `max_hops` links so that it fits in the MPLS stack.
+        """
+        paths = [ [ [] for __ in range(16) ] for _ in range(16)]
         for i in range(16):
             for j in range(16):
-                paths[i][j].sort(key=lambda t: t[1])
-        
+                if i != j:
+                    paths[i][j] = self.cal_k_shortest_paths(City(i), City(j), k, max_hops)
+
         return paths
 
     def reset_states(self):
         """Resets switches state"""
-        [controller.reset_state() for controller in self.controllers.values()]
+        list(self.executor.map(lambda controller: controller.reset_state(), self.controllers.values()))
 
     def build_topo(self):
         """
@@ -842,6 +2197,7 @@ class Controller(object):
             host_intfs = intfs[host_name]
 
             sw.controller = self.controllers[city]
+            sw.monitor = self.monitors[city]
 
             for _, attrs in host_intfs.items():
                 if attrs['node_neigh'] == str(sw):
@@ -873,13 +2229,18 @@ class Controller(object):
                     self.links_capacity[neigh_city][city] = 1e7
         
         self.initial_weights = copy.deepcopy(self.weights)
+        self.initial_links_capacity = copy.deepcopy(self.links_capacity)
         self.pprint_topo()
 
     def connect_to_switches(self):
         """Connects to switches"""
         for p4switch in self.topo.get_p4switches():
             thrift_port = self.topo.get_thrift_port(p4switch)
-            self.controllers[city_maps[p4switch]] = SimpleSwitchThriftAPI(thrift_port)
+            self.controllers[city_maps[p4switch]] = SwitchConnection(self.switch_api, thrift_port, "programming")
+            # The monitors poll often, give up on a slow switch sooner.
+            self.monitors[city_maps[p4switch]] = SwitchConnection(self.switch_api, thrift_port, "monitoring", timeout=THRIFT_TIMEOUT / 2)
+            # The monitoring connection is opened by its first call, see start_monitor.
+            self.controllers[city_maps[p4switch]].connect()
             logging.debug(f"Switch: {p4switch} port: {thrift_port}")
     
     def sanity_check(self):
@@ -895,29 +2256,6 @@ class Controller(object):
                     logging.warning(f"Reverse weight doesn't exist for {city2} -> {city1}, setting it to {w}")
                     self.weights[city2][city1] = w
 
-    def mpls_path_rebuild(self, path):
-        mpls_ports = []
-
-        for i in range(len(path) - 1):
-            cur = path[i]
-            next = path[i + 1]
-            cur_port, cur_mac, next_port, next_mac = self.switches[cur].get_link_to(next)
-            mpls_ports.append(cur_port)
-
-        return mpls_ports
-
-    def path_valid(self, path, sw1: Switch):
-        for i in range(len(sw1.failed_link)):
-            if sw1.failed_link[i] in path:
-                return False
-        return True
-
-    def path_direct_valid(self, path, sw1: Switch):
-        for i in range(len(sw1.failed_link) - 1):
-            if sw1.failed_link[i] in path:
-                return False
-        return True
-
     def build_meter_alt_paths(self, src: City, dst: City):
         """
             Build the alternative paths based on the result of cal_paths()
@@ -956,207 +2294,367 @@ class Controller(object):
                         sw1.dst_table_add(c2, "meter_table", f"lfa_replace_{len(mpls_path)}_hop", [sw1.host.lpm, dst_sw.host.ip], mpls_path, alt_path)
             
 
-    def build_failure_rerout(self, sw1_wf: Switch, sw2_wf: Switch):
-        """ Reroute the traffic when failures are detected
+    def cal_lfa_paths(self, sw: Switch):
         """
-        sw_l = []
-        sw_l.append(sw1_wf)
-        sw_l.append(sw2_wf)
+            Calculate the backup paths of the switch to all destinations for each link of the switch.
 
-        # Add the failed link to sw.failed_link to avoid conflicts in the lfa table
-        sw1_wf.failed_link.append(sw2_wf.city)
-        sw2_wf.failed_link.append(sw1_wf.city)
+            Each backup path is the shortest path avoiding the link, see LFA_REP_tbl in switch.p4. Return
+            the LFA_REP_tbl entries like Switch.sync_table wants.
+        """
+        desired = {}
+        for c2 in sw.sw_links:
+            port = sw.sw_links[c2]['port']
+            for dst_sw in self.switches:
+                if dst_sw.city == sw.city:
+                    continue
 
-        logging.debug(f"[Failure-Recover] Link between {str(sw1_wf.city)} -> {str(sw2_wf.city)} failed")
-        logging.debug(f"[Failure-Recover] Recompute routing paths")
-        
-        # Rebuild all routes avoiding the failed link
-        for i in range(2):
-            for j in range(16):
-                if(j != sw_l[i].city):
-                    # Check whether from swi_wf.city to j uses the failed link
-                    if(sw_l[1-i].city in self.best_paths[sw_l[i].city][j]):
-                        logging.debug(f"[Failure-Recover] {str(sw_l[1-i].city)} in {self.best_paths[sw_l[i].city][j]}")
-                        # Find the first route with out the failed link
-                        logging.debug(f"[Failure-Recover] failed_link of {str(sw_l[1-i].city)} : {sw_l[1-i].failed_link}")
-                        for p in self.paths[sw_l[i].city][j]:
-                            if (sw_l[1-i].city == p[0][-1]):
-                                # The target city is directly connected with the src city
-                                if self.path_direct_valid(p[0], sw_l[i]):
-                                    # The failed link is directly connected to the destination
-                                    dst_sw = self.switches[j]
-                                    # Add dst ip to sw.in_reroute_table
-                                    if dst_sw.host.ip in sw_l[i].in_reroute_table:
-                                        # If the dst is already in the table
-                                        mpls_path = list(map(str, self.mpls_path_rebuild(p[0])[::-1]))
-                                        handle_1 = sw_l[i].table_modify("LFA_REP_tbl", sw_l[i].in_reroute_table[dst_sw.host.ip], f"lfa_replace_{len(p[0]) - 1}_hop", mpls_path)
-                                        # Store the handle of the table
-                                        sw_l[i].in_reroute_table[dst_sw.host.ip] = handle_1
-                                        action_name = f"lfa_replace_{len(p[0]) - 1}_hop"
-                                        match_keys = [dst_sw.host.ip]
-                                        logging.debug(f"[Failure-Recover] [{str(sw_l[i].city)}] -> [{str(dst_sw.city)}] Path Change table_modify LFA_REP_tbl {action_name} {match_keys} {mpls_path}")
-                                        break
-                                    else:
-                                        # If the dst is not in the table
-                                        mpls_path = list(map(str, self.mpls_path_rebuild(p[0])[::-1]))
-                                        handle_1 = sw_l[i].table_add("LFA_REP_tbl", f"lfa_replace_{len(p[0]) - 1}_hop", [dst_sw.host.ip], mpls_path)
-                                        sw_l[i].in_reroute_table[dst_sw.host.ip] = handle_1
-                                        action_name = f"lfa_replace_{len(p[0]) - 1}_hop"
-                                        match_keys = [dst_sw.host.ip]
-                                        logging.debug(f"[Failure-Recover] [{str(sw_l[i].city)}] -> [{str(dst_sw.city)}] Path Change table_add LFA_REP_tbl {action_name} {match_keys} {mpls_path}")
-                                        break
-                            
-                            # Check the validity of the path
-                            if self.path_valid(p[0], sw_l[i]):
-                                dst_sw = self.switches[j]
-                                # Add dst ip to sw.in_reroute_table
-                                if dst_sw.host.ip in sw_l[i].in_reroute_table:
-                                    # If the dst is already in the table
-                                    mpls_path = list(map(str, self.mpls_path_rebuild(p[0])[::-1]))
-                                    handle_1 = sw_l[i].table_modify("LFA_REP_tbl", sw_l[i].in_reroute_table[dst_sw.host.ip], f"lfa_replace_{len(p[0]) - 1}_hop", mpls_path)
-                                    # Store the handle of the table
-                                    sw_l[i].in_reroute_table[dst_sw.host.ip] = handle_1
-                                    action_name = f"lfa_replace_{len(p[0]) - 1}_hop"
-                                    match_keys = [dst_sw.host.ip]
-                                    logging.debug(f"[Failure-Recover] [{str(sw_l[i].city)}] -> [{str(dst_sw.city)}] Path Change table_modify LFA_REP_tbl {action_name} {match_keys} {mpls_path}")
-                                    break
-                                else:
-                                    # If the dst is not in the table
-                                    mpls_path = list(map(str, self.mpls_path_rebuild(p[0])[::-1]))
-                                    handle_1 = sw_l[i].table_add("LFA_REP_tbl", f"lfa_replace_{len(p[0]) - 1}_hop", [dst_sw.host.ip], mpls_path)
-                                    sw_l[i].in_reroute_table[dst_sw.host.ip] = handle_1
-                                    action_name = f"lfa_replace_{len(p[0]) - 1}_hop"
-                                    match_keys = [dst_sw.host.ip]
-                                    logging.debug(f"[Failure-Recover] [{str(sw_l[i].city)}] -> [{str(dst_sw.city)}] Path Change table_add LFA_REP_tbl {action_name} {match_keys} {mpls_path}")
-                                    break
-                    
+                backup = self.cal_lfa_path(sw, c2, dst_sw)
+                if backup is None:
+                    continue
 
-    def has_failure(self, pong: Pong, ports: list):
-        sw2 = pong.sw
+                mpls_path = list(map(str, self.build_mpls_path(backup[0])[::-1]))
+                desired[((str(port), dst_sw.host.ip), 0)] = (f"lfa_replace_{len(mpls_path)}_hop", tuple(mpls_path))
 
-        logging.debug(f"[{str(sw2)}]: Possible failures from {ports}")
-        for port in ports:
-            sw1 = sw2.sw_ports[port] # type: Switch
+        return desired
 
-            if self.weights[sw1.city][sw2.city] != 0xFFFF:
-                logging.debug(f"Get a failure from {str(sw1)} -> {str(sw2)} weights {self.weights[sw1.city][sw2.city]} {self.weights[sw2.city][sw1.city]}")
-                self.weights[sw1.city][sw2.city] = 0xFFFF
-                self.weights[sw2.city][sw1.city] = 0xFFFF
-                
-                # self.build_failure_rerout(sw2, sw1)
-                # Set register
-                # sw_port_index_1 = sw1.sw_links[sw2.city]['port']
-                # sw1.controller.register_write('linkState', sw_port_index_1, 1)
-                # sw_port_index_2 = sw2.sw_links[sw1.city]['port']
-                # sw2.controller.register_write('linkState', sw_port_index_2, 1)
-                self.paths = self.cal_paths()
-                self.best_paths = self.cal_best_paths(self.paths)
-                self.build_mpls_fec(self.best_paths)
-                #self.build_meter_table()
+    def cal_lfa_path(self, sw: Switch, c2: City, dst_sw: Switch):
+        """
+            Calculate the backup path of the switch to dst_sw avoiding the link to c2 and remember it in `lfa_paths`.
+        """
+        backup = self.shortest_path(sw.city, dst_sw.city, banned_edges={(sw.city, c2)})
+        self.paths_evaluated += 1
+        self.lfa_paths[(sw.city, c2, dst_sw.city)] = backup
+        return backup
 
-        
+    def update_lfa_tables(self, links: list):
+        """
+            Update the backup paths after the weights of the links c1 <-> c2 changed.
 
-    def no_failure(self, pong: Pong, ports: list):
-        sw2 = pong.sw
+            Like affected_pairs, a backup path is only recomputed if it traverses a failed link, or if a path over
+            a recovered link may be as short as it. Return the number of backup paths recomputed.
+        """
+        failed = [ (c1, c2) for c1, c2 in links if self.weights[c1][c2] == 0xFFFF ]
+        recovered = [ (c1, c2) for c1, c2 in links if self.weights[c1][c2] != 0xFFFF ]
+        dis = self.cal_distances() if len(recovered) != 0 else None
 
-        for port in ports:
-            sw1 = sw2.sw_ports[port] # type: Switch
-            if self.weights[sw1.city][sw2.city] != 0xFFFF:
-                continue
-            
-            logging.debug(f"Failure recovery from {str(sw1)} -> {str(sw2)} weights {self.weights[sw1.city][sw2.city]} {self.weights[sw2.city][sw1.city]}")
-            self.weights[sw1.city][sw2.city] = self.initial_weights[sw1.city][sw2.city]
-            self.weights[sw2.city][sw1.city] = self.initial_weights[sw2.city][sw1.city]
-            # Set back register
-            # sw_port_index_1 = sw1.sw_links[sw2.city]['port']
-            # sw1.controller.register_write('linkState', sw_port_index_1, 0)
-            # sw_port_index_2 = sw2.sw_links[sw1.city]['port']
-            # sw2.controller.register_write('linkState', sw_port_index_2, 0)
-            # Update sw.failed_link list
-            # sw1.failed_link.remove(sw2.city)
-            # sw2.failed_link.remove(sw1.city)
-            self.paths = self.cal_paths()
-            self.best_paths = self.cal_best_paths(self.paths)
-            self.build_mpls_fec(self.best_paths)
-            #self.build_meter_table()
-
-
-    def rt_flows(self, monitor: FlowMonitor, flows: dict, interval: float):
+        n = 0
+        for sw in self.switches:
+            for c2 in sw.sw_links:
+                port = sw.sw_links[c2]['port']
+                for dst_sw in self.switches:
+                    if dst_sw.city == sw.city:
+                        continue
+
+                    backup = self.lfa_paths.get((sw.city, c2, dst_sw.city))
+                    weight = float("inf") if backup is None else backup[1]
+                    broken = backup is not None and any(self.path_has_link(backup[0], l1, l2) for l1, l2 in failed)
+                    if not broken and all(self.lfa_via(dis, sw.city, dst_sw.city, l1, l2) > weight for l1, l2 in recovered):
+                        continue
+
+                    backup = self.cal_lfa_path(sw, c2, dst_sw)
+                    n += 1
+                    if backup is None:
+                        sw.delete_entry("LFA_REP_tbl", [str(port), dst_sw.host.ip])
+                    else:
+                        mpls_path = list(map(str, self.build_mpls_path(backup[0])[::-1]))
+                        sw.set_entry("LFA_REP_tbl", [str(port), dst_sw.host.ip], f"lfa_replace_{len(mpls_path)}_hop", mpls_path)
+
+        logging.debug(f"Links {[(str(c1), str(c2)) for c1, c2 in links]} changed, recompute {n} backup paths")
+        return n
+
+    def lfa_via(self, dis: list, src: City, dst: City, c1: City, c2: City):
         """
-            This function is called periodically to check if we have to reroute.
+            The lower bound of the weight of the paths from src to dst over the link c1 <-> c2.
+        """
+        return min(dis[src][c1] + self.weights[c1][c2] + dis[c2][dst], dis[src][c2] + self.weights[c2][c1] + dis[c1][dst])
 
-            IMPORTANT: Sometimes this function is too slow to catch up with the real time flow.
+    def build_lfa_tables(self):
         """
-        def sub_cur_link_by_path(cur_links: list, path: list, spd: float):
-            for i in range(len(path) - 1):
-                cur_links[path[i]][path[i+1]] -= spd
+            Install the backup paths of all switches, so the switches reroute by themselves once a link fails.
 
-        def cal_average_capcacity(path: list, cur_links: list):
-            s = 0
-            for i in range(len(path) - 1):
-                s += cur_links[path[i]][path[i+1]]
+            Only the backup paths which changed are sent, see Switch.sync_table.
+        """
+        for sw in self.switches:
+            sw.sync_table("LFA_REP_tbl", self.cal_lfa_paths(sw))
 
-            return s / (len(path) - 1)
+    def has_failure(self, sw2: Switch, ports: list):
+        logging.debug(f"[{str(sw2)}]: Possible failures from {ports}")
+        self.router.link_down(sw2, ports)
 
-        cur_links = [ [ 0 for _ in range(16) ] for _ in range(16)]
+    def no_failure(self, sw2: Switch, ports: list):
+        self.router.link_up(sw2, ports)
 
+    def set_link_states(self, states: dict):
+        """
+            Apply the link states reported by the switches and update the routes once for all changed links.
+
+            `states` maps (switch, port) to True if the link is down. Return the links which changed.
+        """
+        links = []
+        for (sw2, port), down in states.items():
+            sw1 = sw2.sw_ports[port] # type: Switch
+            w = 0xFFFF if down else self.initial_weights[sw1.city][sw2.city]
+            if self.weights[sw1.city][sw2.city] == w:
+                continue
+
+            if down:
+                logging.debug(f"Get a failure from {str(sw1)} -> {str(sw2)} weights {self.weights[sw1.city][sw2.city]} {self.weights[sw2.city][sw1.city]}")
+            else:
+                logging.debug(f"Failure recovery from {str(sw1)} -> {str(sw2)} weights {self.weights[sw1.city][sw2.city]} {self.weights[sw2.city][sw1.city]}")
+            self.weights[sw1.city][sw2.city] = w
+            self.weights[sw2.city][sw1.city] = 0xFFFF if down else self.initial_weights[sw2.city][sw1.city]
+            links.append((sw1.city, sw2.city))
+
+        if len(links) == 0:
+            return links
+
+        # The switches already use the backup paths, see build_lfa_tables.
+        self.begin_batch()
+        for c1, c2 in self.update_paths(links):
+            self.build_mpls_from_to(c1, c2, self.best_paths[c1][c2])
+        # The flows pinned over a failed link follow their pairs until pin_elephants pins them again.
+        self.unpin([ fl for fl, p in self.pinned.items() if not self.path_alive(p) ])
+        self.flush_switches()
+
+        # The backup paths over the failed links are useless now and the recovered links may be used again.
+        self.begin_batch()
+        self.update_lfa_tables(links)
+        self.flush_switches()
+        #self.build_meter_table()
+        return links
+
+    def rt_flows(self, monitor: FlowPoller, flows: dict, interval: float):
+        """
+            This function is called periodically to check if we have to reroute.
+
+            The links status is a vector of the 256 links and each path is a row of the incidence matrices,
+            see incidence_matrix, so the capacity of all candidate paths is a single product.
+        """
+        if self.elephant_flows:
+            return self.pin_elephants(flows, interval)
+
+        cur_links = np.zeros(256)
         for c1 in self.weights:
             for c2 in self.weights[c1]:
-                cur_links[c1][c2] = 1e7
-                cur_links[c2][c1] = 1e7
+                cur_links[c1 * 16 + c2] = 1e7
+                cur_links[c2 * 16 + c1] = 1e7
 
-        cur_links_map = [ [ [] for _ in range(16) ] for _ in range(16)]
+        # The speed in bps of the flows which are not dropped, by pair of cities.
+        pair_spds = {}
         for src, fls in flows.items():
             for fl, spd in fls.items():
                 c1, _, c2, _, _ = fl
-                spd = (spd / interval) * 8
-                if c2 == src : # Make sure the flow is not dropped  
-                    sub_cur_link_by_path(cur_links, self.best_paths[c1][c2], spd)
+                if c2 == src : # Make sure the flow is not dropped
+                    pair_spds[(c1, c2)] = pair_spds.get((c1, c2), 0) + (spd / interval) * 8
 
-        
+        if len(pair_spds) == 0:
+            return
+
+        # The incidence vectors of the best paths, the multipath groups are weighted by their buckets.
+        pairs = list(pair_spds)
+        best_links = np.array([ self.pair_links(c1, c2) for c1, c2 in pairs ])
+
+        # Subtract all flows from their best paths at once.
+        spds = np.array([ pair_spds[pair] for pair in pairs ])
+        cur_links -= spds @ best_links
+
+        # A reroute moves all flows of the pair, so we decide for the total speed of the pair.
+        hops = best_links.sum(axis=1)
+        # The pairs with waypoints are never rerouted, the multipath groups are rebalanced instead.
+        free = np.array([ self.wps[c1][c2] is None and self.multipaths[c1][c2] is None for c1, c2 in pairs ])
+
+        i = 0
+        while i < len(pairs):
+            # The average capacity of the best paths with the flows of the pair restored, only the pairs
+            # below the threshold are checked. It is the same for the rest until the next reroute.
+            aver_capa = (best_links[i:] @ cur_links + spds[i:] * hops[i:]) / np.maximum(hops[i:], 1)
+            todo = np.flatnonzero(free[i:] & (aver_capa <= 7 * 1e6))
+            if len(todo) == 0:
+                break
+
+            j = i + todo[0]
+            c1, c2 = pairs[j]
+            # Restore current links status and then make decision
+            cur_links += spds[j] * best_links[j]
+            # The same sum as for the candidates, so the best path itself never looks better by a rounding error.
+            cur_average_capa = (best_links[j] @ cur_links) / max(hops[j], 1)
+            m = self.path_links[c1][c2]
+            aver = (m @ cur_links) / np.maximum(m.sum(axis=1), 1)
+            # If we find a route with more capcacity.
+            better = (aver > cur_average_capa) | (aver >= 9 * 1e6)
+            if better.any():
+                k = int(np.argmax(better))
+                p = self.paths[c1][c2][k][0]
+                # Do reroute
+                logging.debug(f"Reroute from {self.best_paths[c1][c2]} to {p} for cur={cur_average_capa} new={aver[k]}")
+                self.best_paths[c1][c2] = p
+                self.build_mpls_from_to(c1, c2, p)
+                best_links[j] = m[k]
+                hops[j] = m[k].sum()
+            # Then update the links status.
+            cur_links -= spds[j] * best_links[j]
+            i = j + 1
+
+        for j in np.flatnonzero(~free):
+            c1, c2 = pairs[j]
+            if self.multipaths[c1][c2] is not None:
+                self.rebalance_by_capacity(c1, c2, spds[j], cur_links)
+
+    def rebalance_by_capacity(self, c1: City, c2: City, spd: float, cur_links):
+        """
+            Weight the paths of the multipath group from c1 to c2 by their capacity if one of them is congested.
+
+            `cur_links` is the capacity left on the links with all flows, the `spd` bps of the group included.
+            It is updated with the new split. Only the buckets which changed are sent, see build_multipath_from_to.
+        """
+        members = self.multipaths[c1][c2]
+        m = self.incidence_matrix([ p for p, _ in members ])
+        shares = self.multipath_shares(members)
+        # The capacity of the bottleneck of each path without the flows of the group.
+        cur_links += spd * (shares @ m)
+        capa = np.where(m > 0, cur_links, np.inf).min(axis=1)
+
+        # Keep the split unless a path the group uses is left with less than 7Mbps, like a reroute, and the split
+        # by capacity leaves ECMP_REBALANCE_MARGIN more on the worst path, so the groups don't chase each other.
+        left = (capa - spd * shares)[shares > 0].min()
+        if left <= 7 * 1e6 and capa.max() > 0:
+            weights = [ float(c) for c in np.maximum(capa, 0) ]
+            new_shares = self.multipath_shares([ (p, w) for (p, _), w in zip(members, weights) ])
+            if (capa - spd * new_shares)[new_shares > 0].min() > left + ECMP_REBALANCE_MARGIN:
+                logging.debug(f"Rebalance {str(c1)} -> {str(c2)} from {list(shares)} to {list(new_shares)}")
+                self.rebalance_multipath(c1, c2, weights)
+                shares = new_shares
+
+        cur_links -= spd * (shares @ m)
+
+    def pin_elephants(self, flows: dict, interval: float):
+        """
+            Pin the `self.elephant_flows` largest flows to the paths with the most capacity, see flow_tbl in switch.p4.
+
+            The other flows stay on the paths of their pairs, or are spread over the multipath group of the pair by
+            its buckets. A pinned flow keeps its path unless another one has ELEPHANT_MARGIN more capacity on its
+            bottleneck, so the flows don't chase each other. The pins of the flows which are no longer among the
+            largest are removed.
+        """
+        cur_links = np.zeros(256)
+        for c1 in self.weights:
+            for c2 in self.weights[c1]:
+                cur_links[c1 * 16 + c2] = 1e7
+                cur_links[c2 * 16 + c1] = 1e7
+
+        # The speed in bps of the flows which are not dropped.
+        spds = {}
         for src, fls in flows.items():
             for fl, spd in fls.items():
-                c1, _, c2, _, _ = fl
-                spd = (spd / interval) * 8
-                if c2 == src : # Make sure the flow is not dropped  
-                    if self.wps[c1][c2] is None:
-                        # Restore current links status and then make decision
-                        sub_cur_link_by_path(cur_links, self.best_paths[c1][c2], -spd)
-                        cur_average_capa = cal_average_capcacity(self.best_paths[c1][c2], cur_links)
-                        for p, _ in self.paths[c1][c2]:
-                            aver = cal_average_capcacity(p, cur_links)
-                            # If we find a route with more capcacity.
-                            if cur_average_capa <= 7 * 1e6 and ( aver > cur_average_capa or aver >= 9 * 1e6 ):
-                                # Do reroute
-                                logging.debug(f"Reroute from {self.best_paths[c1][c2]} to {p} for cur={cur_average_capa} new={aver}")
-                                self.best_paths[c1][c2] = p
-                                self.build_mpls_from_to(c1, c2, p)
-                                break
-                        # Then update the links status.
-                        sub_cur_link_by_path(cur_links, self.best_paths[c1][c2], spd)
+                if fl[2] == src and fl[0] != fl[2]:
+                    spds[fl] = spds.get(fl, 0) + (spd / interval) * 8
+
+        def current_path(fl):
+            p = self.pinned.get(fl)
+            return p if p is not None and self.path_alive(p) else None
+
+        def current_row(fl):
+            p = current_path(fl)
+            return self.incidence_matrix([p])[0] if p is not None else self.pair_links(fl[0], fl[2])
+
+        # The links status with all flows on their current paths.
+        for fl, spd in spds.items():
+            cur_links -= spd * current_row(fl)
+
+        pinned = {}
+        for fl in sorted(spds, key=lambda fl: -spds[fl])[:self.elephant_flows]:
+            c1, _, c2, _, _ = fl
+            cur = current_path(fl)
+            cur_row = current_row(fl)
+            m = self.path_links[c1][c2]
+            if not cur_row.any() or m is None or len(m) == 0:
+                continue
+
+            # The capacity of the bottleneck of each path with the flow taken off its current path.
+            cur_links += spds[fl] * cur_row
+            target_city = self.wps[c1][c2]
+            capa = np.where(m > 0, cur_links, np.inf).min(axis=1)
+            capa[[ target_city is not None and target_city not in p for p, _ in self.paths[c1][c2] ]] = -np.inf
+            cur_capa = np.where(cur_row > 0, cur_links, np.inf).min()
+
+            k = int(np.argmax(capa))
+            p = cur
+            if capa[k] > cur_capa + ELEPHANT_MARGIN:
+                p = self.paths[c1][c2][k][0]
+                logging.debug(f"Pin flow {fl} from {cur} to {p} for cur={cur_capa} new={capa[k]}")
+
+            # An unpinned flow stays on the route of its pair.
+            cur_links -= spds[fl] * (cur_row if p is None else self.incidence_matrix([p])[0])
+            # The route of a multipath group may not be the best path, so we pin even to it.
+            if p is not None and (p != self.best_paths[c1][c2] or self.multipaths[c1][c2] is not None):
+                pinned[fl] = p
+
+        # Pin the flows on their source switches, only the changed pins are sent.
+        self.begin_batch()
+        for fl in list(self.pin_meters):
+            if fl not in pinned:
+                del self.pin_meters[fl]
+
+        desired = { sw.city : {} for sw in self.switches }
+        for fl, p in pinned.items():
+            mpls_path = tuple(map(str, self.build_mpls_path(p)[::-1]))
+            desired[fl[0]][(self.pin_keys(fl), 0)] = (f"pin_{len(mpls_path)}_hop", (str(self.pin_meter(fl)),) + mpls_path)
+
+        for sw in self.switches:
+            sw.sync_table("flow_tbl", desired[sw.city])
+        self.flush_switches()
+        self.pinned = pinned
+
+    def pin_meter(self, fl: tuple):
+        """
+            The pin_meter cell of the pinned flow. A flow keeps its cell while it is pinned.
+
+            The cells are rate limited like the FEC_tbl entries, see fec_meter. The rates are the same for all
+            cells, so they are only set the first time a cell is used.
+        """
+        if fl not in self.pin_meters:
+            sw = self.switches[fl[0]]
+            used = set( i for f, i in self.pin_meters.items() if f[0] == fl[0] )
+            index = next( i for i in range(FLOW_PINS) if i not in used )
+            if index not in self.pin_meters_ready[sw.city]:
+                rates = sw.get_meter_rates_from_bw(0.00085, 1600, 0.00085, 1600)
+                sw.call(sw.controller.meter_set_rates, ('pin_meter', index, rates))
+                self.pin_meters_ready[sw.city].add(index)
+            self.pin_meters[fl] = index
+
+        return self.pin_meters[fl]
+
+    def pin_keys(self, fl: tuple):
+        """
+            The flow_tbl match keys of the flow (src_city, sport, dst_city, dport, proto).
+        """
+        c1, sport, c2, dport, proto = fl
+        return (self.switches[c1].host.ip, self.switches[c2].host.ip, str(sport), str(dport), str(IP_PROTOCOLS[proto]))
+
+    def unpin(self, flows: list):
+        """
+            Remove the pins of the flows, they follow the routes of their pairs until pin_elephants pins them again.
+        """
+        for fl in flows:
+            self.switches[fl[0]].delete_entry("flow_tbl", list(self.pin_keys(fl)))
+            del self.pinned[fl]
+            self.pin_meters.pop(fl, None)
 
     def start_monitor(self):
         """
             This function starts all monitors
         """
-        ts = []
+        # All route changes go through the routing worker.
+        ts = [self.router]
+        if self.reference_time:
+            ts.append(DemandScheduler([ t for t in self.timeline if t > self.demands_time ], self.reference_time, self.router.demands))
         #ts.append(LinkMonitor(self.rt_speed, 0.5))
-        ts.append(FlowMonitor(self.switches, self.rt_flows, 0.5))
-
-        for i in range(16):
-            c1 = City(i)
-            s1 = self.switches[c1]
+        ts.append(FlowPoller(self.switches, self.router.flows, 0.5))
 
-            for c2 in s1.sw_links:
-                s2 = self.switches[c2]
+        ts.append(HeartbeatSender(self.switches, 0.3))
 
-                if c1 < c2:
-                    ts.append(Ping(s1, s2, 0.3))
-                    ts.append(Ping(s2, s1, 0.3))
-                    pass
-        
-        for i in range(16):
-            ts.append(Pong(self.switches[i], 0.8, self.has_failure, self.no_failure))
+        # Two heartbeats are lost before a failure.
+        ts.append(LinkListener(self.switches, 0.7, self.router.link_down, self.router.link_up))
         
         for t in ts:
             t.start()
@@ -1181,14 +2679,32 @@ def get_args():
                         type=str, required=False, default='')
     parser.add_argument('--slas', help='SLA',
     type=str, required=False, default='')
+    parser.add_argument('--fake-topo', help='Program fake switches of the topology built by fake_switch.py and exit',
+                        type=str, required=False, default='')
+    parser.add_argument('--reference-time', help='The unix time the simulation starts, to reserve capacity for the base flows only while they are active',
+                        type=float, required=False, default=0)
+    parser.add_argument('--elephant-flows', help='Pin the N largest flows to paths one by one instead of rerouting pairs of cities',
+                        type=int, required=False, default=0)
+    parser.add_argument('--profile', help='Write the timing of the startup to the json file',
+                        type=str, nargs='?', const='profile.json', default='')
+    parser.add_argument('--fake-latency', help='The latency of each RPC to the fake switches in seconds',
+                        type=float, required=False, default=0.001)
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = get_args()
     try:
-        controller = Controller(args.base_traffic, args.slas)
-        controller.main()
+        if args.fake_topo:
+            from fake_switch import FakeTopology, fake_switch_api
+            start = time.time()
+            controller = Controller(args.base_traffic, args.slas, FakeTopology(args.fake_topo),
+                                    fake_switch_api(args.fake_latency), args.profile)
+            logging.info(f"Programmed fake switches in {time.time() - start:.3f}s")
+        else:
+            controller = Controller(args.base_traffic, args.slas, profile=args.profile, reference_time=args.reference_time,
+                                    elephant_flows=args.elephant_flows)
+            controller.main()
     except KeyboardInterrupt:
         exit(0)
     except Exception as e:
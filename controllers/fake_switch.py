@@ -0,0 +1,267 @@
+"""
+    An offline stand-in for the bmv2 switches, so the controller runs without Mininet.
+
+    FakeSwitchAPI implements the subset of SimpleSwitchThriftAPI the controller uses and FakeTopology the subset
+    of the p4utils topology. The topology.json is built from project/cities.txt and project/links.txt with
+    build_topology, like p4run does.
+
+    Usage:
+        python controllers/fake_switch.py --out fake_topology.json [--links inputs/00_baseline.links]
+        python controllers/controller.py --base-traffic ... --slas ... --fake-topo fake_topology.json
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from advnet_utils.get_city_info import Delay, get_cities, get_city_short_name
+from advnet_utils.input_parsers import parse_additional_links, parse_links
+
+cur_dir = os.path.dirname(os.path.abspath(__file__)) + "/"
+
+# The first thrift port, the switch i listens on THRIFT_PORT + i.
+THRIFT_PORT = 9090
+
+
+def load_registers(p4_file: str):
+    """
+        Parse the register declarations of the P4 program, return the size of each register.
+    """
+    with open(p4_file, "r") as f:
+        src = f.read()
+
+    defines = dict(re.findall(r"^#define\s+(\w+)\s+(\d+)\s*$", src, re.M))
+    registers = {}
+    for size, name in re.findall(r"^register<bit<\d+>>\((\w+)\)\s+(\w+);", src, re.M):
+        registers[name] = int(defines.get(size, size))
+
+    return registers
+
+
+class FakeSwitchError(Exception):
+    pass
+
+
+class FakeMgmtInfo:
+    def __init__(self, notifications_socket: str):
+        self.notifications_socket = notifications_socket
+
+
+# The raw Thrift client, see SimpleSwitchThriftAPI.client
+class FakeClient:
+
+    def __init__(self, api):
+        self.api = api
+
+    def bm_mgmt_get_info(self):
+        self.api.rpc("bm_mgmt_get_info")
+        # Nobody publishes on it, so the digests never come.
+        return FakeMgmtInfo(f"ipc:///tmp/fake-bmv2-{self.api.thrift_port}-notifications.ipc")
+
+    def bm_learning_set_buffer_size(self, cxt_id, list_id, nb_samples):
+        self.api.rpc("bm_learning_set_buffer_size")
+
+    def bm_learning_ack_buffer(self, cxt_id, list_id, buffer_id):
+        self.api.rpc("bm_learning_ack_buffer")
+
+
+class FakeSwitchAPI:
+    """
+        The subset of SimpleSwitchThriftAPI used by the controller.
+
+        Each call takes `latency` seconds and the calls to a switch are served one by one, like a Thrift server
+        with a single connection. The bad table operations are logged and return None like p4utils does.
+    """
+
+    def __init__(self, thrift_port: int, latency=0.001, p4_file=cur_dir + "../p4src/switch.p4"):
+        self.thrift_port = thrift_port
+        self.latency = latency
+        self.register_sizes = load_registers(p4_file)
+        self.client = FakeClient(self)
+        # The calls of each method.
+        self.rpcs = Counter()
+        self.lock = threading.Lock()
+        self.clear()
+
+    def rpc(self, name: str):
+        with self.lock:
+            self.rpcs[name] += 1
+            if self.latency > 0:
+                time.sleep(self.latency)
+
+    def reset_state(self):
+        self.rpc("reset_state")
+        self.clear()
+
+    def clear(self):
+        # table name -> { handle : [match keys, action name, action params, prio] }
+        self.tables = {}
+        self.defaults = {}
+        self.meters = {}
+        self.next_handle = 0
+        self.registers = { name : [0 for _ in range(size)] for name, size in self.register_sizes.items() }
+
+    def table_add(self, table_name: str, action_name: str, match_keys: list, action_params=[], prio=0):
+        self.rpc("table_add")
+        entries = self.tables.setdefault(table_name, {})
+        for keys, _, _, p in entries.values():
+            if keys == list(match_keys) and p == prio:
+                logging.error(f"[fake {self.thrift_port}] Invalid table operation (DUPLICATE_ENTRY) {table_name} {match_keys}")
+                return None
+
+        hdl = self.next_handle
+        self.next_handle += 1
+        entries[hdl] = [list(match_keys), action_name, list(action_params), prio]
+        return hdl
+
+    def table_modify(self, table_name: str, action_name: str, entry_handle: int, action_params=[]):
+        self.rpc("table_modify")
+        entry = self.tables.get(table_name, {}).get(entry_handle)
+        if entry is None:
+            logging.error(f"[fake {self.thrift_port}] Invalid table operation (INVALID_HANDLE) {table_name} {entry_handle}")
+            return None
+
+        entry[1], entry[2] = action_name, list(action_params)
+        return entry_handle
+
+    def table_delete(self, table_name: str, entry_handle: int):
+        self.rpc("table_delete")
+        if self.tables.get(table_name, {}).pop(entry_handle, None) is None:
+            logging.error(f"[fake {self.thrift_port}] Invalid table operation (INVALID_HANDLE) {table_name} {entry_handle}")
+
+    def table_set_default(self, table_name: str, action_name: str, action_params=[]):
+        self.rpc("table_set_default")
+        self.defaults[table_name] = (action_name, list(action_params))
+
+    def meter_set_rates(self, meter_name: str, index: int, rates: list):
+        self.rpc("meter_set_rates")
+        self.meters[(meter_name, index)] = list(rates)
+
+    def register_read(self, register_name: str, index=None, show=False):
+        self.rpc("register_read")
+        if register_name not in self.registers:
+            raise FakeSwitchError(f"Unknown register {register_name}")
+
+        if index is None:
+            return list(self.registers[register_name])
+        return self.registers[register_name][index]
+
+    def register_write(self, register_name: str, index: int, value: int):
+        self.rpc("register_write")
+        if register_name not in self.registers:
+            raise FakeSwitchError(f"Unknown register {register_name}")
+
+        self.registers[register_name][index] = value
+
+
+def fake_switch_api(latency=0.001):
+    """
+        Return the `switch_api` of the controller for the fake switches.
+
+        The connections to the same thrift port share a fake switch, like the connections to a bmv2 switch.
+    """
+    switches = {}
+
+    def connect(thrift_port: int):
+        if thrift_port not in switches:
+            switches[thrift_port] = FakeSwitchAPI(thrift_port, latency)
+        return switches[thrift_port]
+
+    return connect
+
+
+class FakeTopology:
+    """
+        The subset of the p4utils topology used by the controller, loaded from the output of build_topology.
+
+        The output can be given directly as `graph` too.
+    """
+
+    def __init__(self, topo_file: str = None, graph: dict = None):
+        if graph is None:
+            with open(topo_file, "r") as f:
+                graph = json.load(f)
+        self.graph = graph
+        self.nodes = { node["id"] : node for node in self.graph["nodes"] }
+
+    def get_p4switches(self):
+        return { name : node for name, node in self.nodes.items() if node.get("isP4Switch", False) }
+
+    def get_thrift_port(self, name: str):
+        return self.nodes[name]["thrift_port"]
+
+    def get_node_intfs(self):
+        intfs = { name : {} for name in self.nodes }
+        for link in self.graph["links"]:
+            attrs = { k : v for k, v in link.items() if not k[-1] in "12" and k not in ("source", "target") }
+            for a, b in (("1", "2"), ("2", "1")):
+                intf = dict(attrs)
+                for k in ("node", "intfName", "port", "addr", "ip"):
+                    intf[k] = link[k + a]
+                    intf[k + "_neigh"] = link[k + b]
+                intfs[link["node" + a]][link["intfName" + a]] = intf
+
+        return intfs
+
+
+def build_topology(topology_path=cur_dir + "../project/", links_file=None):
+    """
+        Build the topology in the node-link json format of p4utils, see build_base_topology in advnet_utils.
+
+        The host of each switch is on port 1, the links to other switches follow in the order of links.txt
+        and then `links_file`.
+    """
+    delays = Delay(topology_path)
+    switches = [ get_city_short_name(city) for city in get_cities(topology_path + "cities.txt") ]
+
+    nodes = []
+    links = []
+    ports = {}
+
+    def add_link(node1: str, node2: str, **params):
+        ends = {}
+        for i, node in (("1", node1), ("2", node2)):
+            ports[node] = ports.get(node, 0) + 1
+            ends["node" + i] = node
+            ends["port" + i] = ports[node]
+            ends["intfName" + i] = f"{node}-eth{ports[node]}"
+            ends["addr" + i] = "00:00:{:02x}:{:02x}:{:02x}:{:02x}".format(0x0a, len(links) >> 8, len(links) & 0xFF, int(i))
+            ends["ip" + i] = None
+        links.append(dict(source=node1, target=node2, **ends, **params))
+        return links[-1]
+
+    for i, sw in enumerate(switches):
+        nodes.append({ "id" : sw, "isP4Switch" : True, "isSwitch" : True, "thrift_port" : THRIFT_PORT + i, "device_id" : i })
+        host = f"{sw}_h0"
+        nodes.append({ "id" : host, "isHost" : True })
+        link = add_link(host, sw)
+        link["ip1"] = f"10.{i + 1}.1.2/24"
+        link["ip2"] = f"10.{i + 1}.1.1/24"
+
+    all_links = [ (src, dst, bw) for src, dst, bw in parse_links(topology_path + "links.txt") ]
+    if links_file is not None:
+        all_links += [ (src, dst, bw) for (src, dst), bw in parse_additional_links(links_file) ]
+
+    for src, dst, bw in all_links:
+        add_link(src, dst, bw=float(bw), delay="{}ms".format(delays.get_delay(src, dst)))
+
+    return { "directed" : False, "multigraph" : False, "graph" : {}, "nodes" : nodes, "links" : links }
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', help='Path to the topology json',
+                        type=str, required=False, default='fake_topology.json')
+    parser.add_argument('--links', help='Path to the additional links',
+                        type=str, required=False, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    with open(args.out, "w") as f:
+        json.dump(build_topology(links_file=args.links), f, indent=2)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The controller and the fake switches are scripts in controllers/, not a package.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,569 @@
+"""
+    Regression tests of the controller.
+
+    Usage:
+        python -m pytest controllers/tests
+"""
+import ipaddress
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+import pytest
+
+# The controller imports the p4utils, thrift and nnpy of the VM.
+for module in ["numpy", "psutil", "nnpy", "p4utils", "thrift", "advnet_utils"]:
+    pytest.importorskip(module)
+
+from advnet_utils.get_city_info import Delay
+from advnet_utils.input_parsers import parse_links
+
+import controller as C
+from fake_switch import FakeTopology, build_topology, fake_switch_api
+
+project_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../project/")
+inputs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../inputs/")
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# Links added to the topology of project/links.txt, so the cities have more paths.
+EXTRA_LINKS = [("LIS", "MAN"), ("LIS", "BER"), ("MAD", "FRA"), ("GLO", "AMS"), ("POR", "REN"), ("MUN", "LIL")]
+
+
+def make_weights(extra=()):
+    """
+        Return a controller with only the weights of the links, the delays like build_topo.
+    """
+    c = C.Controller.__new__(C.Controller)
+    c.paths_evaluated = 0
+    c.weights = { C.City(i) : {} for i in range(16) }
+    delays = Delay(project_dir)
+    links = [ (src, dst) for src, dst, _ in parse_links(project_dir + "links.txt") ] + list(extra)
+    for src, dst in links:
+        w = float(delays.get_delay(src, dst))
+        c.weights[C.city_maps[src]][C.city_maps[dst]] = w
+        c.weights[C.city_maps[dst]][C.city_maps[src]] = w
+
+    return c
+
+
+def path_weight(c, path):
+    return sum(c.weights[path[i]][path[i+1]] for i in range(len(path) - 1))
+
+
+@pytest.mark.parametrize("extra", [0, 3, len(EXTRA_LINKS)])
+def test_k_shortest_paths_match_networkx(extra):
+    nx = pytest.importorskip("networkx")
+    c = make_weights(EXTRA_LINKS[:extra])
+
+    g = nx.Graph()
+    for c1, neighbours in c.weights.items():
+        for c2, w in neighbours.items():
+            if w != 0xFFFF:
+                g.add_edge(c1, c2, weight=w)
+
+    for src, dst in itertools.permutations(map(C.City, range(16)), 2):
+        got = c.cal_k_shortest_paths(src, dst)
+
+        # networkx has no hop limit, skip the paths which don't fit in the MPLS stack.
+        expected = []
+        for p in nx.shortest_simple_paths(g, src, dst, weight="weight"):
+            if len(p) - 1 <= C.CONST_MAX_HOPS:
+                expected.append(path_weight(c, p))
+            if len(expected) == C.K_SHORTEST_PATHS:
+                break
+
+        # Paths of the same weight may come in any order, compare the weights.
+        assert [ w for _, w in got ] == pytest.approx(expected), (str(src), str(dst))
+        assert len(set(p for p, _ in got)) == len(got)
+        for p, w in got:
+            assert p[0] == src and p[-1] == dst
+            assert len(set(p)) == len(p) and len(p) - 1 <= C.CONST_MAX_HOPS
+            assert w == pytest.approx(path_weight(c, p))
+
+
+def make_paths(extra=()):
+    """
+        Return a controller with the weights, the paths and the best paths, the shortest paths without demands.
+    """
+    c = make_weights(extra)
+    c.paths = c.cal_paths()
+    c.link_pairs = c.index_paths(c.paths)
+    c.path_links = [ [ c.incidence_matrix([ p for p, _ in ps ]) for ps in row ] for row in c.paths ]
+    c.wps = [ [ None for __ in range(16) ] for _ in range(16) ]
+    c.reservations = [ [ 0 for __ in range(16) ] for _ in range(16) ]
+    c.best_paths = [ [ ps[0][0] if len(ps) != 0 else () for ps in row ] for row in c.paths ]
+    c.multipath_pairs = set()
+    c.multipaths = [ [ None for __ in range(16) ] for _ in range(16) ]
+    c.elephant_flows = 0
+    c.pinned = {}
+    c.initial_weights = { c1 : dict(ws) for c1, ws in c.weights.items() }
+    return c
+
+
+def links_of(c):
+    return sorted(set( tuple(sorted((c1, c2))) for c1, ws in c.weights.items() for c2 in ws ))
+
+
+def set_links(c, links: list, down: bool):
+    for c1, c2 in links:
+        c.weights[c1][c2] = 0xFFFF if down else c.initial_weights[c1][c2]
+        c.weights[c2][c1] = 0xFFFF if down else c.initial_weights[c2][c1]
+    c.update_paths(links)
+
+
+def assert_paths_recomputed(c):
+    full = c.cal_paths()
+    for i, j in itertools.permutations(range(16), 2):
+        assert [ w for _, w in c.paths[i][j] ] == pytest.approx([ w for _, w in full[i][j] ]), (str(C.City(i)), str(C.City(j)))
+        assert all(w < 0xFFFF for _, w in c.paths[i][j])
+        best_path = c.best_paths[i][j]
+        assert best_path == () or best_path in [ p for p, _ in c.paths[i][j] ]
+
+    # The reverse index must not keep the pairs of removed paths.
+    index = { l : pairs for l, pairs in c.index_paths(c.paths).items() if len(pairs) != 0 }
+    assert { l : pairs for l, pairs in c.link_pairs.items() if len(pairs) != 0 } == index
+
+
+@pytest.mark.parametrize("extra", [0, len(EXTRA_LINKS)])
+def test_update_paths_matches_full_recompute(extra):
+    c = make_paths(EXTRA_LINKS[:extra])
+    links = links_of(c)
+
+    # Fail and recover some links one by one, then two together.
+    for link in links[::3]:
+        set_links(c, [link], True)
+        assert_paths_recomputed(c)
+        set_links(c, [link], False)
+        assert_paths_recomputed(c)
+
+    set_links(c, links[1:3], True)
+    assert_paths_recomputed(c)
+    set_links(c, links[1:3], False)
+    assert_paths_recomputed(c)
+
+
+class RecordingAPI:
+    """
+        Records the table operations sent to a switch, each takes `latency` seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.threads = set()
+
+    def _call(self, name, *args):
+        time.sleep(self.latency)
+        self.calls.append((name,) + args)
+        self.threads.add(threading.get_ident())
+        return len(self.calls)
+
+    def table_add(self, *args):
+        return self._call("table_add", *args)
+
+    def table_modify(self, *args):
+        return self._call("table_modify", *args)
+
+    def table_delete(self, *args):
+        return self._call("table_delete", *args)
+
+    def table_set_default(self, *args):
+        return self._call("table_set_default", *args)
+
+
+def make_switches(latency=0.0):
+    """
+        Return a controller with the switches only, programmed through RecordingAPI.
+    """
+    c = C.Controller.__new__(C.Controller)
+    c.switches = [ C.Switch(C.City(i)) for i in range(16) ]
+    for sw in c.switches:
+        sw.controller = RecordingAPI(latency)
+    c.executor = C.ThreadPoolExecutor(max_workers=16)
+    return c
+
+
+def test_batch_runs_in_order_on_flush():
+    c = make_switches(latency=0.02)
+    handles = {}
+
+    c.begin_batch()
+    for sw in c.switches:
+        for k in range(3):
+            sw.table_add("FEC_tbl", "mpls_ingress_1_hop", [str(k)], ["2"], callback=lambda hdl, key=(sw.city, k): handles.__setitem__(key, hdl))
+        sw.table_set_default("FEC_tbl", "drop")
+
+    # Nothing is sent before the flush.
+    assert all(len(sw.controller.calls) == 0 for sw in c.switches)
+    assert len(handles) == 0
+
+    start = time.time()
+    c.flush_switches()
+    elapsed = time.time() - start
+
+    for sw in c.switches:
+        # The operations of a switch run in order and the callbacks get the handles.
+        assert [ call[0] for call in sw.controller.calls ] == ["table_add"] * 3 + ["table_set_default"]
+        assert [ call[3] for call in sw.controller.calls[:3] ] == [["0"], ["1"], ["2"]]
+        assert sw.controller.calls[3] == ("table_set_default", "FEC_tbl", "drop", [])
+        assert [ handles[(sw.city, k)] for k in range(3) ] == [1, 2, 3]
+
+    # The switches are programmed concurrently, 16 * 4 calls one by one take 1.28s.
+    assert len(set().union(*(sw.controller.threads for sw in c.switches))) > 1
+    assert elapsed < 16 * 4 * 0.02 / 2
+
+    # The batch is over, the operations are sent right away again.
+    c.switches[0].table_add("FEC_tbl", "drop", ["3"], [])
+    assert len(c.switches[0].controller.calls) == 5
+    c.executor.shutdown()
+
+
+def test_shadow_tables_send_only_changes():
+    c = make_switches()
+    sw = c.switches[0]
+    api = sw.controller
+    desired = { (("1", "10.2.1.2"), 0) : ("lfa_replace_1_hop", ("2",)),
+                (("1", "10.3.1.2"), 0) : ("lfa_replace_2_hop", ("3", "2")),
+                (("2", "10.3.1.2"), 0) : ("lfa_replace_1_hop", ("4",)) }
+
+    c.begin_batch()
+    assert sw.sync_table("LFA_REP_tbl", desired) == 3
+    c.flush_switches()
+    assert [ call[0] for call in api.calls ] == ["table_add"] * 3
+    handles = { key : entry[2] for key, entry in sw.tables["LFA_REP_tbl"].items() }
+    assert sorted(handles.values()) == [1, 2, 3]
+
+    # The same entries again, nothing is sent.
+    assert sw.sync_table("LFA_REP_tbl", desired) == 0
+    assert sw.set_entry("LFA_REP_tbl", ["1", "10.2.1.2"], "lfa_replace_1_hop", ["2"]) is False
+    assert len(api.calls) == 3
+    assert sw.rpc_saved == 4
+
+    # A changed action is modified on its handle, a missing entry is deleted on its handle.
+    desired[(("1", "10.3.1.2"), 0)] = ("lfa_replace_1_hop", ("5",))
+    del desired[(("2", "10.3.1.2"), 0)]
+    c.begin_batch()
+    assert sw.sync_table("LFA_REP_tbl", desired) == 2
+    c.flush_switches()
+    assert sorted(api.calls[3:]) == sorted([ ("table_modify", "LFA_REP_tbl", "lfa_replace_1_hop", handles[(("1", "10.3.1.2"), 0)], ["5"]),
+                                             ("table_delete", "LFA_REP_tbl", handles[(("2", "10.3.1.2"), 0)]) ])
+    assert { key : (entry[0], entry[1]) for key, entry in sw.tables["LFA_REP_tbl"].items() } == desired
+    assert sw.rpc_calls == len(api.calls) == 5
+    c.executor.shutdown()
+
+
+def rt_flows_loop(c, flows: dict, interval: float):
+    """
+        The rt_flows before it was vectorized, on lists of the links. Return the new best paths.
+    """
+    best_paths = [ list(row) for row in c.best_paths ]
+
+    def sub_cur_link_by_path(cur_links: list, path: list, spd: float):
+        for i in range(len(path) - 1):
+            cur_links[path[i]][path[i+1]] -= spd
+
+    def cal_average_capcacity(path: list, cur_links: list):
+        return sum(cur_links[path[i]][path[i+1]] for i in range(len(path) - 1)) / (len(path) - 1)
+
+    cur_links = [ [ 0 for _ in range(16) ] for _ in range(16) ]
+    for c1 in c.weights:
+        for c2 in c.weights[c1]:
+            cur_links[c1][c2] = 1e7
+            cur_links[c2][c1] = 1e7
+
+    for src, fls in flows.items():
+        for (c1, _, c2, _, _), spd in fls.items():
+            if c2 == src:
+                sub_cur_link_by_path(cur_links, best_paths[c1][c2], (spd / interval) * 8)
+
+    for src, fls in flows.items():
+        for (c1, _, c2, _, _), spd in fls.items():
+            spd = (spd / interval) * 8
+            if c2 != src or c.wps[c1][c2] is not None:
+                continue
+            sub_cur_link_by_path(cur_links, best_paths[c1][c2], -spd)
+            cur_average_capa = cal_average_capcacity(best_paths[c1][c2], cur_links)
+            for p, _ in c.paths[c1][c2]:
+                aver = cal_average_capcacity(p, cur_links)
+                if cur_average_capa <= 7 * 1e6 and (aver > cur_average_capa or aver >= 9 * 1e6):
+                    best_paths[c1][c2] = p
+                    break
+            sub_cur_link_by_path(cur_links, best_paths[c1][c2], spd)
+
+    return best_paths
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rt_flows_matches_loop(seed):
+    rng = random.Random(seed)
+    c = make_paths(EXTRA_LINKS)
+    # Some pairs keep their waypoint path.
+    for _ in range(5):
+        c1, c2 = rng.sample(range(16), 2)
+        c.wps[c1][c2] = c.best_paths[c1][c2][1] if len(c.best_paths[c1][c2]) > 2 else None
+    rerouted = []
+    c.build_mpls_from_to = lambda c1, c2, p: rerouted.append((c1, c2, p))
+
+    # One flow per pair, a reroute moves the whole pair. The flows are seen by their destination switch.
+    interval = 0.5
+    flows = { C.City(i) : {} for i in range(16) }
+    for c1, c2 in rng.sample(list(itertools.permutations(map(C.City, range(16)), 2)), 60):
+        flows[c2][(c1, 5000, c2, 5001, "udp")] = rng.uniform(1e5, 4e5)
+    # Flows seen by another switch on the way are not counted.
+    flows[C.City(0)][(C.City(1), 5000, C.City(2), 5001, "udp")] = 1e6
+
+    expected = rt_flows_loop(c, flows, interval)
+    c.rt_flows(None, flows, interval)
+
+    assert [ list(row) for row in c.best_paths ] == expected
+    assert len(rerouted) != 0
+    assert all(c.best_paths[c1][c2] == p for c1, c2, p in rerouted)
+
+
+def test_subscribe_rejects_unchecked_ports():
+    sw = C.Switch(C.City.AMS)
+    sw.monitor = RecordingAPI()
+    sw.monitor.register_write = lambda *args: sw.monitor._call("register_write", *args)
+    sw.sw_ports = { p: None for p in (1, C.N_PORTS) }
+    listener = C.LinkListener([sw], 0.7, None, None)
+
+    # The switch only checks the first N_PORTS ports, so the failures of the others would never be reported.
+    with pytest.raises(ValueError):
+        listener.subscribe(sw)
+    assert sw.monitor.calls == []
+
+
+def make_network(extra=()):
+    """
+        Return a controller with the paths of make_paths and the switches of make_switches linked like the weights.
+    """
+    c = make_paths(extra)
+    net = make_switches()
+    c.switches, c.executor = net.switches, net.executor
+    for sw in c.switches:
+        sw.host.lpm = f"10.{sw.city + 1}.1.2/24"
+        for port, c2 in enumerate(sorted(c.weights[sw.city]), start=2):
+            sw.sw_links[c2] = { "port" : port, "mac" : None, "sw" : c.switches[c2] }
+            sw.sw_ports[port] = c.switches[c2]
+    c.lfa_paths = {}
+    return c
+
+
+def assert_lfa_recomputed(c):
+    for sw in c.switches:
+        installed = sw.tables.get("LFA_REP_tbl", {})
+        for c2, link in sw.sw_links.items():
+            for dst_sw in c.switches:
+                if dst_sw.city == sw.city:
+                    continue
+
+                full = c.shortest_path(sw.city, dst_sw.city, banned_edges={(sw.city, c2)})
+                backup = c.lfa_paths[(sw.city, c2, dst_sw.city)]
+                entry = installed.get(((str(link["port"]), dst_sw.host.ip), 0))
+                if full is None:
+                    assert backup is None and entry is None
+                    continue
+
+                # The paths may differ on ties, but the installed entry must be the remembered path.
+                assert backup[1] == pytest.approx(full[1]), (str(sw), str(c2), str(dst_sw))
+                assert all(c.weights[backup[0][i]][backup[0][i+1]] != 0xFFFF for i in range(len(backup[0]) - 1))
+                assert entry[1] == tuple(map(str, c.build_mpls_path(backup[0])[::-1]))
+
+
+@pytest.mark.parametrize("extra", [0, len(EXTRA_LINKS)])
+def test_update_lfa_tables_matches_cal_lfa_path(extra):
+    c = make_network(EXTRA_LINKS[:extra])
+    c.build_lfa_tables()
+    assert_lfa_recomputed(c)
+    total = len(c.lfa_paths)
+
+    for link in links_of(c)[::2]:
+        set_links(c, [link], True)
+        assert c.update_lfa_tables([link]) < total
+        assert_lfa_recomputed(c)
+        set_links(c, [link], False)
+        assert c.update_lfa_tables([link]) < total
+        assert_lfa_recomputed(c)
+    c.executor.shutdown()
+
+
+def sla_allows(rules, port: int, ip, sport: int, dport: int):
+    return any( p == port and ip in net and sl <= sport <= sr and dl <= dport <= dr
+                for p, net, (sl, sr), (dl, dr) in rules )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sla_compression_matches_expanded_rules(seed):
+    rng = random.Random(seed)
+    c = C.Controller.__new__(C.Controller)
+    all_nets = set( ipaddress.ip_network(f"10.{i}.1.0/24") for i in range(1, 16) )
+
+    # Few distinct ranges, so the rules overlap, touch and share networks like the sla rules of a switch.
+    bounds = [1, 100, 101, 102, 200, 300, 301, 400, 60000, 65535]
+    ranges = [ (l, r) for l in bounds for r in bounds if l <= r ]
+    rules = set()
+    for _ in range(60):
+        port = rng.choice([1, 2])
+        nets = rng.sample(sorted(all_nets), rng.choice([1, 2, 15]))
+        srange, drange = rng.choice(ranges), rng.choice(ranges)
+        rules |= set( (port, net, srange, drange) for net in nets )
+
+    entries = c.compile_sla_rules(rules, all_nets)
+    assert len(entries) <= len(rules)
+    # The entries are all NoAction, each with its own priority.
+    assert all( action == ("NoAction", ()) for action in entries.values() )
+    assert len(set( prio for _, prio in entries )) == len(entries)
+
+    compiled = []
+    for (port, net, srange, drange), _ in entries:
+        compiled.append((int(port), ipaddress.ip_network(net), tuple(map(int, srange.split("->"))), tuple(map(int, drange.split("->")))))
+
+    # The hosts are the only destinations, so only their addresses are checked.
+    ports = sorted(set( x + d for l, r in ranges for x in (l, r) for d in (-1, 0, 1) if 0 <= x + d <= 65535 ))
+    for port in [1, 2, 3]:
+        for net in all_nets:
+            ip = net[5]
+            for _ in range(200):
+                sport, dport = rng.choice(ports), rng.choice(ports)
+                assert sla_allows(compiled, port, ip, sport, dport) == sla_allows(rules, port, ip, sport, dport), \
+                    (port, str(ip), sport, dport)
+
+
+def max_utilization(c, demands: dict, paths: dict):
+    # A link is shared by both directions, like links_capacity.
+    load = {}
+    for pair, path in paths.items():
+        for i in range(len(path) - 1):
+            link = frozenset((path[i], path[i+1]))
+            load[link] = load.get(link, 0) + demands[pair]
+    return max(l / c.initial_links_capacity[min(link)][max(link)] for link, l in load.items())
+
+
+def make_te(extra=()):
+    c = make_paths(extra)
+    c.initial_links_capacity = [ [ 1e7 if C.City(j) in c.weights[C.City(i)] else 0 for j in range(16) ] for i in range(16) ]
+    return c
+
+
+def random_demands(c, rng, util: float):
+    """
+        Return random demands of 60 pairs and their candidates, scaled so the shortest paths reach `util`.
+    """
+    pairs = rng.sample([ (C.City(i), C.City(j)) for i, j in itertools.permutations(range(16), 2) ], 60)
+    candidates = { pair : list(range(len(c.paths[pair[0]][pair[1]]))) for pair in pairs }
+    demands = { pair : rng.uniform(1, 10) for pair in pairs }
+    scale = util / max_utilization(c, demands, { pair : c.paths[pair[0]][pair[1]][0][0] for pair in pairs })
+    return { pair : d * scale for pair, d in demands.items() }, candidates
+
+
+def placed_paths(c, choice: dict):
+    return { pair : c.paths[pair[0]][pair[1]][k][0] for pair, k in choice.items() }
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_solve_te_keeps_shortest_paths_below_max_utilization(seed):
+    c = make_te(EXTRA_LINKS)
+    demands, candidates = random_demands(c, random.Random(seed), C.TE_MAX_UTIL - 0.05)
+
+    assert c.solve_te(demands, candidates) == { pair : ks[0] for pair, ks in candidates.items() }
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_solve_te_lowers_max_utilization(seed):
+    c = make_te(EXTRA_LINKS)
+    demands, candidates = random_demands(c, random.Random(seed), 1.2)
+
+    choice = c.solve_te(demands, candidates)
+    assert all(choice[pair] in candidates[pair] for pair in demands)
+    assert max_utilization(c, demands, placed_paths(c, choice)) < 1.2
+
+
+def test_solve_te_moves_pairs_below_max_utilization():
+    c = make_te(EXTRA_LINKS)
+    link_set = lambda path: { frozenset(l) for l in zip(path, path[1:]) }
+
+    # Both directions of a pair on the shortest path use 100% of its links, but the reverse pair has a
+    # path sharing no link with it.
+    for c1, c2 in itertools.permutations(map(C.City, range(16)), 2):
+        shortest = link_set(c.paths[c1][c2][0][0])
+        ks = [ k for k, (p, _) in enumerate(c.paths[c2][c1]) if len(link_set(p) & shortest) == 0 ]
+        if len(ks) != 0:
+            break
+    demands = { (c1, c2) : 5e6, (c2, c1) : 5e6 }
+    assert max_utilization(c, demands, { (c1, c2) : c.paths[c1][c2][0][0], (c2, c1) : c.paths[c2][c1][0][0] }) > C.TE_MAX_UTIL
+
+    choice = c.solve_te(demands, { pair : list(range(len(c.paths[pair[0]][pair[1]]))) for pair in demands })
+    assert max_utilization(c, demands, placed_paths(c, choice)) <= C.TE_MAX_UTIL
+
+
+def make_controller(scenario: str, **kwargs):
+    """
+        Return a controller programming the fake switches of the scenario, see fake_switch.py.
+    """
+    prefix = inputs_dir + scenario
+    topo = FakeTopology(graph=build_topology(links_file=prefix + ".links"))
+    return C.Controller(prefix + ".traffic-base", prefix + ".slas", topo, fake_switch_api(0), **kwargs)
+
+
+def report_links(c, links: list, down: bool):
+    """
+        Report the links to the routing worker like LinkListener and handle them.
+    """
+    for c1, c2 in links:
+        sw2 = c.switches[c2]
+        if down:
+            c.has_failure(sw2, [sw2.sw_links[c1]["port"]])
+        else:
+            c.no_failure(sw2, [sw2.sw_links[c1]["port"]])
+    c.router.handle_pending()
+
+
+def ecmp_bucket_paths(c, src: C.City, dst: C.City):
+    """
+        Follow the labels of each bucket of the group from src to dst installed on the fake switch.
+    """
+    api = c.switches[src].controller.connect()
+    paths = {}
+    for keys, action, params, _ in api.tables.get("ecmp_tbl", {}).values():
+        if keys[0] != str(int(dst)):
+            continue
+        assert action == f"mpls_push_{len(params)}_hop"
+        path = [src]
+        # The first label is pushed last, see build_multipath_from_to.
+        for port in reversed(params):
+            path.append(c.switches[path[-1]].sw_ports[int(port)].city)
+        paths[int(keys[1])] = tuple(path)
+
+    return paths
+
+
+def assert_ecmp_alive(c):
+    for src, dst in c.multipath_pairs:
+        members = c.multipaths[src][dst]
+        assert members is not None and all(c.path_alive(p) for p, _ in members), (str(src), str(dst))
+
+        paths = ecmp_bucket_paths(c, src, dst)
+        assert sorted(paths) == list(range(C.ECMP_BUCKETS))
+        for p in paths.values():
+            assert p[-1] == dst and c.path_alive(p), (str(src), str(dst), [str(x) for x in p])
+
+
+@pytest.mark.parametrize("scenario", ["00_baseline", "01_turing"])
+def test_ecmp_groups_avoid_failed_links(scenario):
+    c = make_controller(scenario)
+    assert len(c.multipath_pairs) != 0
+    assert_ecmp_alive(c)
+
+    # Fail each link used by a multipath group, also when the best path of the group doesn't use it.
+    links = sorted(set( tuple(sorted((p[i], p[i+1])))
+                        for src, dst in c.multipath_pairs for p, _ in c.multipaths[src][dst] for i in range(len(p) - 1) ))
+    for link in links:
+        report_links(c, [link], True)
+        assert_ecmp_alive(c)
+        report_links(c, [link], False)
+        assert_ecmp_alive(c)
+    c.executor.shutdown()
@@ -20,7 +20,7 @@ cur_dir = os.path.dirname(os.path.abspath(__file__)) + "/"
 
 
 def run_controllers(net: AdvNetNetworkAPI, inputidr, scenario: str,
-                    log_enabled: bool = False):
+                    log_enabled: bool = False, reference_time: float = 0):
     """Schedules controllers
 
     The controller code must be placed in `inputdir/controllers/`
@@ -31,6 +31,9 @@ def run_controllers(net: AdvNetNetworkAPI, inputidr, scenario: str,
 
     The global controller must be called: controller.py Per switch controllers
     must be called: <switch_name>-controller.py. For example: BAR-controller.py
+
+    If `reference_time` is set, the global controller gets the simulation
+    reference time, so it knows when the base flows start.
     """
 
     # path to SLAs
@@ -45,10 +48,11 @@ def run_controllers(net: AdvNetNetworkAPI, inputidr, scenario: str,
         log_file = None
         if log_enabled:
             log_file = "./log/controller.log"
-        net.execScript(
-            'python {}/controller.py --base-traffic {} --slas {}'.format(
-                controllers_dir, base_traffic_file, slas_file),
-            out_file=log_file, reboot=True)
+        cmd = 'python {}/controller.py --base-traffic {} --slas {}'.format(
+            controllers_dir, base_traffic_file, slas_file)
+        if reference_time:
+            cmd += ' --reference-time {}'.format(reference_time)
+        net.execScript(cmd, out_file=log_file, reboot=True)
     # schedule other controllers
     for switch_name in net.p4switches():
         if os.path.isfile(
@@ -85,7 +89,7 @@ def program_switches(net: AdvNetNetworkAPI, inputdir):
 def run_network(
         inputdir, scenario, outputdir, debug_mode, log_enabled, pcap_enabled,
         warmup_phase=10, check_constrains=True, no_events=False,
-        only_check_inputs=False):
+        only_check_inputs=False, controller_reference_time=False, traffic_agent=False):
     """Starts the project simulation"""
     # starts the flow scheduling task
     net = AdvNetNetworkAPI()
@@ -150,7 +154,7 @@ def run_network(
     traffic_manager = TrafficManager(
         net, _additional_traffic_file, _base_traffic_file, _slas_file,
         _additional_traffic_constrains, _base_traffic_constrains,
-        check_constrains, outputdir, experiment_duration)
+        check_constrains, outputdir, experiment_duration, traffic_agent)
 
     # configure net waypoints
     waypoint_switches = traffic_manager.get_wp_helper().get_waypoint_switches()
@@ -162,7 +166,8 @@ def run_network(
 
     if not only_check_inputs:
         # Adds controllers.
-        run_controllers(net, inputdir, scenario, log_enabled)
+        run_controllers(net, inputdir, scenario, log_enabled,
+                        simulation_time_reference if controller_reference_time else 0)
 
         # enable or disable logs and pcaps
         if log_enabled:
@@ -256,6 +261,14 @@ def get_args():
         '--check-inputs',
         help='Only checks if input files fulfill the contrains. Does not run the network!',
         action='store_true', required=False, default=False)
+    parser.add_argument(
+        '--controller-reference-time',
+        help='Passes the simulation start time to the global controller, so it only reserves capacity for the active base flows',
+        action='store_true', required=False, default=False)
+    parser.add_argument(
+        '--traffic-agent',
+        help='Runs the flows of each host in one asyncio traffic agent instead of a task per sender and receiver',
+        action='store_true', required=False, default=False)
     return parser.parse_args()
 
     # constrains are disabled if no-constrains is set.
@@ -265,4 +278,5 @@ if __name__ == "__main__":
     args = get_args()
     run_network(args.inputdir, args.scenario, args.outputdir, args.debug_mode,
                 args.log_enabled, args.pcap_enabled, float(args.warmup),
-                args.no_constrains, args.no_events, args.check_inputs)
+                args.no_constrains, args.no_events, args.check_inputs,
+                args.controller_reference_time, args.traffic_agent)